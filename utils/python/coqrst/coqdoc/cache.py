@@ -0,0 +1,181 @@
+"""
+Cache coqdoc's highlighting across documents, workers, and builds.
+==================================================================
+
+The same snippets (``Reset Initial.``, ``Check nat.``, common ``Require``
+lines…) appear in many documents.  A `HighlightCache` stores the tokens of
+each snippet in an sqlite database, keyed by a hash of the snippet, the coqdoc
+binary, its options, and `COQDOC_HEADER`.  The database uses write-ahead
+logging, so that Sphinx's parallel workers can share it.  Entries record when
+they were last used, and `HighlightCache.prune` drops the least recently used
+ones beyond a maximum count.  To keep lookups from taking write locks, the
+time of last use is only updated on the first use of an entry in each build.
+
+The cache is an optimization: if the database can't be used (a read-only
+directory, a file system without the locking that WAL mode needs, a lock held
+for too long…), the error is reported once and the cache disables itself, so
+that snippets are simply highlighted by coqdoc.
+
+Run ``python3 -m coqrst.coqdoc.cache [--clear] DATABASE`` to show statistics
+about a cache, or to empty it.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+
+from .main import COQDOC_OPTIONS, COQDOC_HEADER
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT NOT NULL, last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS tokens_last_used ON tokens (last_used);
+"""
+
+LOCK_TIMEOUT = 30 # Seconds to wait for another process's write lock
+
+def coqdoc_fingerprint(coqdoc_bin="coqdoc"):
+    """Compute a string identifying coqdoc_bin, its options, and the header
+    prepended to snippets (see `coqrst.repl.cache.fingerprint`)."""
+    path = shutil.which(coqdoc_bin) or coqdoc_bin
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        binary = "{}:{}:{}".format(path, st.st_size, st.st_mtime_ns)
+    except OSError:
+        binary = path
+    return "\0".join([binary] + COQDOC_OPTIONS + [COQDOC_HEADER])
+
+class HighlightCache:
+    """A size-bounded, sqlite-backed LRU cache of token lists.
+
+    Connections are opened for each operation, so instances can be shared with
+    threads and forked processes.
+    """
+
+    def __init__(self, path, max_entries, fingerprint=None, on_error=None):
+        """Create a cache in the database at path (but don't create it yet).
+
+        :param max_entries: An upper bound on the number of entries, as
+                            enforced by `prune`.
+        :param fingerprint: Identifies the lexer; see `coqdoc_fingerprint`.
+        :param on_error:    Called with a message when the database fails, after
+                            which `get_many`, `put_many` and `prune` do nothing.
+        """
+        self.path, self.max_entries = path, max_entries
+        self.fingerprint = coqdoc_fingerprint() if fingerprint is None else fingerprint
+        self.on_error, self.disabled = on_error, False
+        self.started = time.time() # Entries used since then don't need a new last_used
+        self.hits, self.misses = 0, 0
+
+    def _disable(self, error):
+        """Stop using the database, after error."""
+        if not self.disabled:
+            self.disabled = True
+            if self.on_error:
+                self.on_error("Not using the coqdoc cache at {}: {}".format(self.path, error))
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+
+    def key(self, snippet):
+        return hashlib.sha256("\0".join([self.fingerprint, snippet]).encode("utf-8")).hexdigest()
+
+    def get_many(self, snippets):
+        """Return a list with the cached tokens of each snippet, or None."""
+        if self.disabled:
+            return [None] * len(snippets)
+        keys = [self.key(snippet) for snippet in snippets]
+        found, stale = {}, []
+        try:
+            db = self.connect()
+            try:
+                for start in range(0, len(keys), 500): # Stay below sqlite's limit on parameters
+                    batch = keys[start:start + 500]
+                    marks = ",".join("?" * len(batch))
+                    query = "SELECT key, tokens, last_used FROM tokens WHERE key IN ({})".format(marks)
+                    for key, tokens, last_used in db.execute(query, batch):
+                        found[key] = tokens
+                        if last_used < self.started:
+                            stale.append(key)
+                if stale:
+                    with db:
+                        db.executemany("UPDATE tokens SET last_used = ? WHERE key = ?",
+                                       [(time.time(), key) for key in stale])
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+            return [None] * len(snippets)
+        hits = sum(key in found for key in keys)
+        self.hits, self.misses = self.hits + hits, self.misses + len(keys) - hits
+        return [[tuple(token) for token in json.loads(found[key])] if key in found else None
+                for key in keys]
+
+    def put_many(self, snippets, tokens):
+        """Store tokens (a list of lists of (classes, text) pairs) for snippets."""
+        if self.disabled:
+            return
+        now = time.time()
+        rows = [(self.key(snippet), json.dumps(toks), now) for snippet, toks in zip(snippets, tokens)]
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", rows)
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+
+    def prune(self):
+        """Remove least-recently used entries beyond max_entries."""
+        if self.disabled:
+            return
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.execute("DELETE FROM tokens WHERE key IN (SELECT key FROM tokens "
+                               "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+
+    def clear(self):
+        db = self.connect()
+        try:
+            with db:
+                db.execute("DELETE FROM tokens")
+            db.execute("VACUUM")
+        finally:
+            db.close()
+
+    def count(self):
+        db = self.connect()
+        try:
+            return db.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+        finally:
+            db.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect or clear a coqdoc highlight cache.")
+    parser.add_argument("database", help="Path to the cache (coqdoc-cache.sqlite in Sphinx's doctree directory)")
+    parser.add_argument("--clear", action="store_true", help="Remove all entries")
+    args = parser.parse_args()
+    cache = HighlightCache(args.database, 0, fingerprint="")
+    if args.clear:
+        cache.clear()
+    size = os.path.getsize(args.database) if os.path.exists(args.database) else 0
+    print("{}: {} entries, {} bytes".format(args.database, cache.count(), size))
+
+if __name__ == '__main__':
+    main()
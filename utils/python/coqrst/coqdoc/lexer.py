@@ -0,0 +1,176 @@
+"""
+A pure-Python Coq lexer
+=======================
+
+A fast, in-process approximation of coqdoc's highlighting (see `main`), which
+produces the same ``coqdoc-<type>`` classes as `coqrst.coqdoc.lex`.  Unlike
+coqdoc, it handles sentence fragments (such as ``(a: A) (b: B)``) gracefully.
+
+Comments (which nest, and may contain strings) and strings are single tokens,
+classified as ``coqdoc-comment`` and ``coqdoc-string``.  Runs of symbols
+(``/\\``, ``<->``, ``++``, …) are ``coqdoc-notation`` tokens, except for
+Gallina's own punctuation (``:=``, ``=>``, ``|``, …) and bullets.  Without
+globalization information, coqdoc prints notations and strings as plain text,
+so `main` doesn't count these two classes as mismatches.
+"""
+
+import re
+
+GALLINA_KEYWORDS = frozenset("""
+    Abort About Add Admitted All Arguments Axiom Axioms Back BackTo Bind Canonical
+    Check Class Close CoFixpoint CoInductive Coercion Compute Conjecture
+    Conjectures Constant Context Corollary Declare Defined Definition Delimit
+    Derive Drop End Eval Example Existing Export Extract Extraction Fact Fail
+    Fixpoint Focus Functional Generalizable Global Goal Hint Hypotheses Hypothesis
+    Identity Implicit Import Include Inductive Infix Inline Instance Lemma Let
+    Load Local Locate Ltac Module Monomorphic Morphism Next Notation Obligation
+    Obligations Opaque Open Parameter Parameters Polymorphic Print Program Proof
+    Property Proposition Qed Record Recursive Relation Remark Require Reserved
+    Reset Restart Save Scheme Scope Search SearchAbout SearchPattern
+    SearchRewrite Section Set Setoid Show Solve Structure Tactic Theorem Time
+    Timeout Transparent Undo Unfocus Universe Universes Unset Variable Variables
+    Variant
+    Prop SProp Type as at cofix else end exists exists2 fix for forall fun if
+    in let match return struct then using where with
+""".split())
+
+TACTICS = frozenset("""
+    abstract apply assert assumption auto autorewrite by case cbv change clear
+    compute congruence constructor cut debug dependent destruct discriminate do
+    eapply eauto econstructor eexact eexists elim elimtype eval evar exact
+    exfalso f_equal fail field first firstorder fold fresh generalize hnf idtac
+    induction info injection instantiate intro intros intuition inversion
+    inversion_clear lazy left move omega pattern pose progress red refine
+    reflexivity rename repeat replace rewrite right ring set setoid_rewrite
+    simpl simple solve specialize split subst symmetry tauto transitivity trivial
+    try unfold until
+""".split())
+
+# Symbols that are part of Gallina's syntax, rather than notations
+PUNCTUATION = frozenset(": := :> :: | || => -> <- ; , @ ! ? ..".split())
+
+IDENT = r"[^\W\d][\w']*"
+TOKEN_RE = re.compile(r"""
+    (?P<comment>\(\*)
+  | (?P<string>")
+  | (?P<ident>{ident}(?:\.{ident})*)
+  | (?P<symbol>[-!#$%&*+/:;<=>?@\\^|~]+)
+  | (?P<other>\s+|[0-9]+|.)
+""".format(ident=IDENT), re.VERBOSE | re.DOTALL)
+COMMENT_RE = re.compile(r'\(\*|\*\)|"')
+BULLET_RE = re.compile(r"-+|\++|\*+")
+STRING_BODY_RE = re.compile(r'(?:[^"]|"")*"') # Quotes are escaped by doubling them
+
+def skip_string(source, pos):
+    """Return the position after the end of the string starting before pos."""
+    match = STRING_BODY_RE.match(source, pos)
+    return match.end() if match else len(source)
+
+def skip_comment(source, pos):
+    """Return the position after the end of the comment starting before pos."""
+    depth = 1
+    while depth:
+        match = COMMENT_RE.search(source, pos)
+        if not match:
+            return len(source)
+        pos = match.end()
+        if match.group() == '"':
+            pos = skip_string(source, pos)
+        else:
+            depth += 1 if match.group() == "(*" else -1
+    return pos
+
+# Classes that coqdoc doesn't produce when run without a .glob file (see main)
+UNTYPED_BY_COQDOC = frozenset(["coqdoc-notation", "coqdoc-string"])
+
+# Maximum fraction of snippets on which `main` tolerates differences with coqdoc
+MAX_MISMATCH_RATE = 0.05
+
+def classify(ident):
+    if ident in GALLINA_KEYWORDS:
+        return "keyword"
+    elif ident in TACTICS:
+        return "tactic"
+    return "var"
+
+def is_bullet(source, match):
+    """Check whether match (a run of symbols) is a bullet starting source."""
+    return BULLET_RE.fullmatch(match.group()) is not None and not source[:match.start()].strip()
+
+def lex(source):
+    """Convert source into a stream of (css_classes, token_string)."""
+    pos, plain = 0, []
+    while pos < len(source):
+        match = TOKEN_RE.match(source, pos)
+        kind, pos = match.lastgroup, match.end()
+        if kind == "comment":
+            pos = skip_comment(source, pos)
+        elif kind == "string":
+            pos = skip_string(source, pos)
+        elif kind == "ident":
+            kind = classify(match.group())
+        elif kind == "symbol" and not (match.group() in PUNCTUATION or is_bullet(source, match)):
+            kind = "notation"
+        else:
+            plain.append(match.group())
+            continue
+        if plain:
+            yield [], "".join(plain)
+            plain = []
+        yield ["coqdoc-{}".format(kind)], source[match.start():pos]
+    if plain:
+        yield [], "".join(plain)
+
+def lex_many(sources):
+    """Lex each of sources; same interface as `coqrst.coqdoc.lex_many`."""
+    return [list(lex(source)) for source in sources]
+
+def normalize(tokens, ignored=()):
+    """Merge consecutive tokens with identical classes, ignoring whitespace and
+    the classes in ignored."""
+    merged = []
+    for classes, text in tokens:
+        classes = [cls for cls in classes if cls not in ignored]
+        text = re.sub(r"\s+", "", text)
+        if merged and merged[-1][0] == classes:
+            merged[-1] = (classes, merged[-1][1] + text)
+        elif text:
+            merged.append((classes, text))
+    return merged
+
+def sphinx_snippets(rst_paths):
+    """Extract the sentences of coqtop and coqdoc blocks from rst_paths, split
+    as the Sphinx build splits them."""
+    import textwrap
+    from ..repl.sentences import split_sentences
+    directive = re.compile(r"^( *)\.\. (?:coqtop|coqdoc)::.*\n((?:\1 +.*\n|[ \t]*\n)*)", re.MULTILINE)
+    for path in rst_paths:
+        with open(path, encoding="utf-8") as f:
+            for match in directive.finditer(f.read()):
+                yield from split_sentences(textwrap.dedent(match.group(2)).strip())
+
+def main():
+    """Compare this lexer with coqdoc on the sentences of the given rst files.
+
+    Exit with a non-zero status if they differ on more than
+    ``--max-mismatches`` of the sentences."""
+    import sys
+    import argparse
+    from .main import lex_many as coqdoc_lex_many
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("paths", nargs="+", help="reStructuredText files")
+    parser.add_argument("--max-mismatches", type=float, default=MAX_MISMATCH_RATE,
+                        help="Tolerated fraction of differing sentences (default: %(default)s)")
+    args = parser.parse_args()
+    snippets = list(sphinx_snippets(args.paths))
+    mismatches = 0
+    for snippet, reference in zip(snippets, coqdoc_lex_many(snippets)):
+        ours, theirs = normalize(lex(snippet), UNTYPED_BY_COQDOC), normalize(reference)
+        if ours != theirs:
+            mismatches += 1
+            print("{!r}\n  coqdoc: {}\n  python: {}".format(snippet, theirs, ours))
+    print("{}/{} snippets differ".format(mismatches, len(snippets)))
+    sys.exit(1 if mismatches > args.max_mismatches * len(snippets) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -7,34 +7,41 @@ Only works for full, syntactically valid sentences; on shorter snippets, coqdoc
 swallows parts of the input.
 
 Works by reparsing coqdoc's output into the output that Sphinx expects from a
-lexer.
+lexer.  Use `lex_many` to lex multiple snippets with a single coqdoc process.
 """
 
 import os
+import re
 from tempfile import mkstemp
 from subprocess import check_output
 
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
-
 COQDOC_OPTIONS = ['--body-only', '--no-glob', '--no-index', '--no-externals',
                   '-s', '--html', '--stdout', '--utf8']
 
 COQDOC_SYMBOLS = ["->", "<-", "<->", "=>", "<=", ">=", "<>", "~", "/\\", "\\/", "|-", "*", "forall", "exists"]
 COQDOC_HEADER = "".join("(** remove printing {} *)".format(s) for s in COQDOC_SYMBOLS)
 
-def coqdoc(coq_code, coqdoc_bin="coqdoc"):
+# A HighlightCache (see coqrst.coqdoc.cache) used by lex_many, if any
+CACHE = None
+
+SNIPPET_SENTINEL = "(** coqrst-snippet-{} *)\n"
+SNIPPET_SENTINEL_RE = re.compile(r"coqrst-snippet-([0-9]+)")
+
+def coqdoc(coq_code, coqdoc_bin="coqdoc", timeout=2):
     """Get the output of coqdoc on coq_code."""
     fd, filename = mkstemp(prefix="coqdoc-", suffix=".v")
     try:
         os.write(fd, COQDOC_HEADER.encode("utf-8"))
         os.write(fd, coq_code.encode("utf-8"))
         os.close(fd)
-        return check_output([coqdoc_bin] + COQDOC_OPTIONS + [filename], timeout = 2).decode("utf-8")
+        return check_output([coqdoc_bin] + COQDOC_OPTIONS + [filename], timeout=timeout).decode("utf-8")
     finally:
         os.remove(filename)
 
+# bs4 is slow to load, so it's imported lazily, in each function that uses it
+
 def is_whitespace_string(elem):
+    from bs4.element import NavigableString
     return isinstance(elem, NavigableString) and elem.strip() == ""
 
 def strip_soup(soup, pred):
@@ -50,22 +57,92 @@ def strip_soup(soup, pred):
 
     soup.contents[:] = soup.contents[skip:]
 
-def lex(source):
-    """Convert source into a stream of (css_classes, token_string)."""
-    soup = BeautifulSoup(coqdoc(source))
-    root = soup.find(class_='code')
-    strip_soup(root, is_whitespace_string)
-    for elem in root.children:
+def lex_elements(elems):
+    """Convert elems (children of a coqdoc code block) into (css_classes, token_string) pairs."""
+    from bs4.element import NavigableString
+    for elem in elems:
         if isinstance(elem, NavigableString):
             yield [], elem
-        elif elem.name == "span":
-            cls = "coqdoc-{}".format(elem['type'])
-            yield [cls], elem.string
+        elif elem.name == "span": # Comments have a class, but no type
+            cls = "coqdoc-{}".format(elem.get('type') or elem['class'][0])
+            yield [cls], elem.get_text()
         elif elem.name == 'br':
             pass
         else:
             raise ValueError(elem)
 
+def lex(source):
+    """Convert source into a stream of (css_classes, token_string)."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(coqdoc(source), "html.parser")
+    root = soup.find(class_='code')
+    strip_soup(root, is_whitespace_string)
+    yield from lex_elements(root.children)
+
+def use_cache(cache):
+    """Make lex_many use cache (a HighlightCache, or None)."""
+    global CACHE # pylint: disable=global-statement
+    CACHE = cache
+
+def lex_many(sources):
+    """Lex each of sources, running coqdoc only once (and only on sources that
+    aren't in `CACHE`).
+
+    :return: A list with one list of (css_classes, token_string) per source.
+    """
+    if not sources:
+        return []
+    cached = CACHE.get_many(sources) if CACHE else [None] * len(sources)
+    missing = sorted(set(src for src, tokens in zip(sources, cached) if tokens is None))
+    if missing:
+        lexed = lex_many_with_coqdoc(missing)
+        if CACHE:
+            CACHE.put_many(missing, lexed)
+        found = dict(zip(missing, lexed))
+        cached = [found[src] if tokens is None else tokens for src, tokens in zip(sources, cached)]
+    return cached
+
+def lex_many_with_coqdoc(sources):
+    """Lex each of sources, running coqdoc only once.
+
+    Snippets are separated by numbered sentinel documentation comments, which
+    coqdoc renders as ‘doc’ blocks between ‘code’ blocks.  If a snippet
+    swallows a sentinel (e.g. because of an unterminated comment), fall back to
+    lexing each snippet separately.
+
+    Token strings are converted to plain strings: bs4's strings keep their
+    whole soup alive, and can't be pickled.
+    """
+
+    from bs4 import BeautifulSoup
+
+    coq_code = "".join(SNIPPET_SENTINEL.format(idx) + src + "\n"
+                       for idx, src in enumerate(sources))
+    soup = BeautifulSoup(coqdoc(coq_code, timeout=2 + len(sources) / 50), "html.parser")
+
+    current, code_children = None, [[] for _ in sources]
+    for block in soup.find_all(class_=['doc', 'code']):
+        if 'doc' in block['class']:
+            match = SNIPPET_SENTINEL_RE.search(block.get_text())
+            if match:
+                if int(match.group(1)) != (-1 if current is None else current) + 1:
+                    break
+                current = int(match.group(1))
+        elif current is not None:
+            code_children[current].extend(block.contents)
+
+    if current != len(sources) - 1:
+        return [[(classes, str(text)) for classes, text in lex(src)] for src in sources]
+
+    tokens = []
+    for children in code_children:
+        while children and is_whitespace_string(children[-1]):
+            children.pop()
+        while children and is_whitespace_string(children[0]):
+            children.pop(0)
+        tokens.append([(classes, str(text)) for classes, text in lex_elements(children)])
+    return tokens
+
 def main():
     """Lex stdin (for testing purposes)"""
     import sys
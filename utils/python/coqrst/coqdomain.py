@@ -6,45 +6,118 @@ could imagine extending it.
 
 # pylint: disable=too-few-public-methods
 
+import os
 import re
+import sys
 from itertools import chain
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 from docutils import nodes, utils
 from docutils.transforms import Transform
 from docutils.parsers.rst import Directive, directives
-from docutils.parsers.rst.roles import code_role #, set_classes
+from docutils.parsers.rst.roles import code_role, set_classes
 from docutils.parsers.rst.directives.admonitions import BaseAdmonition
 
 from sphinx import addnodes
 from sphinx.roles import XRefRole
+from sphinx.util import logging
 from sphinx.util.nodes import set_source_info, set_role_source_info, make_refnode
+from sphinx.transforms import SphinxTransform
 from sphinx.directives import ObjectDescription
 from sphinx.domains import Domain, ObjType, Index
 from sphinx.ext.mathbase import MathDirective, displaymath
 
 from . import coqdoc
+from . import timing
+from .coqdoc import lexer as pylexer
 from .repl import ansicolors
 from .repl.coqtop import CoqTop
+from .repl import incremental
+from .repl.parallel import split_for_jobs, run_segments, run_longest_first
+from .repl.sentences import split_sentences
+from .repl.cache import ResponseCache, CachedCoqTop, RESET_SENTENCE
+from .repl.pool import CoqTopPool, PooledCoqTop
 from .notations.sphinx import sphinxify
 from .notations.plain import stringify_with_ellipses
+from .notations.parsing import NotationSyntaxError
+
+logger = logging.getLogger(__name__)
 
 def parse_notation(notation, source, line, rawtext=None):
-    """Parse notation and wrap it in an inline node"""
-    node = nodes.inline(rawtext or notation, '', *sphinxify(notation), classes=['notation'])
+    """Parse notation and wrap it in an inline node
+
+    :raises NotationSyntaxError: if notation is malformed."""
+    with timing.measure("notations"):
+        node = nodes.inline(rawtext or notation, '', *sphinxify(notation), classes=['notation'])
     node.source, node.line = source, line
     return node
 
+def stringify_notation(notation):
+    """Like stringify_with_ellipses, but return malformed notations unchanged.
+
+    Errors are reported when rendering the notation."""
+    try:
+        return stringify_with_ellipses(notation)
+    except NotationSyntaxError:
+        return notation
+
 def highlight_using_coqdoc(sentence):
     """Lex sentence using coqdoc, and yield inline nodes for each token"""
-    tokens = coqdoc.lex(utils.unescape(sentence, 1))
+    with timing.measure("coqdoc"):
+        tokens = coqdoc.lex(utils.unescape(sentence, 1))
     for classes, value in tokens:
         yield nodes.inline(value, value, classes=classes)
 
+def highlight_many_using_coqdoc(pending, lexer=coqdoc):
+    """Lex multiple snippets at once (with a single coqdoc process, by default).
+
+    :param pending: A list of (node, snippet) pairs; inline nodes for the tokens
+                    of each snippet are appended to the corresponding node.
+    :param lexer: A module providing ‘lex_many’: either `coqdoc` or `pylexer`.
+    """
+    add_highlighting(pending, lex_snippets([snippet for _, snippet in pending], lexer))
+
+def lex_snippets(snippets, lexer=coqdoc):
+    """Lex snippets using lexer (see highlight_many_using_coqdoc), and return
+    the list of their tokens."""
+    snippets = [utils.unescape(snippet, 1) for snippet in snippets]
+    with timing.measure("coqdoc"):
+        return list(lexer.lex_many(snippets))
+
+def add_highlighting(pending, lexed):
+    """Append inline nodes for the tokens of each snippet in pending (see
+    highlight_many_using_coqdoc), given lexed, the list of their tokens."""
+    for (node, _), tokens in zip(pending, lexed):
+        for classes, value in tokens:
+            node += nodes.inline(value, value, classes=classes)
+
+def colorize_output(output):
+    """Parse ANSI sequences in output (from coqtop) into Sphinx nodes."""
+    with timing.measure("ansi"):
+        return AnsiColorsParser().colorize_str(output)
+
 def make_target(objtype, targetid):
     """Create a target to an object of type objtype and id targetid"""
     return "coq:{}.{}".format(objtype, targetid)
 
+class ObjectRecord(namedtuple("ObjectRecord", "docname objtype anchor")):
+    """Where a Coq object is defined, as stored in the domain's data.
+
+    There is one record per object, and the environment pickles all of them,
+    so records are small: docnames and objtypes are interned (pickle then
+    stores each of them once), and the target id is computed from the objtype
+    and the anchor (see `make_target`).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, docname, objtype, anchor):
+        return cls(sys.intern(docname), sys.intern(objtype), anchor)
+
+    @property
+    def targetid(self):
+        return make_target(self.objtype, self.anchor)
+
 class CoqObject(ObjectDescription):
     """A generic Coq object; all Coq objects are subclasses of this.
 
@@ -104,29 +177,32 @@ class CoqObject(ObjectDescription):
         if self.index_suffix:
             return " " + self.index_suffix
 
-    def _record_name(self, name, target_id):
-        """Record a name, mapping it to target_id
+    def _record_name(self, name, anchor):
+        """Record a name, mapping it to anchor (see `make_target`)
 
         Warns if another object of the same name already exists.
         """
-        names_in_subdomain = self.env.domaindata['coq']['objects'][self._subdomain()]
+        data = self.env.domaindata['coq']
+        names_in_subdomain = data['objects'][self._subdomain()]
         # Check that two objects in the same domain don't have the same name
         if name in names_in_subdomain:
             self.state_machine.reporter.warning(
                 'Duplicate Coq object: {}; other is at {}'.format(
-                    name, self.env.doc2path(names_in_subdomain[name][0])),
+                    name, self.env.doc2path(names_in_subdomain[name].docname)),
                 line=self.lineno)
-        names_in_subdomain[name] = (self.env.docname, self.objtype, target_id)
+        CoqDomain.add_object(data, self._subdomain(), name,
+                             ObjectRecord.make(self.env.docname, self.objtype, anchor))
 
     def _add_target(self, signode, name):
         """Register a link target ‘name’, pointing to signode."""
-        targetid = make_target(self.objtype, nodes.make_id(name))
+        anchor = nodes.make_id(name)
+        targetid = make_target(self.objtype, anchor)
         if targetid not in self.state.document.ids:
             signode['ids'].append(targetid)
             signode['names'].append(name)
             signode['first'] = (not self.names)
             self.state.document.note_explicit_target(signode)
-            self._record_name(name, targetid)
+            self._record_name(name, anchor)
         return targetid
 
     def _add_index_entry(self, name, target):
@@ -158,7 +234,12 @@ class NotationObject(CoqObject):
     """A base class for objects whose signatures should be rendered as nested boxes."""
     def _render_signature(self, signature, signode):
         position = self.state_machine.get_source_and_line(self.lineno)
-        tacn_node = parse_notation(signature, *position)
+        try:
+            tacn_node = parse_notation(signature, *position)
+        except NotationSyntaxError as err:
+            self.state_machine.reporter.warning(
+                'Malformed notation {!r}: {}'.format(signature, err), line=self.lineno)
+            tacn_node = nodes.inline(signature, signature, classes=['notation'])
         signode += addnodes.desc_name(signature, '', tacn_node)
 
 class TacticObject(PlainObject):
@@ -180,7 +261,7 @@ class VernacObject(NotationObject):
     annotation = "Command"
 
     def _name_from_signature(self, signature):
-        return stringify_with_ellipses(signature)
+        return stringify_notation(signature)
 
 class VernacVariantObject(VernacObject):
     """An object to represent variants of Coq commands"""
@@ -205,7 +286,7 @@ class OptionObject(NotationObject):
     annotation = "Option"
 
     def _name_from_signature(self, signature):
-        return stringify_with_ellipses(signature)
+        return stringify_notation(signature)
 
 class ExceptionObject(NotationObject):
     """An object to represent Coq errors."""
@@ -216,29 +297,34 @@ class ExceptionObject(NotationObject):
 
     # Generate names automatically
     def _name_from_signature(self, signature):
-        return stringify_with_ellipses(signature)
+        return stringify_notation(signature)
 
 def NotationRole(role, rawtext, text, lineno, inliner, options={}, content=[]):
     #pylint: disable=unused-argument, dangerous-default-value
     """And inline role for notations"""
     notation = utils.unescape(text, 1)
     position = inliner.reporter.get_source_and_line(lineno)
-    return [nodes.literal(rawtext, '', parse_notation(notation, *position, rawtext=rawtext))], []
+    try:
+        node = parse_notation(notation, *position, rawtext=rawtext)
+    except NotationSyntaxError as err:
+        msg = inliner.reporter.warning('Malformed notation {!r}: {}'.format(notation, err), line=lineno)
+        return [inliner.problematic(rawtext, rawtext, msg)], [msg]
+    return [nodes.literal(rawtext, '', node)], []
 
 def coq_code_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     #pylint: disable=dangerous-default-value
     """And inline role for Coq source code"""
-    options['language'] = 'Coq'
-    return code_role(role, rawtext, text, lineno, inliner, options, content)
-    ## Too heavy:
-    ## Forked from code_role to use our custom tokenizer; this doesn't work for
-    ## snippets though: for example CoqDoc swallows the parentheses around this:
-    ## “(a: A) (b: B)”
-    # set_classes(options)
-    # classes = ['code', 'coq']
-    # code = utils.unescape(text, 1)
-    # node = nodes.literal(rawtext, '', *highlight_using_coqdoc(code), classes=classes)
-    # return [node], []
+    if inliner.document.settings.env.config.coq_lexer != 'python':
+        # CoqDoc is too heavy for this, and it doesn't work for snippets: for
+        # example, it swallows the parentheses around this: “(a: A) (b: B)”
+        options['language'] = 'Coq'
+        return code_role(role, rawtext, text, lineno, inliner, options, content)
+    set_classes(options)
+    classes = ['code', 'coq']
+    code = utils.unescape(text, 1)
+    tokens = (nodes.inline(value, value, classes=cls) for cls, value in pylexer.lex(code))
+    node = nodes.literal(rawtext, '', *tokens, classes=classes)
+    return [node], []
 
 # TODO pass different languages?
 LtacRole = GallinaRole = VernacRole = coq_code_role
@@ -299,8 +385,10 @@ class CoqdocDirective(Directive):
     def run(self):
         # Uses a ‘container’ instead of a ‘literal_block’ to disable
         # Pygments-based post-processing (we could also set rawsource to '')
+        # Highlighting is done by CoqtopBlocksTransform, with all other
+        # snippets of this document
         content = '\n'.join(self.content)
-        node = nodes.inline(content, '', *highlight_using_coqdoc(content))
+        node = nodes.inline(content, '', coqdoc_pending=True)
         wrapper = nodes.container(content, node, classes=['coqdoc', 'literal-block'])
         return [wrapper]
 
@@ -435,7 +523,9 @@ class CoqtopBlocksTransform(Transform):
     """Filter handling the actual work for the coqtop directive
 
     Adds coqtop's responses, colorizes input and output, and merges consecutive
-    coqtop directives for better visual rendition.
+    coqtop directives for better visual rendition.  Coqtop inputs and the
+    contents of coqdoc directives are highlighted together, in a single coqdoc
+    run per document.
     """
     default_priority = 10
 
@@ -443,10 +533,14 @@ class CoqtopBlocksTransform(Transform):
     def is_coqtop_block(node):
         return isinstance(node, nodes.Element) and 'coqtop_options' in node
 
+    @staticmethod
+    def is_pending_coqdoc_block(node):
+        return isinstance(node, nodes.Element) and 'coqdoc_pending' in node
+
     @staticmethod
     def split_sentences(source):
-        """Split Coq sentences in source. Could be improved."""
-        return re.split(r"(?<=(?<!\.)\.)\s+", source)
+        """Split Coq sentences in source (see coqrst.repl.sentences)."""
+        return split_sentences(source)
 
     @staticmethod
     def parse_options(options):
@@ -488,36 +582,122 @@ class CoqtopBlocksTransform(Transform):
                 blocks.append(re.sub("^", "    ", output, flags=re.MULTILINE) + "\n")
         return '\n'.join(blocks)
 
-    def add_coqtop_output(self):
-        """Add coqtop's responses to a Sphinx AST
-
-        Finds nodes to process using is_coqtop_block."""
-        with CoqTop(color=True) as repl:
-            for node in self.document.traverse(CoqtopBlocksTransform.is_coqtop_block):
-                options = node['coqtop_options']
-                opt_undo, opt_reset, opt_input, opt_output = self.parse_options(options)
-
-                if opt_reset:
-                    repl.sendone("Reset Initial.")
-                pairs = []
-                for sentence in self.split_sentences(node.rawsource):
-                    pairs.append((sentence, repl.sendone(sentence)))
-                if opt_undo:
-                    repl.sendone("Undo {}.".format(len(pairs)))
-
-                dli = nodes.definition_list_item()
-                for sentence, output in pairs:
-                    # Use Coqdoq to highlight input
-                    in_chunks = highlight_using_coqdoc(sentence)
-                    dli += nodes.term(sentence, '', *in_chunks, classes=self.block_classes(opt_input))
-                    # Parse ANSI sequences to highlight output
-                    out_chunks = AnsiColorsParser().colorize_str(output)
-                    dli += nodes.definition(output, *out_chunks, classes=self.block_classes(opt_output, output))
-                node.clear()
-                node.rawsource = self.make_rawsource(pairs, opt_input, opt_output)
-                node['classes'].extend(self.block_classes(opt_input or opt_output))
-                node += nodes.inline('', '', classes=['coqtop-reset'] * opt_reset)
-                node += nodes.definition_list(node.rawsource, dli)
+    def collect_coqtop_blocks(self):
+        """Find nodes to process using is_coqtop_block, and plan their execution.
+
+        :return: A list of (node, options, sentences) triples, where options are
+                 the parsed options of node, and sentences is the list of
+                 sentences to send for it, including the ones implied by the
+                 ‘reset’ and ‘undo’ options."""
+        blocks = []
+        for node in self.document.traverse(CoqtopBlocksTransform.is_coqtop_block):
+            options = self.parse_options(node['coqtop_options'])
+            opt_undo, opt_reset, _, _ = options
+            sentences = self.split_sentences(node.rawsource)
+            sentences = ([RESET_SENTENCE] * opt_reset + sentences +
+                         ["Undo {}.".format(len(sentences))] * opt_undo)
+            blocks.append((node, options, sentences))
+        return blocks
+
+    def run_segment(self, index, sentences):
+        """Run the index-th segment of this document; see run_coqtop_segment."""
+        env = self.document.settings.env
+        return run_coqtop_segment(env.app, env.docname, index, sentences)
+
+    def run_sentences(self, sentences, stage):
+        """Send sentences to coqtop, and colorize its responses.
+
+        Segments delimited by resets are independent, so with coqtop_jobs > 1
+        they run concurrently on separate coqtop processes (see run_segment);
+        otherwise, all sentences run on one process.  The outputs of each
+        segment are colorized on stage (an executor) as soon as the segment
+        completes, while other segments still run.
+
+        :return: A list of (output, future of colorize_output(output)) pairs."""
+        def run_segment(index, segment):
+            outputs = self.run_segment(index, segment)
+            return [(output, stage.submit(colorize_output, output)) for output in outputs]
+        jobs = self.document.settings.env.config.coqtop_jobs
+        return run_segments(split_for_jobs(sentences, jobs), run_segment, jobs)
+
+    @staticmethod
+    def shown(options, items):
+        """Drop the items (one per sentence of a block with options) that
+        correspond to sentences implied by the ‘reset’ and ‘undo’ options."""
+        opt_undo, opt_reset, _, _ = options
+        return items[opt_reset:len(items) - opt_undo]
+
+    def fill_coqtop_block(self, node, options, sentences, outputs, pending, colorized=None):
+        """Replace the contents of node by its sentences and their outputs.
+
+        Input sentences are not highlighted immediately; instead, (node,
+        sentence) pairs are added to pending.
+
+        :param colorized: The nodes of each output, if already computed by
+                          colorize_output."""
+        _, opt_reset, opt_input, opt_output = options
+        pairs = self.shown(options, list(zip(sentences, outputs)))
+        colorized = self.shown(options, colorized) if colorized else [None] * len(pairs)
+
+        dli = nodes.definition_list_item()
+        for (sentence, output), out_chunks in zip(pairs, colorized):
+            # Use Coqdoq to highlight input (later)
+            term = nodes.term(sentence, '', classes=self.block_classes(opt_input))
+            pending.append((term, sentence))
+            dli += term
+            # Parse ANSI sequences to highlight output (the text is only
+            # stored in out_chunks: large outputs would double the doctree)
+            if out_chunks is None:
+                out_chunks = colorize_output(output)
+            dli += nodes.definition('', *out_chunks, classes=self.block_classes(opt_output, output))
+        node.clear()
+        node.rawsource = self.make_rawsource(pairs, opt_input, opt_output)
+        node['classes'].extend(self.block_classes(opt_input or opt_output))
+        node += nodes.inline('', '', classes=['coqtop-reset'] * opt_reset)
+        node += nodes.definition_list(node.rawsource, dli)
+
+    def add_coqtop_output(self, pending):
+        """Add coqtop's responses to a Sphinx AST, and highlight Coq code.
+
+        All sentences of the document are sent at once (see run_sentences), and
+        work is overlapped with coqtop's: the inputs of all blocks are known in
+        advance, so they are lexed (with the snippets of pending) in the
+        background while coqtop runs, and outputs are colorized as their
+        segments complete.  Then each block is filled in order using
+        fill_coqtop_block, and highlighting is added to all nodes."""
+        blocks = self.collect_coqtop_blocks()
+        if not blocks:
+            self.highlight(pending)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        inputs = [s for _, options, sentences in blocks for s in self.shown(options, sentences)]
+        with ThreadPoolExecutor(max_workers=2) as stage: # One lexer, one colorizer
+            lexed = stage.submit(lex_snippets, [s for _, s in pending] + inputs, self.lexer())
+            results = self.run_sentences([s for _, _, sentences in blocks for s in sentences], stage)
+            outputs = [output for output, _ in results]
+            colorized = [future.result() for _, future in results]
+            self.fill_coqtop_blocks(blocks, outputs, pending, colorized)
+            add_highlighting(pending, lexed.result())
+
+    def fill_coqtop_blocks(self, blocks, outputs, pending, colorized=None):
+        """Fill blocks (see collect_coqtop_blocks) using fill_coqtop_block.
+
+        :param outputs: The responses to the sentences of all blocks, in order.
+        :param colorized: The nodes of each output, if already computed."""
+        start = 0
+        for node, options, sentences in blocks:
+            end = start + len(sentences)
+            self.fill_coqtop_block(node, options, sentences, outputs[start:end], pending,
+                                   colorized and colorized[start:end])
+            start = end
+
+    def defer_coqtop_output(self):
+        """Record the sentences of this document in env.coq_deferred, instead of
+        running them now (see run_deferred_coqtop); the blocks stay as they are."""
+        env = self.document.settings.env
+        blocks = self.collect_coqtop_blocks()
+        if blocks:
+            env.coq_deferred[env.docname] = [s for _, _, sentences in blocks for s in sentences]
 
     @staticmethod
     def merge_coqtop_classes(kept_node, discarded_node):
@@ -540,8 +720,37 @@ class CoqtopBlocksTransform(Transform):
                     else:
                         break
 
+    def collect_coqdoc_blocks(self, pending):
+        """Add (node, source) pairs for each coqdoc directive to pending."""
+        for node in self.document.traverse(CoqtopBlocksTransform.is_pending_coqdoc_block):
+            del node['coqdoc_pending']
+            pending.append((node, node.rawsource))
+
+    def lexer(self):
+        use_pylexer = self.document.settings.env.config.coq_lexer == 'python'
+        return pylexer if use_pylexer else coqdoc
+
+    def highlight(self, pending):
+        if pending:
+            highlight_many_using_coqdoc(pending, self.lexer())
+
     def apply(self):
-        self.add_coqtop_output()
+        with timing.measure("transform"):
+            pending = []
+            self.collect_coqdoc_blocks(pending)
+            if self.document.settings.env.config.coqtop_deferred:
+                self.defer_coqtop_output()
+                self.highlight(pending)
+            else:
+                self.add_coqtop_output(pending)
+                self.merge_consecutive_coqtop_blocks()
+
+    def apply_deferred(self, outputs):
+        """Fill the coqtop blocks of a document that was read with
+        coqtop_deferred set, given outputs, the responses to its sentences."""
+        pending = []
+        self.fill_coqtop_blocks(self.collect_coqtop_blocks(), outputs, pending)
+        self.highlight(pending)
         self.merge_consecutive_coqtop_blocks()
 
 class CoqSubdomainsIndex(Index):
@@ -557,12 +766,12 @@ class CoqSubdomainsIndex(Index):
         items = chain(*(self.domain.data['objects'][subdomain].items()
                         for subdomain in self.subdomains))
 
-        for itemname, (docname, _, anchor) in sorted(items, key=lambda x: x[0].lower()):
-            if docnames and docname not in docnames:
+        for itemname, record in sorted(items, key=lambda x: x[0].lower()):
+            if docnames and record.docname not in docnames:
                 continue
 
             entries = content[itemname[0].lower()]
-            entries.append([itemname, 0, docname, anchor, '', '', ''])
+            entries.append([itemname, 0, record.docname, record.targetid, '', '', ''])
 
         collapse = False
         content = sorted(content.items())
@@ -613,6 +822,47 @@ def GrammarProductionRole(typ, rawtext, text, lineno, inliner, options={}, conte
     env.domaindata['std']['objects']['token', text] = env.docname, targetid
     return [node], []
 
+def grammar_tokens(env):
+    """Return a dict mapping grammar tokens (from `productionlist` directives and
+    the `production` role) to the (docname, targetid) pairs that define them."""
+    return {name: target for (objtype, name), target in env.domaindata['std']['objects'].items()
+            if objtype == 'token'}
+
+def reset_grammar_tokens(app, env): # pylint: disable=unused-argument
+    """Forget the grammar tokens of the previous build, once all documents are read."""
+    app.coq_grammar_tokens = None
+
+def is_hole(node):
+    return isinstance(node, nodes.inline) and 'hole' in node['classes']
+
+class NotationHolesResolver(SphinxTransform):
+    """Link holes in notations (``@token``) to the grammar productions that
+    define them.
+
+    All holes of a document are resolved in one pass, using a table of tokens
+    built once per build; holes without a production stay plain text.
+    """
+
+    default_priority = 5 # Before Sphinx's ReferencesResolver
+
+    def apply(self):
+        holes = self.document.traverse(is_hole)
+        if not holes:
+            return
+        from sphinx.environment import NoUri # Slow to import; see coqrst.startup
+        tokens = getattr(self.app, 'coq_grammar_tokens', None)
+        if tokens is None:
+            tokens = self.app.coq_grammar_tokens = grammar_tokens(self.env)
+        for hole in holes:
+            target = tokens.get(hole.astext())
+            if target:
+                todocname, targetid = target
+                try:
+                    ref = make_refnode(self.app.builder, self.env.docname, todocname, targetid, hole.deepcopy())
+                except NoUri:
+                    continue
+                hole.parent.replace(hole, ref) # Not replace_self, which copies the hole's classes
+
 class CoqDomain(Domain):
     """A domain to document Coq code.
 
@@ -679,20 +929,43 @@ class CoqDomain(Domain):
 
     indices = [CoqVernacIndex, CoqTacticIndex, CoqOptionIndex, CoqGallinaIndex, CoqExceptionIndex]
 
-    data_version = 1
+    data_version = 2
     initial_data = {
         # Collect everything under a key that we control, since Sphinx adds
         # others, such as “version”
-        'objects' : { # subdomain → name → docname, objtype, targetid
+        'objects' : { # subdomain → name → ObjectRecord
             'cmd': {},
             'tac': {},
             'tacn': {},
             'opt': {},
             'thm': {},
             'exn': {},
-        }
+        },
+        'by_doc': {} # docname → subdomain → {name}, for clear_doc and merge_domaindata
     }
 
+    def __init__(self, env):
+        data = env.domaindata.get(self.name)
+        if data is not None and data.get('version') == 1:
+            CoqDomain.migrate_v1(data)
+        super().__init__(env)
+
+    @staticmethod
+    def migrate_v1(data):
+        """Convert data from version 1 (tuples, no reverse index) in place."""
+        objects, data['by_doc'] = data['objects'], {}
+        for subdomain, names in objects.items():
+            for name, (docname, objtype, targetid) in list(names.items()):
+                anchor = targetid[len(make_target(objtype, '')):]
+                CoqDomain.add_object(data, subdomain, name, ObjectRecord.make(docname, objtype, anchor))
+        data['version'] = 2
+
+    @staticmethod
+    def add_object(data, subdomain, name, record):
+        """Record name in subdomain of data, overriding previous definitions."""
+        data['objects'][subdomain][name] = record
+        data['by_doc'].setdefault(record.docname, {}).setdefault(subdomain, set()).add(name)
+
     @staticmethod
     def find_index_by_name(targetid):
         for index in CoqDomain.indices:
@@ -702,20 +975,25 @@ class CoqDomain(Domain):
     def get_objects(self):
         # Used for searching and object inventories (intersphinx)
         for _, objects in self.data['objects'].items():
-            for name, (docname, objtype, targetid) in objects.items():
-                yield (name, name, objtype, docname, targetid, self.object_types[objtype].attrs['searchprio'])
+            for name, record in objects.items():
+                yield (name, name, record.objtype, record.docname, record.targetid,
+                       self.object_types[record.objtype].attrs['searchprio'])
         for index in self.indices:
             yield (index.name, index.localname, 'index', "coq-" + index.name, '', -1)
 
     def merge_domaindata(self, docnames, otherdata):
         DUP = "Duplicate declaration: '{}' also defined in '{}'.\n"
-        for subdomain, their_objects in otherdata['objects'].items():
-            our_objects = self.data['objects'][subdomain]
-            for name, (docname, objtype, targetid) in their_objects.items():
-                if docname in docnames:
+        their_objects = otherdata['objects']
+        for docname in docnames:
+            for subdomain, names in otherdata['by_doc'].get(docname, {}).items():
+                our_objects = self.data['objects'][subdomain]
+                for name in names:
+                    record = their_objects[subdomain][name]
+                    if record.docname != docname: # Overridden by a later definition
+                        continue
                     if name in our_objects:
-                        self.env.warn(docname, DUP.format(name, our_objects[name][0]))
-                    our_objects[name] = (docname, objtype, targetid)
+                        self.env.warn(docname, DUP.format(name, our_objects[name].docname))
+                    CoqDomain.add_object(self.data, subdomain, name, record)
 
     def resolve_xref(self, env, fromdocname, builder, role, targetname, node, contnode):
         # ‘target’ is the name that was written in the document
@@ -727,14 +1005,15 @@ class CoqDomain(Domain):
         else:
             resolved = self.data['objects'][role].get(targetname)
             if resolved:
-                (todocname, _, targetid) = resolved
-                return make_refnode(builder, fromdocname, todocname, targetid, contnode, targetname)
+                return make_refnode(builder, fromdocname, resolved.docname, resolved.targetid, contnode, targetname)
 
     def clear_doc(self, docname_to_clear):
-        for subdomain_objects in self.data['objects'].values():
-            for name, (docname, _, _) in list(subdomain_objects.items()):
-                if docname == docname_to_clear:
-                    del subdomain_objects[name]
+        for subdomain, names in self.data['by_doc'].pop(docname_to_clear, {}).items():
+            objects = self.data['objects'][subdomain]
+            for name in names:
+                record = objects.get(name)
+                if record is not None and record.docname == docname_to_clear:
+                    del objects[name]
 
 def is_coqtop_or_coqdoc_block(node):
     return (isinstance(node, nodes.Element) and
@@ -759,6 +1038,195 @@ def simplify_source_code_blocks_for_latex(app, doctree, fromdocname): # pylint:
             else:
                 node.replace_self(nodes.literal_block(node.rawsource, node.rawsource, language="Coq"))
 
+def make_coqtop_repl(app):
+    """Create a coqtop instance, using the process pool and the response
+    cache if there are ones."""
+    pool = getattr(app, 'coqtop_pool', None)
+    config = app.config
+    coqtop = PooledCoqTop(pool) if pool else CoqTop(color=True, transport=config.coqtop_transport,
+                                                    max_output=config.coqtop_max_output or None,
+                                                    backend=config.coqtop_backend)
+    if timing.RECORDER:
+        coqtop = timing.TimedRepl(coqtop, timing.RECORDER)
+    cache = getattr(app, 'coqtop_cache', None)
+    return CachedCoqTop(coqtop, cache) if cache else coqtop
+
+def run_coqtop_segment(app, docname, index, sentences):
+    """Send sentences (the index-th segment of docname) to a fresh coqtop,
+    and return the list of its responses.
+
+    Uses the coqtop broker if there is one (see coqtop_broker), or else a
+    long-lived incremental session if coqtop_incremental_sessions is set, so
+    that only sentences that changed since the last build re-run."""
+    broker = getattr(app, 'coqtop_broker', None)
+    if broker:
+        with timing.measure("broker"):
+            return broker.run((docname, index), sentences)
+    sessions = incremental.SESSIONS
+    make_repl = lambda: make_coqtop_repl(app)
+    if sessions.max_sessions <= 0:
+        with make_repl() as repl:
+            return [repl.sendone(sentence) for sentence in sentences]
+    key = (docname, tuple(app.config.coqtop_prelude), index)
+    try:
+        return sessions.get(key, make_repl).run(sentences)
+    except Exception:
+        sessions.discard(key)
+        raise
+
+def reset_deferred_coqtop(app, env, docnames): # pylint: disable=unused-argument
+    env.coq_deferred = {} # Docname → sentences of its coqtop blocks
+
+def merge_deferred_coqtop(app, env, docnames, other): # pylint: disable=unused-argument
+    env.coq_deferred.update(getattr(other, 'coq_deferred', {}))
+
+def run_deferred_coqtop(app, env):
+    """Run the sentences of all documents read with coqtop_deferred set, and
+    fill their doctrees.
+
+    Segments of all documents share coqtop_jobs threads (independently of
+    Sphinx's -j), longest first, so that a few large documents don't end up
+    running last."""
+    deferred = getattr(env, 'coq_deferred', {})
+    if not deferred:
+        return
+    if timing.RECORDER:
+        timing.RECORDER.start_document(None)
+    tasks = [(docname, index, segment) for docname, sentences in sorted(deferred.items())
+             for index, segment in enumerate(split_for_jobs(sentences, app.config.coqtop_jobs))]
+
+    def run_task(task, segment):
+        docname, index, _ = tasks[task]
+        return run_coqtop_segment(app, docname, index, segment)
+
+    segments = [segment for _, _, segment in tasks]
+    results = run_longest_first(segments, run_task, app.config.coqtop_jobs)
+    outputs = defaultdict(list)
+    for (docname, _, _), result in zip(tasks, results):
+        outputs[docname].extend(result)
+    for docname in sorted(deferred):
+        doctree = env.get_doctree(docname)
+        CoqtopBlocksTransform(doctree).apply_deferred(outputs[docname])
+        env.write_doctree(docname, doctree)
+    env.coq_deferred = {}
+    if timing.RECORDER:
+        env.coq_timings["(deferred coqtop)"] = timing.RECORDER.finish_document("")
+
+def init_coqtop_cache(app):
+    """Create the coqtop response cache, unless it's disabled (or owned by the broker)."""
+    if app.config.coqtop_cache_size > 0 and not app.config.coqtop_broker:
+        directory = os.path.join(app.doctreedir, 'coqtop-cache')
+        app.coqtop_cache = ResponseCache(directory, app.config.coqtop_cache_size)
+
+def warn_prelude_error(sentence, output):
+    logger.warning("Error in coqtop_prelude sentence {!r}:\n{}".format(sentence, output))
+
+def init_coqtop_pool(app):
+    """Create the pool of coqtop processes, unless it's disabled and there's no
+    prelude (or the pool is owned by the broker)."""
+    config = app.config
+    if (config.coqtop_pool_size > 0 or config.coqtop_prelude) and not config.coqtop_broker:
+        app.coqtop_pool = CoqTopPool(config.coqtop_pool_size, config.coqtop_prelude,
+                                     on_error=warn_prelude_error, color=True,
+                                     transport=config.coqtop_transport,
+                                     max_output=config.coqtop_max_output or None,
+                                     backend=config.coqtop_backend)
+
+def close_coqtop_pool(app, exception): # pylint: disable=unused-argument
+    pool = getattr(app, 'coqtop_pool', None)
+    if pool:
+        pool.close()
+
+def start_coqtop_broker(app):
+    """Start the coqtop broker, if coqtop_broker is set; forked readers inherit
+    the connection details."""
+    if app.config.coqtop_broker:
+        from .repl.broker import start_broker
+        from .repl.parallel import default_jobs
+        config = app.config
+        settings = {"max_sessions": config.coqtop_jobs or default_jobs(),
+                    "coqtop_args": {"color": True, "transport": config.coqtop_transport,
+                                    "max_output": config.coqtop_max_output or None,
+                                    "backend": config.coqtop_backend},
+                    "prelude": config.coqtop_prelude, "pool_size": config.coqtop_pool_size,
+                    "cache_directory": os.path.join(app.doctreedir, 'coqtop-cache'),
+                    "cache_size": config.coqtop_cache_size}
+        app.coqtop_broker = start_broker(settings)
+
+def stop_coqtop_broker(app, exception): # pylint: disable=unused-argument
+    broker = getattr(app, 'coqtop_broker', None)
+    if broker:
+        app.coqtop_broker = None
+        stats = broker.shutdown()
+        logger.info("coqtop broker: " + ", ".join("{} {}".format(v, k) for k, v in sorted(stats.items())))
+
+def init_incremental_sessions(app):
+    """Configure incremental sessions, and warn about their scope."""
+    incremental.SESSIONS.max_sessions = app.config.coqtop_incremental_sessions
+    if app.config.coqtop_incremental_sessions > 0 and not app.config.coqtop_broker:
+        logger.warning("coqtop_incremental_sessions only reuses sessions within one process: "
+                       "they are lost when sphinx-build exits, and each -j worker starts with "
+                       "none (coqtop_broker shares sessions between workers)")
+
+def init_timing(app):
+    """Start recording timings, if coq_timing_report is set."""
+    timing.RECORDER = timing.TimingRecorder() if app.config.coq_timing_report else None
+
+def reset_timings(app, env, docnames): # pylint: disable=unused-argument
+    env.coq_timings = {} # Only report documents read in this build
+
+def start_document_timing(app, docname, source): # pylint: disable=unused-argument
+    if timing.RECORDER:
+        timing.RECORDER.start_document(docname)
+
+def finish_document_timing(app, doctree): # pylint: disable=unused-argument
+    """Store the timings of the document that was just read in the environment
+    (which parallel builds send back to the main process)."""
+    recorder, env = timing.RECORDER, app.env
+    if recorder and recorder.docname == env.docname:
+        with open(env.doc2path(env.docname), encoding=app.config.source_encoding) as f:
+            source = f.read()
+        env.coq_timings[env.docname] = recorder.finish_document(source)
+
+def merge_timings(app, env, docnames, other): # pylint: disable=unused-argument
+    env.coq_timings.update(getattr(other, 'coq_timings', {}))
+
+def write_timing_report(app, exception):
+    """Write the JSON timing report, and log a summary."""
+    if timing.RECORDER and exception is None:
+        import json
+        report = timing.make_report(getattr(app.env, 'coq_timings', {}))
+        path = os.path.join(app.outdir, app.config.coq_timing_report)
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        logger.info("Coq timings (full report in {}):".format(path))
+        for line in timing.summarize(report):
+            logger.info("  " + line)
+
+def init_coqdoc_cache(app):
+    """Create the coqdoc highlight cache, unless it's disabled."""
+    if app.config.coqdoc_cache_size > 0:
+        from .coqdoc.cache import HighlightCache
+        path = os.path.join(app.doctreedir, 'coqdoc-cache.sqlite')
+        app.coqdoc_cache = HighlightCache(path, app.config.coqdoc_cache_size, on_error=logger.warning)
+    coqdoc.use_cache(getattr(app, 'coqdoc_cache', None))
+
+def prune_coqdoc_cache(app, exception):
+    """Report statistics about the coqdoc highlight cache, and shrink it."""
+    cache = getattr(app, 'coqdoc_cache', None)
+    if cache and exception is None:
+        if cache.hits or cache.misses:
+            logger.info("coqdoc cache: {} hits, {} misses".format(cache.hits, cache.misses))
+        cache.prune()
+
+def prune_coqtop_cache(app, exception):
+    """Report statistics about the coqtop response cache, and shrink it."""
+    cache = getattr(app, 'coqtop_cache', None)
+    if cache and exception is None:
+        if cache.hits or cache.misses:
+            logger.info("coqtop cache: {} hits, {} misses".format(cache.hits, cache.misses))
+        cache.prune()
+
 def setup(app):
     """Register the Coq domain"""
 
@@ -776,8 +1244,75 @@ def setup(app):
     app.add_directive("inference", InferenceDirective)
     app.add_directive("preamble", PreambleDirective)
     app.add_transform(CoqtopBlocksTransform)
+    app.add_post_transform(NotationHolesResolver)
+    app.connect('env-updated', reset_grammar_tokens)
     app.connect('doctree-resolved', simplify_source_code_blocks_for_latex)
 
+    # Highlight Coq code using coqdoc ('coqdoc') or a pure-Python lexer ('python')
+    app.add_config_value('coq_lexer', 'coqdoc', 'env')
+    # Cache up to this many snippets highlighted by coqdoc across documents,
+    # workers, and builds (set to 0 to disable)
+    app.add_config_value('coqdoc_cache_size', 100000, '')
+    app.connect('builder-inited', init_coqdoc_cache)
+    app.connect('build-finished', prune_coqdoc_cache)
+
+    # Cache coqtop's responses across builds (set to 0 to disable)
+    app.add_config_value('coqtop_cache_size', 64 * 1024 * 1024, '')
+    app.connect('builder-inited', init_coqtop_cache)
+    app.connect('build-finished', prune_coqtop_cache)
+
+    # Keep this many coqtop processes ready, primed with coqtop_prelude (with 0,
+    # each document starts its own process)
+    app.add_config_value('coqtop_pool_size', 0, '')
+    # Sentences to run at the start of each document, and after each reset
+    app.add_config_value('coqtop_prelude', [], 'env')
+    # How to connect to coqtop: "pty" (a pseudo-terminal) or "pipe" (faster
+    # for large outputs, and with no limit on the length of sentences)
+    app.add_config_value('coqtop_transport', 'pty', 'env')
+    # How to talk to coqtop: "repl" (scrape coqtop's prompts; $COQBIN) or "xml"
+    # (use CoqIDE's protocol, through $COQIDETOP; responses aren't colored)
+    app.add_config_value('coqtop_backend', 'repl', 'env')
+    # Keep at most this many characters of each coqtop response; the rest is
+    # dropped as it is read, and replaced by a note (set to 0 to keep everything)
+    app.add_config_value('coqtop_max_output', 1024 * 1024, 'env')
+    app.connect('builder-inited', init_coqtop_pool)
+
+    # Keep coqtop sessions alive across builds for up to this many documents,
+    # and only re-run sentences that changed.  Sessions live in the process
+    # that reads documents, so this only helps when Sphinx runs repeatedly in
+    # a long-running process, without -j; within a build, coqtop_broker reuses
+    # sessions across documents and workers instead (and ignores this setting)
+    app.add_config_value('coqtop_incremental_sessions', 0, '')
+    app.connect('builder-inited', init_incremental_sessions)
+
+    # How many coqtop processes to run concurrently in each document (one per
+    # reset-delimited segment), or in the whole build with coqtop_deferred;
+    # 1 runs each document on a single process, and 0 means one per CPU
+    app.add_config_value('coqtop_jobs', 1, '')
+    # Run coqtop once all documents have been read, instead of while reading
+    # each one: this balances the load across documents, independently of -j
+    app.add_config_value('coqtop_deferred', False, '')
+    app.connect('env-before-read-docs', reset_deferred_coqtop)
+    app.connect('env-merge-info', merge_deferred_coqtop)
+    app.connect('env-updated', run_deferred_coqtop)
+    # Run coqtop in a separate broker process, shared by all of Sphinx's
+    # workers: it runs at most coqtop_jobs coqtop sessions, reuses them across
+    # documents, and runs identical segments once
+    app.add_config_value('coqtop_broker', False, '')
+    app.connect('builder-inited', start_coqtop_broker)
+    app.connect('build-finished', stop_coqtop_broker)
+    app.connect('build-finished', close_coqtop_pool)
+
+    # Time coqtop, highlighting, notations, and ANSI parsing in each document,
+    # and write a JSON report to this file (relative to the output directory)
+    app.add_config_value('coq_timing_report', '', '')
+    app.connect('builder-inited', init_timing)
+    app.connect('env-before-read-docs', reset_timings)
+    app.connect('source-read', start_document_timing)
+    app.connect('doctree-read', finish_document_timing)
+    app.connect('env-merge-info', merge_timings)
+    app.connect('build-finished', write_timing_report)
+
     # Add extra styles
     app.add_stylesheet("hint.min.css")
     app.add_stylesheet("ansi.css")
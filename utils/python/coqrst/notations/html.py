@@ -1,4 +1,4 @@
-"""A visitor for ANDTLR notation ASTs, producing raw HTML.
+"""A visitor for notation ASTs, producing raw HTML.
 
 Uses the dominate package.
 """
@@ -6,34 +6,31 @@ Uses the dominate package.
 from dominate import tags
 
 from .parsing import parse
-from .TacticNotationsParser import TacticNotationsParser
-from .TacticNotationsVisitor import TacticNotationsVisitor
+from .ir import NotationVisitor
 
-class TacticNotationsToHTMLVisitor(TacticNotationsVisitor):
-    def visitRepeat(self, ctx:TacticNotationsParser.RepeatContext):
+class TacticNotationsToHTMLVisitor(NotationVisitor):
+    def visitRepeat(self, node):
         with tags.span(_class="repeat-wrapper"):
             with tags.span(_class="repeat"):
-                self.visitChildren(ctx)
-            repeat_marker = ctx.LGROUP().getText()[1]
-            separator = ctx.ATOM()
-            tags.sup(repeat_marker)
-            if separator:
-                tags.sub(separator.getText())
-
-    def visitCurlies(self, ctx:TacticNotationsParser.CurliesContext):
+                self.visitChildren(node)
+            tags.sup(node.marker)
+            if node.separator:
+                tags.sub(node.separator)
+
+    def visitCurlies(self, node):
         sp = tags.span(_class="curlies")
         sp.add("{")
         with sp:
-            self.visitChildren(ctx)
+            self.visitChildren(node)
         sp.add("}")
 
-    def visitAtomic(self, ctx:TacticNotationsParser.AtomicContext):
-        tags.span(ctx.ATOM().getText())
+    def visitAtomic(self, node):
+        tags.span(node.text)
 
-    def visitHole(self, ctx:TacticNotationsParser.HoleContext):
-        tags.span(ctx.ID().getText()[1:], _class="hole")
+    def visitHole(self, node):
+        tags.span(node.name, _class="hole")
 
-    def visitWhitespace(self, ctx:TacticNotationsParser.WhitespaceContext):
+    def visitWhitespace(self, node):
         tags.span(" ")          # TODO: no need for a <span> here
 
 def htmlize(notation):
@@ -0,0 +1,121 @@
+"""A compact, immutable representation of parsed notations.
+
+Parse trees (from rdparser or ANTLR) carry a lot of structure that is useless
+once parsing is done; this module defines the five kinds of nodes that matter
+(repeat, curlies, atomic, hole, and whitespace) as named tuples, which are
+small, immutable, and picklable.  A notation is a tuple of such nodes.
+
+Use `from_parse_tree` to convert a parse tree, and subclass `NotationVisitor`
+to process the result.
+"""
+
+import sys
+from collections import namedtuple
+
+class Node:
+    """Mixin for IR nodes: dispatch to the visitor method named visitor_method."""
+    __slots__ = ()
+    visitor_method = None
+
+    def accept(self, visitor):
+        return getattr(visitor, self.visitor_method)(self)
+
+class Repeat(namedtuple("Repeat", "marker separator children"), Node):
+    """A repeated group ‘{+ …}’, ‘{* …}’ or ‘{? …}’; separator may be None."""
+    __slots__ = ()
+    visitor_method = "visitRepeat"
+
+class Curlies(namedtuple("Curlies", "children"), Node):
+    """A pair of literal braces."""
+    __slots__ = ()
+    visitor_method = "visitCurlies"
+
+class Atomic(namedtuple("Atomic", "text"), Node):
+    """A piece of literal text."""
+    __slots__ = ()
+    visitor_method = "visitAtomic"
+
+class Hole(namedtuple("Hole", "name"), Node):
+    """A placeholder ‘@name’ (name doesn't include the ‘@’)."""
+    __slots__ = ()
+    visitor_method = "visitHole"
+
+class Whitespace(namedtuple("Whitespace", ""), Node):
+    """Significant whitespace (use the WHITESPACE singleton)."""
+    __slots__ = ()
+    visitor_method = "visitWhitespace"
+
+WHITESPACE = Whitespace()
+
+class NotationVisitor:
+    """Base class for visitors of notations.
+
+    Mirrors the interface of ANTLR's visitors: by default, each visit method
+    visits the node's children and combines the results using
+    `aggregateResult`, starting from `defaultResult`.
+    """
+
+    def defaultResult(self):
+        return None
+
+    def aggregateResult(self, aggregate, nextResult): # pylint: disable=unused-argument
+        return nextResult
+
+    def visit(self, tree):
+        """Visit tree, a node or a tuple of nodes."""
+        if isinstance(tree, Node):
+            return tree.accept(self)
+        return self.visitSequence(tree)
+
+    def visitSequence(self, nodes):
+        result = self.defaultResult()
+        for node in nodes:
+            result = self.aggregateResult(result, node.accept(self))
+        return result
+
+    def visitChildren(self, node):
+        return self.visitSequence(node.children)
+
+    def visitRepeat(self, node):
+        return self.visitChildren(node)
+
+    def visitCurlies(self, node):
+        return self.visitChildren(node)
+
+    def visitAtomic(self, node): # pylint: disable=unused-argument
+        return self.defaultResult()
+
+    def visitHole(self, node): # pylint: disable=unused-argument
+        return self.defaultResult()
+
+    def visitWhitespace(self, node): # pylint: disable=unused-argument
+        return self.defaultResult()
+
+def _convert_children(ctx):
+    nodes = ()
+    for idx in range(ctx.getChildCount()):
+        nodes += _convert(ctx.getChild(idx))
+    return nodes
+
+def _convert(ctx):
+    kind = type(ctx).__name__
+    if kind == "RepeatContext":
+        separator = ctx.ATOM()
+        return (Repeat(ctx.LGROUP().getText()[1],
+                       separator and sys.intern(separator.getText()),
+                       _convert_children(ctx)),)
+    elif kind == "CurliesContext":
+        return (Curlies(_convert_children(ctx)),)
+    elif kind == "AtomicContext":
+        return (Atomic(sys.intern(ctx.ATOM().getText())),)
+    elif kind == "HoleContext":
+        return (Hole(sys.intern(ctx.ID().getText()[1:])),)
+    elif kind == "WhitespaceContext":
+        return (WHITESPACE,)
+    elif kind in ("TopContext", "BlocksContext", "BlockContext"):
+        return _convert_children(ctx)
+    return () # Terminals (WHITESPACE tokens in repeats, braces, EOF, etc.)
+
+def from_parse_tree(tree):
+    """Convert a parse tree (from rdparser or from ANTLR) into a tuple of nodes."""
+    return _convert(tree)
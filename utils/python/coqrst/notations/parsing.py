@@ -1,7 +1,10 @@
-from .TacticNotationsLexer import TacticNotationsLexer
-from .TacticNotationsParser import TacticNotationsParser
+from functools import lru_cache
 
-from antlr4 import CommonTokenStream, InputStream
+from . import ir, rdparser
+from .rdparser import NotationSyntaxError
+
+# Maximum number of parsed notations to keep in memory
+PARSE_CACHE_SIZE = 4096
 
 SUBSTITUTIONS = [("@bindings_list", "{+ (@id := @val) }"),
                  ("@qualid_or_string", "@id|@string")]
@@ -17,12 +20,84 @@ def substitute(notation):
         notation = notation.replace(src, dst)
     return notation
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_substituted(substituted):
+    return ir.from_parse_tree(rdparser.parse(substituted))
+
 def parse(notation):
     """Parse a notation string.
 
-    :return: An ANTLR AST. Use one of the supplied visitors (or write your own)
-             to turn it into useful output.
+    Results are cached, keyed by the substituted notation, so the same tree
+    may be returned multiple times (it's immutable, and visitors build fresh
+    output nodes from it).
+
+    :return: A tuple of `ir` nodes. Use one of the supplied visitors (or write
+             your own `ir.NotationVisitor`) to turn it into useful output.
+    :raises rdparser.NotationSyntaxError: if notation is malformed.
+    """
+    return _parse_substituted(substitute(notation))
+
+def parse_cache_info():
+    """Return statistics about `parse`'s cache, as a (hits, misses, hit_rate) tuple."""
+    info = _parse_substituted.cache_info()
+    total = info.hits + info.misses
+    return info.hits, info.misses, (info.hits / total if total else 0.0)
+
+class _RaisingErrorListener:
+    """An ANTLR error listener that turns the first error into an exception."""
+    # pylint: disable=invalid-name, unused-argument
+
+    def __init__(self, notation):
+        self.notation = notation
+
+    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+        raise NotationSyntaxError(msg, self.notation, column)
+
+    def reportAmbiguity(self, *args):
+        pass
+
+    def reportAttemptingFullContext(self, *args):
+        pass
+
+    def reportContextSensitivity(self, *args):
+        pass
+
+def _antlr_parser(notation, prediction_mode, error_strategy):
+    """Create an ANTLR parser for notation that raises on the first syntax error."""
+    from antlr4 import CommonTokenStream, InputStream
+    from .TacticNotationsLexer import TacticNotationsLexer
+    from .TacticNotationsParser import TacticNotationsParser
+
+    listener = _RaisingErrorListener(notation)
+    lexer = TacticNotationsLexer(InputStream(notation))
+    lexer.removeErrorListeners()
+    lexer.addErrorListener(listener)
+    parser = TacticNotationsParser(CommonTokenStream(lexer))
+    parser.removeErrorListeners()
+    parser.addErrorListener(listener)
+    parser._interp.predictionMode = prediction_mode
+    parser._errHandler = error_strategy
+    return parser
+
+def parse_with_antlr(notation, two_stage=True):
+    """Parse notation using the ANTLR-generated parser, returning an ANTLR tree.
+
+    Use `ir.from_parse_tree` to convert the result to the format of `parse`.
+
+    When two_stage is set, try fast SLL prediction first, bailing out on the
+    first error, and only fall back to full LL prediction if that fails.
+    Mostly useful for testing: the ANTLR runtime is slow to load and use.
+
+    :raises NotationSyntaxError: if notation is malformed.
     """
+    from antlr4.atn.PredictionMode import PredictionMode
+    from antlr4.error.ErrorStrategy import BailErrorStrategy, DefaultErrorStrategy
+    from antlr4.error.Errors import ParseCancellationException
+
     substituted = substitute(notation)
-    lexer = TacticNotationsLexer(InputStream(substituted))
-    return TacticNotationsParser(CommonTokenStream(lexer)).top()
+    if two_stage:
+        try:
+            return _antlr_parser(substituted, PredictionMode.SLL, BailErrorStrategy()).top()
+        except (ParseCancellationException, NotationSyntaxError):
+            pass # SLL may fail on valid input; let LL decide
+    return _antlr_parser(substituted, PredictionMode.LL, DefaultErrorStrategy()).top()
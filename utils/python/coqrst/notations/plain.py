@@ -1,4 +1,4 @@
-"""A visitor for ANDTLR notation ASTs, producing plain text with ellipses.
+"""A visitor for notation ASTs, producing plain text with ellipses.
 
 Somewhat-closely approximates the rendering of the original manual.
 """
@@ -6,33 +6,31 @@ Somewhat-closely approximates the rendering of the original manual.
 from io import StringIO
 
 from .parsing import parse
-from .TacticNotationsParser import TacticNotationsParser
-from .TacticNotationsVisitor import TacticNotationsVisitor
+from .ir import NotationVisitor
 
-class TacticNotationsToDotsVisitor(TacticNotationsVisitor):
+class TacticNotationsToDotsVisitor(NotationVisitor):
     def __init__(self):
         self.buffer = StringIO()
 
-    def visitRepeat(self, ctx:TacticNotationsParser.RepeatContext):
-        separator = ctx.ATOM()
-        self.visitChildren(ctx)
-        if ctx.LGROUP().getText()[1] == "+":
-            spacer = (separator.getText() + " " if separator else "")
+    def visitRepeat(self, node):
+        self.visitChildren(node)
+        if node.marker == "+":
+            spacer = (node.separator + " " if node.separator else "")
             self.buffer.write(spacer + "…" + spacer)
-            self.visitChildren(ctx)
+            self.visitChildren(node)
 
-    def visitCurlies(self, ctx:TacticNotationsParser.CurliesContext):
+    def visitCurlies(self, node):
         self.buffer.write("{")
-        self.visitChildren(ctx)
+        self.visitChildren(node)
         self.buffer.write("}")
 
-    def visitAtomic(self, ctx:TacticNotationsParser.AtomicContext):
-        self.buffer.write(ctx.ATOM().getText())
+    def visitAtomic(self, node):
+        self.buffer.write(node.text)
 
-    def visitHole(self, ctx:TacticNotationsParser.HoleContext):
-        self.buffer.write("‘{}’".format(ctx.ID().getText()[1:]))
+    def visitHole(self, node):
+        self.buffer.write("‘{}’".format(node.name))
 
-    def visitWhitespace(self, ctx:TacticNotationsParser.WhitespaceContext):
+    def visitWhitespace(self, node):
         self.buffer.write(" ")
 
 def stringify_with_ellipses(notation):
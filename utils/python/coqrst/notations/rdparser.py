@@ -0,0 +1,256 @@
+"""A hand-written recursive-descent parser for the notation grammar.
+
+Implements the grammar in TacticNotations.g without depending on the ANTLR
+runtime.  The resulting trees mimic those produced by TacticNotationsParser
+(same node names and accessors), so existing visitors work unchanged.
+
+Run this module with a file of notations (one per line) to check that it agrees
+with the ANTLR parser on each of them, and to compare the speed of both parsers.
+"""
+
+import re
+
+LGROUP, LBRACE, RBRACE, ATOM, ID, WHITESPACE, EOF = \
+    "LGROUP", "LBRACE", "RBRACE", "ATOM", "ID", "WHITESPACE", "EOF"
+
+TOKEN_RE = re.compile(r"""
+    (?P<LGROUP>\{[+*?])
+  | (?P<LBRACE>\{)
+  | (?P<RBRACE>\})
+  | (?P<ATOM>[^@{} ]+)
+  | (?P<ID>@[a-zA-Z0-9_]+)
+  | (?P<WHITESPACE>\ +)
+""", re.VERBOSE)
+
+BLOCK_START = (ATOM, ID, LGROUP, LBRACE)
+
+class NotationSyntaxError(ValueError):
+    """A syntax error in a notation; column is a 0-based offset into notation."""
+
+    def __init__(self, msg, notation, column):
+        super().__init__("column {}: {}".format(column, msg))
+        self.msg, self.notation, self.column = msg, notation, column
+
+class Terminal:
+    """A token; the counterpart of ANTLR's TerminalNode."""
+
+    def __init__(self, kind, text, column):
+        self.kind, self.text, self.column = kind, text, column
+
+    def getText(self):
+        return self.text
+
+    def getChildCount(self):
+        return 0
+
+    def accept(self, visitor):
+        return visitor.visitTerminal(self)
+
+class Context:
+    """A node of the parse tree; the counterpart of ANTLR's ParserRuleContext.
+
+    Trees are shared by `parsing.parse`'s cache, so children are stored in a
+    tuple.
+    """
+
+    visitor_method = None
+
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def getChildren(self):
+        return iter(self.children)
+
+    def getChildCount(self):
+        return len(self.children)
+
+    def getChild(self, i):
+        return self.children[i]
+
+    def getText(self):
+        return "".join(child.getText() for child in self.children if child.getText() != "<EOF>")
+
+    def getToken(self, kind):
+        for child in self.children:
+            if isinstance(child, Terminal) and child.kind == kind:
+                return child
+        return None
+
+    def accept(self, visitor):
+        return getattr(visitor, self.visitor_method)(self)
+
+class TopContext(Context):
+    visitor_method = "visitTop"
+
+class BlocksContext(Context):
+    visitor_method = "visitBlocks"
+
+class BlockContext(Context):
+    visitor_method = "visitBlock"
+
+class RepeatContext(Context):
+    visitor_method = "visitRepeat"
+
+    def LGROUP(self):
+        return self.getToken(LGROUP)
+
+    def ATOM(self):
+        return self.getToken(ATOM)
+
+class CurliesContext(Context):
+    visitor_method = "visitCurlies"
+
+class WhitespaceContext(Context):
+    visitor_method = "visitWhitespace"
+
+class AtomicContext(Context):
+    visitor_method = "visitAtomic"
+
+    def ATOM(self):
+        return self.getToken(ATOM)
+
+class HoleContext(Context):
+    visitor_method = "visitHole"
+
+    def ID(self):
+        return self.getToken(ID)
+
+def tokenize(notation):
+    """Split notation into a list of Terminals, ending with EOF."""
+    tokens, pos = [], 0
+    while pos < len(notation):
+        match = TOKEN_RE.match(notation, pos)
+        if not match:
+            raise NotationSyntaxError("unexpected character {!r}".format(notation[pos]), notation, pos)
+        tokens.append(Terminal(match.lastgroup, match.group(), pos))
+        pos = match.end()
+    tokens.append(Terminal(EOF, "<EOF>", pos))
+    return tokens
+
+class Parser:
+    """Parse a single notation; use `parse` instead of instantiating this."""
+
+    def __init__(self, notation):
+        self.notation = notation
+        self.tokens = tokenize(notation)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)].kind
+
+    def expect(self, kind):
+        token = self.tokens[self.pos]
+        if token.kind != kind:
+            raise NotationSyntaxError("expected {}, got {!r}".format(kind, token.text),
+                                      self.notation, token.column)
+        self.pos += 1
+        return token
+
+    def top(self):
+        return TopContext([self.blocks(), self.expect(EOF)])
+
+    def blocks(self):
+        children = [self.block()]
+        while True:
+            if self.peek() == WHITESPACE and self.peek(1) in BLOCK_START:
+                children.append(self.whitespace())
+            elif self.peek() not in BLOCK_START:
+                return BlocksContext(children)
+            children.append(self.block())
+
+    def block(self):
+        kind = self.peek()
+        if kind == ATOM:
+            child = AtomicContext([self.expect(ATOM)])
+        elif kind == ID:
+            child = HoleContext([self.expect(ID)])
+        elif kind == LGROUP:
+            child = self.repeat()
+        elif kind == LBRACE:
+            child = self.curlies()
+        else:
+            token = self.tokens[self.pos]
+            raise NotationSyntaxError("expected a block, got {!r}".format(token.text),
+                                      self.notation, token.column)
+        return BlockContext([child])
+
+    def repeat(self):
+        children = [self.expect(LGROUP)]
+        if self.peek() == ATOM:
+            children.append(self.expect(ATOM))
+        children.append(self.expect(WHITESPACE))
+        children.append(self.blocks())
+        if self.peek() == WHITESPACE:
+            children.append(self.expect(WHITESPACE))
+        children.append(self.expect(RBRACE))
+        return RepeatContext(children)
+
+    def curlies(self):
+        children = [self.expect(LBRACE)]
+        if self.peek() == WHITESPACE:
+            children.append(self.whitespace())
+        children.append(self.blocks())
+        if self.peek() == WHITESPACE:
+            children.append(self.whitespace())
+        children.append(self.expect(RBRACE))
+        return CurliesContext(children)
+
+    def whitespace(self):
+        return WhitespaceContext([self.expect(WHITESPACE)])
+
+def parse(notation):
+    """Parse notation into a tree of Contexts; raise NotationSyntaxError on errors."""
+    return Parser(notation).top()
+
+def sexp(tree):
+    """Convert an ANTLR tree or a tree of Contexts into nested tuples."""
+    if tree.getChildCount() == 0 and not hasattr(tree, "children"):
+        return tree.getText()
+    name = type(tree).__name__
+    return (name,) + tuple(sexp(tree.getChild(i)) for i in range(tree.getChildCount()))
+
+def main():
+    """Check conformance with the ANTLR parser, and compare performance."""
+    import sys
+    import timeit
+    import subprocess
+    from . import rdparser # Not __main__, whose NotationSyntaxError is a different class
+    from .parsing import substitute, parse_with_antlr
+
+    with open(sys.argv[1], encoding="utf-8") as f:
+        notations = [substitute(line.rstrip("\n")) for line in f if line.strip()]
+
+    valid, mismatches, rejected = [], 0, 0
+    for notation in notations:
+        try:
+            antlr_tree = sexp(parse_with_antlr(notation))
+        except rdparser.NotationSyntaxError as err:
+            antlr_tree = err
+        try:
+            ours = sexp(rdparser.parse(notation))
+            valid.append(notation)
+        except rdparser.NotationSyntaxError as err:
+            if isinstance(antlr_tree, rdparser.NotationSyntaxError):
+                rejected += 1
+                continue
+            ours = err
+        if ours != antlr_tree:
+            mismatches += 1
+            print("Mismatch on {!r}: {} vs {}".format(notation, ours, antlr_tree))
+    print("{} notations: {} mismatches, {} rejected by both parsers".format(
+        len(notations), mismatches, rejected))
+
+    parsers = (("antlr (LL)", lambda n: parse_with_antlr(n, two_stage=False)),
+               ("antlr (SLL, then LL)", parse_with_antlr),
+               ("recursive descent", rdparser.parse))
+    for name, fn in parsers:
+        duration = min(timeit.repeat(lambda: [fn(n) for n in valid], number=1, repeat=3))
+        print("{}: {:.0f} notations/s".format(name, len(valid) / duration))
+
+    for module in ("coqrst.notations.TacticNotationsParser", "coqrst.notations.rdparser"):
+        cmd = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)"
+        output = subprocess.check_output([sys.executable, "-c", cmd.format(module)])
+        print("import {}: {:.1f}ms".format(module, float(output) * 1000))
+
+if __name__ == '__main__':
+    main()
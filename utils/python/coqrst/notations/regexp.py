@@ -1,44 +1,42 @@
-"""An experimental visitor for ANDTLR notation ASTs, producing regular expressions."""
+"""An experimental visitor for notation ASTs, producing regular expressions."""
 
 import re
 from io import StringIO
 
 from .parsing import parse
-from .TacticNotationsParser import TacticNotationsParser
-from .TacticNotationsVisitor import TacticNotationsVisitor
+from .ir import NotationVisitor
 
-class TacticNotationsToRegexpVisitor(TacticNotationsVisitor):
+class TacticNotationsToRegexpVisitor(NotationVisitor):
     def __init__(self):
         self.buffer = StringIO()
 
-    def visitRepeat(self, ctx:TacticNotationsParser.RepeatContext):
-        separator = ctx.ATOM()
-        repeat_marker = ctx.LGROUP().getText()[1]
+    def visitRepeat(self, node):
+        repeat_marker = node.marker
 
         self.buffer.write("(")
-        self.visitChildren(ctx)
+        self.visitChildren(node)
         self.buffer.write(")")
 
         if repeat_marker in ["?", "*"]:
             self.buffer.write("?")
         elif repeat_marker in ["+", "*"]:
             self.buffer.write("(")
-            self.buffer.write(r"\s*" + re.escape(separator.getText() if separator else " ") + r"\s*")
-            self.visitChildren(ctx)
+            self.buffer.write(r"\s*" + re.escape(node.separator or " ") + r"\s*")
+            self.visitChildren(node)
             self.buffer.write(")*")
 
-    def visitCurlies(self, ctx:TacticNotationsParser.CurliesContext):
+    def visitCurlies(self, node):
         self.buffer.write(r"\{")
-        self.visitChildren(ctx)
+        self.visitChildren(node)
         self.buffer.write(r"\}")
 
-    def visitAtomic(self, ctx:TacticNotationsParser.AtomicContext):
-        self.buffer.write(re.escape(ctx.ATOM().getText()))
+    def visitAtomic(self, node):
+        self.buffer.write(re.escape(node.text))
 
-    def visitHole(self, ctx:TacticNotationsParser.HoleContext):
+    def visitHole(self, node):
         self.buffer.write("([^();. \n]+)") # FIXME could allow more things
 
-    def visitWhitespace(self, ctx:TacticNotationsParser.WhitespaceContext):
+    def visitWhitespace(self, node):
         self.buffer.write(r"\s+")
 
 def regexpify(notation):
@@ -1,17 +1,15 @@
-"""A visitor for ANDTLR notation ASTs, producing Sphinx nodes.
+"""A visitor for notation ASTs, producing Sphinx nodes.
 
 Unlike the HTML visitor, this produces Sphinx-friendly nodes that can be used by
 all backends. If you just want HTML output, use the HTML visitor.
 """
 
 from .parsing import parse
-from .TacticNotationsParser import TacticNotationsParser
-from .TacticNotationsVisitor import TacticNotationsVisitor
+from .ir import NotationVisitor
 
 from docutils import nodes
-from sphinx import addnodes
 
-class TacticNotationsToSphinxVisitor(TacticNotationsVisitor):
+class TacticNotationsToSphinxVisitor(NotationVisitor):
     def defaultResult(self):
         return []
 
@@ -20,40 +18,40 @@ class TacticNotationsToSphinxVisitor(TacticNotationsVisitor):
             aggregate.extend(nextResult)
         return aggregate
 
-    def visitRepeat(self, ctx:TacticNotationsParser.RepeatContext):
+    def visitRepeat(self, node):
         # Uses inline nodes instead of subscript and superscript to ensure that
         # we get the right customization hooks at the LaTeX level
         wrapper = nodes.inline('', '', classes=['repeat-wrapper'])
-        wrapper += nodes.inline('', '', *self.visitChildren(ctx), classes=["repeat"])
+        wrapper += nodes.inline('', '', *self.visitChildren(node), classes=["repeat"])
 
-        repeat_marker = ctx.LGROUP().getText()[1]
+        repeat_marker = node.marker
         wrapper += nodes.inline(repeat_marker, repeat_marker, classes=['notation-sup'])
 
-        separator = ctx.ATOM()
-        if separator:
-            sep = separator.getText()
+        sep = node.separator
+        if sep:
             wrapper += nodes.inline(sep, sep, classes=['notation-sub'])
 
         return [wrapper]
 
-    def visitCurlies(self, ctx:TacticNotationsParser.CurliesContext):
+    def visitCurlies(self, node):
         sp = nodes.inline('', '', classes=["curlies"])
         sp += nodes.Text("{")
-        sp.extend(self.visitChildren(ctx))
+        sp.extend(self.visitChildren(node))
         sp += nodes.Text("}")
         return [sp]
 
-    def visitAtomic(self, ctx:TacticNotationsParser.AtomicContext):
-        atom = ctx.ATOM().getText()
+    def visitAtomic(self, node):
+        atom = node.text
         return [nodes.inline(atom, atom)]
 
-    def visitHole(self, ctx:TacticNotationsParser.HoleContext):
-        hole = ctx.ID().getText()
-        token_name = hole[1:]
-        node = nodes.inline(hole, token_name, classes=["hole"])
-        return [addnodes.pending_xref(token_name, node, reftype='token', refdomain='std', reftarget=token_name)]
+    def visitHole(self, node):
+        # Holes are linked to grammar productions after reading, all at once
+        # (see `coqrst.coqdomain.NotationHolesResolver`)
+        token_name = node.name
+        hole = "@" + token_name
+        return [nodes.inline(hole, token_name, classes=["hole"])]
 
-    def visitWhitespace(self, ctx:TacticNotationsParser.WhitespaceContext):
+    def visitWhitespace(self, node):
         return [nodes.Text(" ")]
 
 def sphinxify(notation):
@@ -0,0 +1,280 @@
+"""
+Share coqtop processes between parallel Sphinx workers.
+=======================================================
+
+With ``-j``, each of Sphinx's reader processes starts its own coqtop
+processes, and nothing bounds their total number.  A `Broker` runs in a
+separate process, owns a bounded set of coqtop sessions, and runs batches of
+sentences (segments of documents, see `coqrst.repl.parallel`) sent by workers
+over a Unix socket, using `BrokerClient`.
+
+The broker reuses sessions across requests: a segment goes to the session that
+last ran the same key (its document and index) if it's idle, else to the idle
+session that shares the longest prefix of sentences with it (typically setup
+sentences), else to a new session while there are fewer than max_sessions,
+else to the least recently used idle session.  Sessions are
+`IncrementalSession`\\ s, so only the sentences past the shared prefix run.
+Identical segments that are requested while one of them is running only run
+once.
+
+Requests and responses are JSON objects, one per line.  `start_broker` spawns
+a broker by running this module.
+"""
+
+import os
+import sys
+import json
+import socket
+import threading
+from collections import OrderedDict
+
+from .coqtop import CoqTop
+from .cache import ResponseCache, CachedCoqTop
+from .pool import CoqTopPool, PooledCoqTop
+from .incremental import IncrementalSession
+
+class BrokerError(Exception):
+    """Raised by `BrokerClient` when the broker fails to run a request."""
+
+def shared_prefix(session, sentences):
+    count = 0
+    for (old, _), new in zip(session.history, sentences):
+        if old != new:
+            break
+        count += 1
+    return count
+
+def report_prelude_error(sentence, output):
+    sys.stderr.write("coqtop broker: error in prelude sentence {!r}:\n{}\n".format(sentence, output))
+
+class InFlight:
+    """A segment that is running, which identical requests wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.outputs, self.error = None, None
+
+class Broker:
+    """Run segments on a bounded set of coqtop sessions; see the module's documentation."""
+
+    def __init__(self, max_sessions, coqtop_args, prelude=(), pool_size=0,
+                 cache_directory=None, cache_size=0):
+        """Configure a broker (coqtop processes are started on demand).
+
+        :param max_sessions: The maximum number of coqtop sessions, and thus of
+                             segments running at the same time
+        :param coqtop_args:  Arguments passed to CoqTop for each process
+        :param prelude, pool_size: See `CoqTopPool`
+        :param cache_directory, cache_size: See `ResponseCache`
+        """
+        self.max_sessions, self.coqtop_args = max_sessions, coqtop_args
+        self.pool = (CoqTopPool(pool_size, prelude, on_error=report_prelude_error, **coqtop_args)
+                     if pool_size > 0 or prelude else None)
+        self.cache = ResponseCache(cache_directory, cache_size) if cache_directory and cache_size > 0 else None
+        self.lock = threading.Condition()
+        self.idle = OrderedDict() # Key → IncrementalSession, least recently used first
+        self.busy = 0 # Number of sessions running a segment
+        self.in_flight = {} # Tuple of sentences → InFlight
+        self.stats = {"segments": 0, "deduplicated": 0, "sessions": 0, "reused": 0}
+
+    def make_repl(self):
+        coqtop = PooledCoqTop(self.pool) if self.pool else CoqTop(**self.coqtop_args)
+        return CachedCoqTop(coqtop, self.cache) if self.cache else coqtop
+
+    def _checkout(self, key, sentences):
+        """Pick a session for sentences, or return None if a new one should be
+        created; wait while all sessions are busy."""
+        with self.lock:
+            while True:
+                session = self.idle.pop(key, None)
+                if session is None and self.idle:
+                    best = max(self.idle, key=lambda k: shared_prefix(self.idle[k], sentences))
+                    if (shared_prefix(self.idle[best], sentences) > 0 or
+                            self.busy + len(self.idle) >= self.max_sessions):
+                        session = self.idle.pop(best)
+                if session is not None or self.busy + len(self.idle) < self.max_sessions:
+                    self.busy += 1
+                    self.stats["reused" if session else "sessions"] += 1
+                    return session
+                self.lock.wait()
+
+    def _checkin(self, key, session):
+        """Make session idle again (under key), or forget it if it's None."""
+        with self.lock:
+            self.busy -= 1
+            if session is not None:
+                self.idle[key] = session
+            self.lock.notify()
+
+    def _run(self, key, sentences):
+        session = self._checkout(key, sentences)
+        try:
+            session = session or IncrementalSession(self.make_repl())
+            outputs = session.run(sentences)
+        except:
+            if session is not None:
+                session.close()
+            self._checkin(key, None)
+            raise
+        self._checkin(key, session)
+        return outputs
+
+    def run(self, key, sentences):
+        """Run sentences as if in a fresh coqtop session, and return the list
+        of coqtop's responses.  Thread-safe.
+
+        :param key: Identifies the segment, to send it to the same session as
+                    in previous runs.
+        """
+        signature = tuple(sentences)
+        with self.lock:
+            self.stats["segments"] += 1
+            flight = self.in_flight.get(signature)
+            owner = flight is None
+            if owner:
+                flight = self.in_flight[signature] = InFlight()
+            else:
+                self.stats["deduplicated"] += 1
+        if not owner:
+            flight.done.wait()
+            if flight.error:
+                raise BrokerError(flight.error)
+            return flight.outputs
+        try:
+            flight.outputs = self._run(tuple(key), sentences)
+            return flight.outputs
+        except Exception as e:
+            flight.error = "{}: {}".format(type(e).__name__, e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[signature]
+            flight.done.set()
+
+    def close(self):
+        """Stop all coqtop processes, prune the cache, and return statistics."""
+        with self.lock:
+            sessions, self.idle = list(self.idle.values()), OrderedDict()
+        for session in sessions:
+            session.close()
+        if self.pool:
+            self.pool.close()
+        stats = dict(self.stats)
+        if self.cache:
+            stats.update(cache_hits=self.cache.hits, cache_misses=self.cache.misses)
+            self.cache.prune()
+        return stats
+
+def serve(broker, path):
+    """Answer requests sent to Unix socket path by `BrokerClient`, until one
+    of them asks to shut down, or until stdin is closed (e.g. because the
+    process that started the broker died)."""
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                request = json.loads(line.decode("utf-8"))
+                if "run" in request:
+                    try:
+                        response = {"outputs": broker.run(*request["run"])}
+                    except Exception as e: # pylint: disable=broad-except
+                        response = {"error": "{}: {}".format(type(e).__name__, e)}
+                elif "shutdown" in request:
+                    response = {"stats": broker.close()}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    response = {"error": "Unknown request: {!r}".format(request)}
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    def watch_parent(server):
+        sys.stdin.buffer.read()
+        broker.close()
+        server.shutdown()
+
+    with Server(path, Handler) as server:
+        threading.Thread(target=watch_parent, args=(server,), daemon=True).start()
+        sys.stdout.write("ready\n")
+        sys.stdout.flush()
+        server.serve_forever()
+
+class BrokerClient:
+    """A connection to a broker, usable from any thread or forked process."""
+
+    def __init__(self, path, process=None):
+        """Talk to the broker listening on path, which runs as process (a
+        Popen object, if this process started it)."""
+        self.path, self.process = path, process
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise BrokerError("The coqtop broker closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise BrokerError(response["error"])
+        return response
+
+    def run(self, key, sentences):
+        """Run sentences; see `Broker.run`."""
+        return self._request({"run": [list(key), list(sentences)]})["outputs"]
+
+    def shutdown(self):
+        """Stop the broker, and return its statistics."""
+        stats = self._request({"shutdown": True})["stats"]
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+        return stats
+
+def remove_socket(path):
+    """Remove socket path, and the temporary directory that contains it."""
+    for remove, target in ((os.remove, path), (os.rmdir, os.path.dirname(path))):
+        try:
+            remove(target)
+        except FileNotFoundError:
+            pass
+
+def start_broker(settings):
+    """Spawn a broker, and return a `BrokerClient` connected to it.
+
+    The socket lives in a fresh temporary directory, since the paths of Unix
+    sockets are limited to about 100 bytes.  The broker exits when its stdin,
+    a pipe from this process (and processes forked from it), is closed.
+
+    :param settings: A dict of keyword arguments for `Broker`
+    """
+    import tempfile
+    import subprocess
+    path = os.path.join(tempfile.mkdtemp(prefix="coqrst-"), "broker.sock")
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.getenv("PYTHONPATH")])))
+    process = subprocess.Popen([sys.executable, "-m", "coqrst.repl.broker", path, json.dumps(settings)],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    if process.stdout.readline() != b"ready\n":
+        process.kill()
+        process.wait()
+        process.stdin.close()
+        process.stdout.close()
+        remove_socket(path)
+        raise BrokerError("The coqtop broker failed to start")
+    process.stdout.close()
+    return BrokerClient(path, process)
+
+def main():
+    path, settings = sys.argv[1], json.loads(sys.argv[2])
+    try:
+        serve(Broker(**settings), path)
+    finally:
+        remove_socket(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Cache coqtop's responses across builds.
+=======================================
+
+Coqtop's response to a sentence only depends on the coqtop binary, its
+arguments, and the sentences sent since the last ``Reset Initial``.  This module
+stores responses on disk, in files named after a hash of all these, so that
+unchanged documents can be rebuilt without starting coqtop at all.
+"""
+
+import os
+import re
+import shutil
+import hashlib
+from tempfile import mkstemp
+
+RESET_SENTENCE = "Reset Initial."
+
+def is_reset(sentence):
+    return re.sub(r"\s+", " ", sentence).strip() == RESET_SENTENCE
+
+def fingerprint(coqtop_bin, args, prelude=(), transport="pty", backend="repl", max_output=None):
+    """Compute a string identifying coqtop_bin, args, prelude sentences,
+    transport, and backend (responses are formatted differently by each), and
+    the truncation limit max_output.
+
+    Uses the path, size, and modification time of the coqtop binary, which is
+    much cheaper than hashing it or running ``coqtop -v``.
+    """
+    path = shutil.which(coqtop_bin) or coqtop_bin
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        binary = "{}:{}:{}".format(path, st.st_size, st.st_mtime_ns)
+    except OSError:
+        binary = path
+    settings = [binary, transport, backend, str(max_output)]
+    return "\0".join(settings + list(args) + ["--"] + list(prelude))
+
+class ResponseCache:
+    """A size-bounded, on-disk LRU cache of coqtop responses.
+
+    Each entry lives in its own file, so that parallel Sphinx workers can share
+    the cache without locking.  Recency is tracked using modification times,
+    which `get` refreshes.
+    """
+
+    def __init__(self, directory, max_size):
+        """Create a cache in directory (but don't create the directory yet).
+
+        :param max_size: An upper bound on the size in bytes of the cache, as
+                         enforced by `prune`.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def history(fprint):
+        """Return a running hash of an empty history of sentences sent to the
+        coqtop described by fprint; extend it with `add_sentence`."""
+        return ResponseCache.add_sentence(hashlib.sha256(), fprint)
+
+    @staticmethod
+    def add_sentence(history, sentence):
+        """Update history (a running hash) with sentence, and return it."""
+        history.update(sentence.encode("utf-8"))
+        history.update(b"\0")
+        return history
+
+    @staticmethod
+    def key(history, sentence):
+        """Compute the key of sentence, sent to coqtop after history (which
+        isn't modified).  Only the new sentence is hashed, so computing the
+        keys of a whole document takes linear time."""
+        return ResponseCache.add_sentence(history.copy(), sentence).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the response stored under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8", newline="") as f:
+                response = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        """Store response under key."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(response)
+        os.replace(tmp, path) # Atomic, so concurrent readers never see partial entries
+
+    def prune(self):
+        """Remove least-recently used entries until the cache fits in max_size."""
+        entries, total = [], 0
+        for root, _, files in os.walk(self.directory):
+            for fname in files:
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class CachedCoqTop:
+    """A wrapper around CoqTop that answers sentences from a `ResponseCache`.
+
+    coqtop is only started on the first cache miss; the sentences that were
+    answered from the cache until then are replayed before sending the new
+    one.  Use this as a context manager, like CoqTop.
+    """
+
+    def __init__(self, coqtop, cache):
+        """Wrap coqtop, a CoqTop (or PooledCoqTop) that hasn't been started yet."""
+        self.coqtop, self.cache = coqtop, cache
+        prelude = getattr(coqtop, 'prelude', ())
+        self.fingerprint = fingerprint(coqtop.coqtop_bin, coqtop.args, prelude,
+                                       coqtop.transport, coqtop.backend, coqtop.max_output)
+        self.history = ResponseCache.history(self.fingerprint) # Sentences sent since the last reset
+        self.pending = [] # Sentences not yet sent to the real coqtop
+        self.started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.started:
+            self.coqtop.__exit__(type, value, traceback)
+
+    def _sync(self):
+        """Start coqtop if needed, and replay pending sentences."""
+        if not self.started:
+            self.coqtop.__enter__()
+            self.started = True
+        for sentence in self.pending:
+            self.coqtop.sendone(sentence)
+        self.pending = []
+
+    def sendone(self, sentence):
+        """Send a single sentence to coqtop, or find its response in the cache."""
+        key = ResponseCache.key(self.history, sentence)
+        output = self.cache.get(key)
+        if output is None:
+            self._sync()
+            output = self.coqtop.sendone(sentence)
+            self.cache.put(key, output)
+        elif is_reset(sentence):
+            # A fresh coqtop is already in its initial state
+            self.pending = [sentence] if self.started else []
+        else:
+            self.pending.append(sentence)
+
+        if is_reset(sentence):
+            self.history = ResponseCache.history(self.fingerprint)
+        else:
+            ResponseCache.add_sentence(self.history, sentence)
+        return output
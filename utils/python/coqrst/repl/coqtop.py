@@ -2,70 +2,507 @@
 Drive coqtop with Python!
 =========================
 
-This module is a simple pexpect-based driver for coqtop, based on the old
-REPL interface.
+This module drives coqtop through its old REPL interface.  `AsyncCoqTop` is an
+asyncio-based driver, which lets a single event loop drive many coqtop sessions
+at once; `CoqTop` is a synchronous wrapper around it, with its own event loop.
+
+coqtop runs either in a pseudo-terminal (the "pty" transport, which is what
+coqtop expects of an interactive session), or connected to plain pipes (the
+"pipe" transport, which skips the terminal's line discipline: there is no limit
+on the length of a sentence, no CRLF translation, and reads and writes use
+large buffers).
+
+`AsyncCoqTop` scrapes coqtop's prompts; `coqrst.repl.ideprotocol` provides
+another backend, over the XML protocol of CoqIDE.  `CoqTop` can wrap either,
+and ``coqrst/repl/fakecoqtop.py`` can stand in for coqtop in both cases.
 """
 
 import os
 import re
+import sys
+from collections import namedtuple
 
-import pexpect
+# Prompts follow one or more newlines (which aren't part of the response)
+COQTOP_PROMPT = re.compile("(?:\r\n)+[^<\\s]+ < ")
+PIPE_PROMPT = re.compile("\n+[^<\\s]+ < ")
+TRANSPORTS = ("pty", "pipe")
+BACKENDS = ("repl", "xml")
 
-class CoqTop:
-    """Create an instance of coqtop.
+# Size of pipe buffers and reads, for the "pipe" transport
+PIPE_SIZE = 1 << 20
 
-    Use this as a context manager: no instance of coqtop is created until
-    you call `__enter__`.  coqtop is terminated when you `__exit__` the
-    context manager.
+# Appended to responses cut at max_output characters
+TRUNCATION_MARKER = "\n[… output truncated: {} more characters]"
+
+ANSI_ESCAPE = re.compile("\x1b\\[[^m]*m")
+# Warnings are also preceded by "Toplevel input, characters …", so only the
+# "Error:" line tells that a sentence failed
+ERROR_RE = re.compile(r"^Error:", re.MULTILINE)
+
+# Fresh identifiers, sent to find out where coqtop is in its input (see _roll_back)
+SYNC_MARKER = "coqrst_sync_{}"
+SYNC_MARKER_RE = re.compile(r"\bcoqrst_sync_[0-9]+\b")
+
+BACKTRACK_RE = re.compile(r"^(?:Undo|Back)(?:\s+([0-9]+))?\s*\.$")
+
+# A message printed by coqtop; level is "error", "warning", "notice", etc.
+Message = namedtuple("Message", "level text")
+
+# Coqtop's response to a sentence: output is what the REPL would print, error
+# tells whether the sentence failed, messages is a tuple of Messages, and
+# state_id identifies coqtop's state after the sentence (when known).
+Response = namedtuple("Response", "output error messages state_id")
+
+def is_error(output):
+    """Check whether output is coqtop's response to a failing sentence."""
+    return ERROR_RE.search(ANSI_ESCAPE.sub("", output)) is not None
+
+def strip_partial_escape(text):
+    """Remove an ANSI escape sequence cut short at the end of text, if any."""
+    escape = text.rfind("\x1b")
+    return text[:escape] if escape >= 0 and "m" not in text[escape:] else text
+
+def truncate(output, max_output):
+    """Cut output to max_output characters (if not None), marking the cut.
+
+    The cut is moved back to the start of an escape sequence that it splits."""
+    if max_output is None or len(output) <= max_output:
+        return output
+    kept = strip_partial_escape(output[:max_output])
+    return kept + TRUNCATION_MARKER.format(len(output) - len(kept))
+
+def backtrack_count(sentence):
+    """Return the number of sentences that sentence (an ``Undo`` or ``Back``)
+    backtracks over, or None if it's not a backtracking command."""
+    backtrack = BACKTRACK_RE.match(sentence.strip())
+    return int(backtrack.group(1) or 1) if backtrack else None
+
+def backend_class(backend):
+    """Return the driver class implementing backend (one of BACKENDS)."""
+    if backend == "repl":
+        return AsyncCoqTop
+    if backend == "xml":
+        from .ideprotocol import AsyncCoqIdeTop
+        return AsyncCoqIdeTop
+    raise ValueError("Unknown backend {!r} (expected one of {})".format(backend, BACKENDS))
+
+def prompt_search_start(buffer):
+    """Return the first position of buffer where a prompt could still start,
+    assuming that the prompt doesn't match buffer.
+
+    Prompts start with newlines, and can't contain whitespace or ‘<’ before their
+    final ‘ < ’; text that ends with a partial ‘ < ’ can still become a prompt."""
+    end = len(buffer)
+    if buffer.endswith(" <"):
+        end -= 2
+    elif buffer.endswith(" "):
+        end -= 1
+    newline = max(buffer.rfind("\n", 0, end), buffer.rfind("\r", 0, end))
+    if newline < 0 or re.search(r"[<\s]", buffer[newline + 1:end]):
+        return len(buffer)
+    while newline > 0 and buffer[newline - 1] in "\r\n":
+        newline -= 1
+    return newline
+
+def widen_pipe(fd):
+    """Grow the kernel buffer of pipe fd to PIPE_SIZE, where supported."""
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+        except OSError: # Above /proc/sys/fs/pipe-max-size
+            pass
+
+class AsyncCoqTop:
+    """Create an instance of coqtop, driven asynchronously through its REPL.
+
+    Use this as an asynchronous context manager (``async with``): no instance
+    of coqtop is created until you enter it.  coqtop is terminated when you
+    exit the context manager.  Concurrent calls to `send` and `send_many` are
+    queued, and run one after the other.
 
     Sentence parsing is very basic for now (a "." in a quoted string will
     confuse it).
+
+    This class also defines the interface of backends: `start`, `close`,
+    `write` and `next_prompt`, `send`, `send_many`, `send_pipelined`, and
+    `query`.
     """
 
-    COQTOP_PROMPT = re.compile("\r\n[^< ]+ < ")
+    COQTOP_PROMPT = COQTOP_PROMPT
+    backend = "repl"
 
-    def __init__(self, coqtop_bin=None, color=False, args=None) -> str:
+    def __init__(self, coqtop_bin=None, color=False, args=None, transport="pty", max_output=None):
         """Configure a coqtop instance (but don't start it yet).
 
         :param coqtop_bin: The path to coqtop; uses $COQBIN by default, falling back to "coqtop"
         :param color:      When True, tell coqtop to produce ANSI color codes (see
                            the ansicolors module)
         :param args:       Additional arugments to coqtop.
+        :param transport:  How to connect to coqtop: "pty" or "pipe" (see above).
+                           Responses use "\\r\\n" line endings with "pty", and
+                           "\\n" with "pipe".
+        :param max_output: Keep at most this many characters of each response
+                           (None for no limit); the rest is read and dropped,
+                           and replaced by TRUNCATION_MARKER.
         """
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport {!r} (expected one of {})".format(transport, TRANSPORTS))
         self.coqtop_bin = coqtop_bin or os.getenv('COQBIN') or "coqtop"
         self.args = (args or []) + ["-color", "on"] * color
-        self.coqtop = None
+        self.transport = transport
+        self.prompt = COQTOP_PROMPT if transport == "pty" else PIPE_PROMPT
+        self.process, self.loop, self.lock = None, None, None
+        self.read_fd, self.write_fd = None, None
+        self.max_output = max_output
+        self.decoder, self.eof = None, False
+        self.buffer = "" # Text that might be part of a prompt
+        self.chunks, self.size = [], 0 # The current response, and its full size
+        self.responses = [] # Complete responses, not yet returned by next_prompt
+        self.waiter = None # Resolved when there's something new to read
+        self.syncs = 0 # Number of markers sent by _roll_back
+
+    async def __aenter__(self):
+        await self.start()
+        await self.next_prompt()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    @staticmethod
+    def _open_pty():
+        """Create a pseudo-terminal for coqtop.
+
+        :return: Our (read, write) and coqtop's (stdin, stdout) file descriptors."""
+        import pty
+        import termios
+        master, slave = pty.openpty()
+        attrs = termios.tcgetattr(slave)
+        attrs[3] &= ~termios.ECHO # Don't echo input back to us
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        return (master, master), (slave, slave)
+
+    @staticmethod
+    def _open_pipes():
+        """Create pipes for coqtop; see `_open_pty`."""
+        stdin, write_fd = os.pipe()
+        read_fd, stdout = os.pipe()
+        for fd in (write_fd, read_fd):
+            widen_pipe(fd)
+        return (read_fd, write_fd), (stdin, stdout)
+
+    async def start(self):
+        """Start coqtop, without waiting for its first prompt."""
+        import codecs
+        import asyncio # Imported lazily, since it's only needed if coqtop runs
+        if self.process:
+            raise ValueError("This coqtop instance is already running")
+        self.loop, self.lock = asyncio.get_event_loop(), asyncio.Lock()
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        ours, theirs = self._open_pty() if self.transport == "pty" else self._open_pipes()
+        try:
+            stdin, stdout = theirs
+            self.process = await asyncio.create_subprocess_exec(
+                self.coqtop_bin, *self.args, stdin=stdin, stdout=stdout, stderr=stdout,
+                start_new_session=True)
+        except:
+            for fd in set(ours):
+                os.close(fd)
+            raise
+        finally:
+            for fd in set(theirs):
+                os.close(fd)
+        for fd in set(ours):
+            os.set_blocking(fd, False)
+        self.read_fd, self.write_fd = ours
+        self.loop.add_reader(self.read_fd, self._on_readable)
+
+    async def close(self):
+        """Kill coqtop, and wait for it to exit."""
+        if not self.process:
+            return
+        self.loop.remove_reader(self.read_fd)
+        for fd in {self.read_fd, self.write_fd}:
+            os.close(fd)
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        await self.process.wait()
+        self.process, self.read_fd, self.write_fd = None, None, None
+
+    def abandon(self):
+        """Close our ends of the connection to coqtop, without killing it.
+
+        Use this on drivers inherited through a fork: the process, and the
+        event loop, still belong to the parent."""
+        for fd in {self.read_fd, self.write_fd} - {None}:
+            os.close(fd)
+        self.process, self.read_fd, self.write_fd = None, None, None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.read_fd, PIPE_SIZE if self.transport == "pipe" else 65536)
+        except BlockingIOError:
+            return
+        except OSError: # EIO: coqtop closed its end of the terminal
+            data = b""
+        if data:
+            self._received(data)
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.read_fd)
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _received(self, data):
+        """Process data, freshly read from coqtop.
+
+        Text that can't be part of a prompt moves to self.chunks right away,
+        so only a short tail is searched again when more data comes in."""
+        self.buffer += self.decoder.decode(data)
+        while True:
+            match = self.prompt.search(self.buffer)
+            if not match:
+                keep = prompt_search_start(self.buffer)
+                self._capture(self.buffer[:keep])
+                self.buffer = self.buffer[keep:]
+                return
+            self._capture(self.buffer[:match.start()])
+            self.buffer = self.buffer[match.end():]
+            output = "".join(self.chunks)
+            if self.max_output is not None and self.size > self.max_output:
+                output = strip_partial_escape(output)
+                output += TRUNCATION_MARKER.format(self.size - len(output))
+            self.responses.append(output)
+            self.chunks, self.size = [], 0
+
+    def _capture(self, text):
+        """Add text to the current response, dropping what exceeds max_output."""
+        if text:
+            room = len(text) if self.max_output is None else self.max_output - self.size
+            if room > 0:
+                self.chunks.append(text[:room])
+            self.size += len(text)
+
+    def _last_output(self):
+        """Return the part of the current response received so far, for error messages."""
+        return "".join(self.chunks) + self.buffer
+
+    async def _wait(self):
+        """Wait until there's something new to read from coqtop."""
+        if self.eof:
+            raise EOFError("coqtop exited; last output: {!r}".format(self._last_output()))
+        self.waiter = self.loop.create_future()
+        await self.waiter
+
+    async def _read_until_prompt(self):
+        while not self.responses:
+            await self._wait()
+        return self.responses.pop(0)
+
+    async def _with_timeout(self, coroutine, timeout):
+        import asyncio
+        try:
+            return await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("No response from coqtop after {}s; last output: {!r}"
+                               .format(timeout, self._last_output())) from None
+
+    async def next_prompt(self, timeout=1):
+        "Wait for the next coqtop prompt, and return the output preceeding it."
+        return await self._with_timeout(self._read_until_prompt(), timeout)
+
+    async def write(self, sentence):
+        """Send a single sentence to coqtop, without waiting for a response.
+
+        Use `next_prompt` to collect the response.
+        """
+        # Suppress newlines, but not spaces: they are significant in notations.
+        # coqtop prints a prompt for each line of input, even with pipes.
+        sentence = re.sub(r"[\r\n]+", " ", sentence).strip()
+        await self._write_bytes((sentence + "\n").encode("utf-8"))
+
+    async def _write_bytes(self, data):
+        while data:
+            try:
+                data = data[os.write(self.write_fd, data):]
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.write_fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.write_fd)
+
+    async def send(self, sentence, timeout=1):
+        """Send a single sentence to coqtop, and return its response.
+
+        :sentence: One Coq sentence (otherwise, Coqtop will produce multiple
+                   prompts and we'll get confused)
+        """
+        async with self.lock:
+            await self.write(sentence)
+            return await self.next_prompt(timeout)
+
+    async def query(self, sentence, timeout=1):
+        """Send a single sentence to coqtop, and return its `Response`.
+
+        The REPL doesn't report state ids or individual messages: the response
+        only has an output, and tells whether it looks like an error.
+        """
+        output = await self.send(sentence, timeout)
+        return Response(output, is_error(output), (), None)
+
+    async def send_many(self, sentences, timeout=1):
+        """Send each of sentences to coqtop in turn, and return the list of its
+        responses.  Other calls to `send` can't interleave with these."""
+        async with self.lock:
+            outputs = []
+            for sentence in sentences:
+                await self.write(sentence)
+                outputs.append(await self.next_prompt(timeout))
+            return outputs
+
+    async def send_pipelined(self, sentences, window=8, timeout=1):
+        """Send sentences to coqtop, writing up to window of them ahead of the
+        responses, and return the list of coqtop's responses.
+
+        This saves a round trip per sentence, but stops at the first failing
+        sentence: the result then ends with that sentence's response.  Any
+        sentences already written after it are rolled back (see `_roll_back`),
+        so that coqtop is left as if they hadn't been sent.
+        """
+        async with self.lock:
+            outputs, written = [], 0
+            while len(outputs) < len(sentences):
+                while written < len(sentences) and written - len(outputs) < window:
+                    await self.write(sentences[written])
+                    written += 1
+                outputs.append(await self.next_prompt(timeout))
+                if is_error(outputs[-1]):
+                    await self._roll_back(written - len(outputs), timeout)
+                    break
+            return outputs
+
+    async def _roll_back(self, in_flight, timeout):
+        """Undo the effects of the last in_flight sentences written to coqtop.
+
+        Coqtop may skip buffered input after an error, so it's unclear how many
+        of these sentences will run.  Instead of guessing, send a failing
+        ``Check`` of a fresh identifier (a marker), collect responses until the
+        one that mentions it, and ``Back`` over the sentences that succeeded
+        until then (``Undo``/``Back`` among in_flight sentences aren't
+        accounted for).  A marker written before another error may be skipped
+        too, so each error among in_flight sentences is followed by a fresh
+        marker; responses to older markers are ignored.
+        """
+        if not in_flight:
+            return
+        marker = await self._write_marker()
+        succeeded = 0
+        while True:
+            output = await self.next_prompt(timeout)
+            markers = SYNC_MARKER_RE.findall(output)
+            if marker in markers:
+                break
+            if not is_error(output):
+                succeeded += 1
+            elif not markers:
+                marker = await self._write_marker()
+        if succeeded:
+            await self.write("Back {}.".format(succeeded))
+            await self.next_prompt(timeout)
+
+    async def _write_marker(self):
+        """Write a failing sentence mentioning a fresh marker, and return the marker."""
+        self.syncs += 1
+        marker = SYNC_MARKER.format(self.syncs)
+        await self.write("Check {}.".format(marker))
+        return marker
+
+class CoqTop:
+    """Create an instance of coqtop.
+
+    Use this as a context manager: no instance of coqtop is created until
+    you call `__enter__`.  coqtop is terminated when you `__exit__` the
+    context manager.
+
+    This is a synchronous wrapper around a driver (an `AsyncCoqTop`, by
+    default): each instance runs its own event loop, only while one of its
+    methods is running.
+    """
+
+    COQTOP_PROMPT = COQTOP_PROMPT
+
+    def __init__(self, coqtop_bin=None, color=False, args=None, transport="pty",
+                 max_output=None, backend="repl"):
+        """Configure a coqtop instance (but don't start it yet); see `AsyncCoqTop`.
+
+        :param backend: How to talk to coqtop: "repl" (`AsyncCoqTop`) or "xml"
+                        (`coqrst.repl.ideprotocol.AsyncCoqIdeTop`).
+        """
+        self.driver = backend_class(backend)(coqtop_bin, color, args, transport, max_output)
+        self.coqtop_bin, self.args = self.driver.coqtop_bin, self.driver.args
+        self.transport, self.backend = self.driver.transport, backend
+        self.max_output = max_output
+        self.loop = None
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
 
     def __enter__(self):
-        if self.coqtop:
-            raise ValueError("This module isn't re-entrant")
-        self.coqtop = pexpect.spawn(self.coqtop_bin, args=self.args, echo=False, encoding="utf-8")
-        # Disable delays (http://pexpect.readthedocs.io/en/stable/commonissues.html?highlight=delaybeforesend)
-        self.coqtop.delaybeforesend = 0
+        self.start()
         self.next_prompt()
         return self
 
+    def start(self):
+        """Start coqtop, without waiting for its first prompt."""
+        import asyncio
+        if self.loop:
+            raise ValueError("This module isn't re-entrant")
+        self.loop = asyncio.new_event_loop()
+        self._run(self.driver.start())
+
     def __exit__(self, type, value, traceback):
-        self.coqtop.kill(9)
+        if self.loop:
+            self._run(self.driver.close())
+            self.loop.close()
+            self.loop = None
+
+    def abandon(self):
+        """Forget this instance, inherited through a fork; see `AsyncCoqTop.abandon`."""
+        self.driver.abandon()
+        self.loop = None
 
-    def next_prompt(self):
+    def next_prompt(self, timeout=1):
         "Wait for the next coqtop prompt, and return the output preceeding it."
-        self.coqtop.expect(CoqTop.COQTOP_PROMPT, timeout = 1)
-        return self.coqtop.before
+        return self._run(self.driver.next_prompt(timeout))
 
-    def sendone(self, sentence):
+    def write(self, sentence):
+        """Send a single sentence to coqtop, without waiting for a response.
+
+        Use `next_prompt` to collect the response.
+        """
+        self._run(self.driver.write(sentence))
+
+    def sendone(self, sentence, timeout=1):
         """Send a single sentence to coqtop.
 
         :sentence: One Coq sentence (otherwise, Coqtop will produce multiple
                    prompts and we'll get confused)
         """
-        # Suppress newlines, but not spaces: they are significant in notations
-        sentence = re.sub(r"[\r\n]+", " ", sentence).strip()
-        # print("Sending {}".format(sentence))
-        self.coqtop.sendline(sentence)
-        output = self.next_prompt()
-        # print("Got {}".format(repr(output)))
-        return output
+        return self._run(self.driver.send(sentence, timeout))
+
+    def send_pipelined(self, sentences, window=8, timeout=1):
+        """Send sentences to coqtop, without waiting for each response before
+        sending the next sentence; see `AsyncCoqTop.send_pipelined`."""
+        return self._run(self.driver.send_pipelined(sentences, window, timeout))
+
+    def query(self, sentence, timeout=1):
+        """Send a single sentence to coqtop, and return its `Response`."""
+        return self._run(self.driver.query(sentence, timeout))
 
 def sendmany(*sentences):
     """A small demo: send each sentence in sentences and print the output"""
@@ -77,6 +514,47 @@ def sendmany(*sentences):
             response = coqtop.sendone(sentence)
             print(response)
 
+async def check_many(sessions, count):
+    """Send count sentences to each of sessions coqtop instances, concurrently."""
+    import asyncio
+    async def session():
+        async with AsyncCoqTop() as coqtop:
+            return await coqtop.send_many(["Check nat."] * count)
+    return await asyncio.gather(*(session() for _ in range(sessions)))
+
+def benchmark(count=200):
+    """Compare the throughput of sending count sentences in various ways."""
+    import time
+    import asyncio
+    sentences = ["Check nat."] * count
+    def timed(label, fn, total=count):
+        start = time.perf_counter()
+        fn()
+        duration = time.perf_counter() - start
+        print("{}: {:.0f} sentences/s".format(label, total / duration))
+    with CoqTop() as coqtop:
+        timed("sendone", lambda: [coqtop.sendone(s) for s in sentences])
+        for window in (1, 8, 32):
+            timed("send_pipelined (window={})".format(window),
+                  lambda: coqtop.send_pipelined(sentences, window=window))
+    loop = asyncio.new_event_loop()
+    timed("8 concurrent sessions", lambda: loop.run_until_complete(check_many(8, count)), 8 * count)
+    loop.close()
+
+def benchmark_transports(sentences=("Print All.", "Check nat."), count=10):
+    """Compare the throughput of the "pty" and "pipe" transports, on sentences
+    with large outputs."""
+    import time
+    for transport in TRANSPORTS:
+        with CoqTop(transport=transport) as coqtop:
+            for sentence in sentences:
+                start, size = time.perf_counter(), 0
+                for _ in range(count):
+                    size += len(coqtop.sendone(sentence, timeout=60))
+                duration = time.perf_counter() - start
+                print("{} ({}): {:.1f} MB/s, {:.1f} sentences/s".format(
+                    sentence, transport, size / duration / 1e6, count / duration))
+
 def main():
     """Run a simple performance test and demo `sendmany`"""
     with CoqTop() as coqtop:
@@ -84,6 +562,8 @@ def main():
             print(repr(coqtop.sendone("Check nat.")))
         sendmany("Goal False -> True.", "Proof.", "intros H.",
                  "Check H.", "Chchc.", "apply I.", "Qed.")
+    benchmark()
+    benchmark_transports()
 
 if __name__ == '__main__':
     main()
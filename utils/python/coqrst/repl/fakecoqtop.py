@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+A fake coqtop, for testing and benchmarking without Coq.
+========================================================
+
+This script speaks coqtop's REPL protocol, or (when given ``-main-channel``,
+like coqidetop) the subset of CoqIDE's XML protocol that
+`coqrst.repl.ideprotocol` uses.  Point ``$COQBIN`` or ``$COQIDETOP`` at it.
+
+Responses are scripted by rules: a JSON list of objects, read from the file
+named by ``$FAKE_COQTOP_RULES`` (`DEFAULT_RULES` otherwise).  The first rule
+whose ``pattern`` (a regular expression) matches a sentence applies:
+
+- ``output``: the response, formatted with the groups of the match;
+- ``error``: whether the sentence fails (default: false);
+- ``warning``: whether output is a warning (default: false); the sentence
+  succeeds;
+- ``repeat``: how many copies of output to print, each formatted with the copy's
+  index as ``{n}`` (default: 1);
+- ``ansi``: an SGR code to color the first line with, when run with
+  ``-color on``;
+- ``delay``: how long to wait, in seconds, before responding;
+- ``discard``: whether to drop the input received so far (as coqtop may do
+  after an error) before responding (default: false).
+
+Sentences that match no rule succeed silently.  If ``$FAKE_COQTOP_LOG`` is
+set, each received sentence is appended to that file, after a ``spawn`` line
+when the process starts.
+
+This file doesn't depend on the rest of coqrst, so that it can run as a script.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+DEFAULT_RULES = [
+    {"pattern": r"^Check nat\.$", "output": "nat\n     : Set", "ansi": "92"},
+    {"pattern": r"^Check (\S+)\.$", "error": True,
+     "output": "The reference {1} was not found in the current environment."},
+    {"pattern": r"^Definition (\S+)", "output": "{1} is defined"},
+    {"pattern": r"^Hint Resolve [^:]*\.$", "warning": True,
+     "output": "Adding and removing hints in the core database implicitly adds them "
+               "to all the databases. [implicit-core-hint-db,deprecated]"},
+    {"pattern": r"^Fail\b", "output": "The command has indeed failed with message:\nfake failure"},
+    {"pattern": r"^Print All\.$", "repeat": 30000,
+     "output": "lemma_{n} : forall n : nat, n + {n} = {n} + n\n"},
+]
+
+PROMPT = "Coq < "
+XML_PROLOGUE = '<!DOCTYPE coq [<!ENTITY nbsp "&#160;">]><coq>'
+
+class Fake:
+    """Answer sentences according to rules."""
+
+    def __init__(self, rules, color, log):
+        self.rules = [(re.compile(rule["pattern"]), rule) for rule in rules]
+        self.color, self.log = color, log
+        self.discard = False # Whether the last rule asked to drop pending input
+        if log:
+            self.record("spawn")
+
+    def record(self, line):
+        with open(self.log, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def respond(self, sentence):
+        """Return (output, level) for sentence; level is "error", "warning",
+        or "notice"."""
+        if self.log:
+            self.record(sentence)
+        self.discard = False
+        for pattern, rule in self.rules:
+            match = pattern.search(sentence)
+            if match:
+                break
+        else:
+            return "", "notice"
+        time.sleep(rule.get("delay", 0))
+        self.discard = rule.get("discard", False)
+        groups = [match.group()] + list(match.groups())
+        output = "".join(rule["output"].format(*groups, n=n) for n in range(rule.get("repeat", 1)))
+        if self.color and "ansi" in rule:
+            first, *rest = output.split("\n", 1)
+            output = "\n".join(["\x1b[{}m{}\x1b[0m".format(rule["ansi"], first)] + rest)
+        level = "error" if rule.get("error") else "warning" if rule.get("warning") else "notice"
+        return output, level
+
+class Input:
+    """Lines of stdin, read without Python's buffering, so that pending input
+    can be discarded."""
+
+    def __init__(self):
+        self.buffer, self.eof = b"", False
+
+    def __iter__(self):
+        while True:
+            while b"\n" not in self.buffer and not self.eof:
+                data = os.read(0, 65536)
+                self.buffer, self.eof = self.buffer + data, not data
+            if not self.buffer:
+                return
+            line, _, self.buffer = self.buffer.partition(b"\n")
+            yield line.decode("utf-8")
+
+    def discard(self):
+        """Drop all input received so far."""
+        import select
+        self.buffer = b""
+        while not self.eof and select.select([0], [], [], 0)[0]:
+            self.eof = not os.read(0, 65536)
+
+def run_repl(fake):
+    out = sys.stdout
+    out.write("Welcome to Coq (fake)\n\n" + PROMPT)
+    out.flush()
+    stdin = Input()
+    for line in stdin:
+        output, level = fake.respond(line.strip())
+        if fake.discard:
+            stdin.discard()
+        if level != "notice":
+            output = "Toplevel input, characters 0-{}:\n> {}\n{}: {}".format(
+                len(line.strip()), line.strip(), level.capitalize(), output)
+        output = output.rstrip("\n")
+        out.write(output + "\n" * bool(output) + "\n" + PROMPT)
+        out.flush()
+
+def richpp(text):
+    return "<richpp><_>{}</_></richpp>".format(escape(text))
+
+def good(payload):
+    return '<value val="good">{}</value>'.format(payload)
+
+def state_id(sid):
+    return '<state_id val="{}"/>'.format(sid)
+
+def feedback(sid, level, text):
+    return ('<feedback object="state" route="0">{}<feedback_content val="message">'
+            '<message><message_level val={}/><option val="none"/>{}</message>'
+            '</feedback_content></feedback>').format(state_id(sid), quoteattr(level), richpp(text))
+
+class IdeServer:
+    """Answer calls of the XML protocol, in a linear document."""
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.sentences = {1: None} # State id → sentence that created it
+        self.parents = {1: None}
+        self.next_id = 2
+
+    def handle(self, call):
+        name = call.get("val")
+        if name == "Init":
+            return good(state_id(1))
+        if name == "Add":
+            sentence = call.find("pair/pair/string").text or ""
+            parent = int(call.find("pair/pair/state_id").get("val"))
+            sid, self.next_id = self.next_id, self.next_id + 1
+            self.sentences[sid], self.parents[sid] = sentence, parent
+            return good("<pair>{}<pair><union val=\"in_l\"><unit/></union><string></string></pair></pair>"
+                        .format(state_id(sid)))
+        if name == "Observe":
+            sid = int(call.find("state_id").get("val"))
+            output, level = self.fake.respond(self.sentences[sid].strip())
+            output = output.rstrip("\n")
+            if level == "error":
+                return '<value val="fail">{}{}</value>'.format(state_id(self.parents[sid]), richpp(output))
+            return (feedback(sid, level, output) if output else "") + good("<unit/>")
+        if name == "EditAt":
+            return good('<union val="in_l"><unit/></union>')
+        if name == "Goal":
+            return good('<option val="none"/>')
+        if name == "Quit":
+            sys.stdout.write(good("<unit/>"))
+            sys.stdout.flush()
+            sys.exit(0)
+        return good("<unit/>")
+
+def run_ide(fake):
+    import xml.etree.ElementTree as ET
+    server = IdeServer(fake)
+    parser = ET.XMLPullParser(events=("start", "end"))
+    parser.feed(XML_PROLOGUE)
+    depth, root = 0, None
+    stdin = sys.stdin.buffer
+    while True:
+        data = stdin.read1(65536)
+        if not data:
+            break
+        parser.feed(data)
+        for event, elem in parser.read_events():
+            if event == "start":
+                depth += 1
+                root = root if root is not None else elem
+                continue
+            depth -= 1
+            if depth == 1:
+                sys.stdout.write(server.handle(elem))
+                sys.stdout.flush()
+                root.remove(elem)
+
+def main():
+    rules_file = os.getenv("FAKE_COQTOP_RULES")
+    if rules_file:
+        with open(rules_file, encoding="utf-8") as f:
+            rules = json.load(f)
+    else:
+        rules = DEFAULT_RULES
+    args = sys.argv[1:]
+    color = any(a == "-color" and b == "on" for a, b in zip(args, args[1:]))
+    fake = Fake(rules, color, os.getenv("FAKE_COQTOP_LOG"))
+    if "-main-channel" in args or "-ideslave" in args:
+        run_ide(fake)
+    else:
+        run_repl(fake)
+
+if __name__ == '__main__':
+    main()
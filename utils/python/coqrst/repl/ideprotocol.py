@@ -0,0 +1,203 @@
+"""
+Drive coqtop through CoqIDE's XML protocol.
+===========================================
+
+coqidetop (``coqtop -ideslave`` before Coq 8.9) speaks the protocol that
+CoqIDE uses: each sentence is ``Add``-ed to a document, which gives it a state
+id, and ``Observe``-d to run it; messages come back as typed feedback, and
+errors as failed calls.  Going back to an earlier state is a single
+``EditAt``.  `AsyncCoqIdeTop` implements the interface of `AsyncCoqTop` on
+top of this, which makes error detection reliable and backtracking cheap.
+
+The protocol doesn't carry ANSI colors: responses are plain text, formatted
+like the REPL's (errors start with ``Error:``, warnings with ``Warning:``).
+
+Run this module to compare both backends (against fakecoqtop.py by default).
+"""
+
+import os
+from xml.sax.saxutils import escape
+
+from .cache import is_reset
+from .coqtop import AsyncCoqTop, Message, Response, backtrack_count, truncate
+
+# Arguments for coqidetop: talk on stdin/stdout; run sentences synchronously
+IDE_ARGS = ["-main-channel", "stdfds", "-async-proofs", "off"]
+
+# The stream of replies isn't a single XML document; this wraps it in one,
+# and declares the entity that Coq uses for non-breaking spaces
+XML_PROLOGUE = '<!DOCTYPE coq [<!ENTITY nbsp "&#160;">]><coq>'
+
+MESSAGE_PREFIXES = {"error": "Error: ", "warning": "Warning: "}
+
+def xml_text(elem):
+    """Return the text of elem, a richpp document or a plain string."""
+    return "".join(elem.itertext()).replace("\xa0", " ")
+
+def parse_message(message):
+    """Convert a <message> element into a `Message`."""
+    level = message.find("message_level").get("val")
+    return Message(level, xml_text(message[-1]))
+
+def render(messages):
+    """Format messages as the REPL would print them."""
+    return "\n".join(MESSAGE_PREFIXES.get(m.level, "") + m.text for m in messages)
+
+class AsyncCoqIdeTop(AsyncCoqTop):
+    """Create an instance of coqidetop, driven asynchronously.
+
+    Sentences given to `write` are queued, and only sent to coqtop by
+    `next_prompt`: each ``Add`` needs the state id returned by the previous
+    one.  Responses to ``Reset Initial``, ``Back`` and ``Undo`` are computed
+    locally, using ``EditAt``.
+    """
+
+    backend = "xml"
+
+    def __init__(self, coqtop_bin=None, color=False, args=None, transport="pipe", # pylint: disable=unused-argument
+                 max_output=None):
+        """Configure a coqidetop instance (but don't start it yet).
+
+        :param coqtop_bin: The path to coqidetop; uses $COQIDETOP by default,
+                           falling back to "coqidetop"
+        :param color:      Ignored: the protocol doesn't use ANSI colors
+        :param args:       Additional arguments to coqidetop
+        :param transport:  Ignored: the protocol always runs over pipes
+        :param max_output: Cut each response to this many characters (None for
+                           no limit)
+        """
+        coqtop_bin = coqtop_bin or os.getenv('COQIDETOP') or "coqidetop"
+        super().__init__(coqtop_bin, False, (args or []) + IDE_ARGS, "pipe", max_output)
+        self.parser, self.root, self.depth = None, None, 0
+        self.values, self.messages = [], []
+        self.states = [] # Ids of the initial state and of live sentences
+        self.queue = [] # Sentences given to write, not yet sent
+        self.initialized = False
+
+    async def start(self):
+        """Start coqidetop, without initializing it (see `next_prompt`)."""
+        import xml.etree.ElementTree as ET
+        await super().start()
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.parser.feed(XML_PROLOGUE)
+
+    def _received(self, data):
+        """Parse data; collect replies in self.values, and messages in self.messages."""
+        self.parser.feed(data)
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                self.depth += 1
+                if self.root is None:
+                    self.root = elem
+                continue
+            self.depth -= 1
+            if self.depth != 1:
+                continue
+            if elem.tag == "value":
+                self.values.append(elem)
+            elif elem.tag == "feedback":
+                content = elem.find("feedback_content")
+                if content.get("val") == "message":
+                    self.messages.append(parse_message(content.find("message")))
+            elif elem.tag == "message": # Coq < 8.6
+                self.messages.append(parse_message(elem))
+            self.root.remove(elem)
+
+    async def _call(self, name, argument):
+        """Call name with argument (an XML string).
+
+        :return: A pair (good, value): good tells whether the call succeeded,
+                 and value is the <value> element of the reply."""
+        await self._write_bytes('<call val="{}">{}</call>'.format(name, argument).encode("utf-8"))
+        while not self.values:
+            await self._wait()
+        value = self.values.pop(0)
+        return value.get("val") == "good", value
+
+    async def back_to(self, state_id):
+        """Return to state_id, which must be the id of a live state."""
+        await self._call("EditAt", '<state_id val="{}"/>'.format(state_id))
+        del self.states[self.states.index(state_id) + 1:]
+
+    async def _initialize(self):
+        _, value = await self._call("Init", '<option val="none"/>')
+        self.states = [int(value.find("state_id").get("val"))]
+        self.initialized = True
+        return ""
+
+    async def _process(self, sentence):
+        """Run sentence, and return its `Response`."""
+        count = backtrack_count(sentence)
+        if is_reset(sentence) or count is not None:
+            target = 0 if count is None else max(0, len(self.states) - 1 - count)
+            await self.back_to(self.states[target])
+            return Response("", False, (), self.states[-1])
+
+        self.messages = []
+        add = ('<pair><pair><string>{}</string><int>-1</int></pair>'
+               '<pair><state_id val="{}"/><bool val="false"/></pair></pair>')
+        good, value = await self._call("Add", add.format(escape(sentence), self.states[-1]))
+        if good:
+            state_id = int(value.find("pair/state_id").get("val"))
+            good, value = await self._call("Observe", '<state_id val="{}"/>'.format(state_id))
+            if good:
+                self.states.append(state_id)
+            else: # Drop the failed sentence from the document
+                await self.back_to(self.states[-1])
+
+        messages = list(self.messages)
+        if not good:
+            error = Message("error", xml_text(value[-1]) if len(value) else xml_text(value))
+            if error not in messages:
+                messages.append(error)
+        output = truncate(render(messages), self.max_output)
+        return Response(output, not good, tuple(messages), self.states[-1])
+
+    async def write(self, sentence):
+        """Queue sentence; `next_prompt` sends it and returns its response."""
+        self.queue.append(sentence)
+
+    async def next_prompt(self, timeout=1):
+        """Return the response to the oldest queued sentence (or, the first
+        time, initialize coqidetop and return an empty greeting)."""
+        if not self.initialized:
+            return await self._with_timeout(self._initialize(), timeout)
+        response = await self._with_timeout(self._process(self.queue.pop(0)), timeout)
+        return response.output
+
+    async def query(self, sentence, timeout=1):
+        async with self.lock:
+            return await self._with_timeout(self._process(sentence), timeout)
+
+    async def _roll_back(self, in_flight, timeout):
+        """Drop the last in_flight queued sentences, which haven't run yet."""
+        del self.queue[len(self.queue) - in_flight:]
+
+def compare_backends(sentences, coqtop_args, coqidetop_args):
+    """Run sentences with each backend, and report differences and timings."""
+    import time
+    from .coqtop import CoqTop
+    results = {}
+    for backend, kwargs in (("repl", coqtop_args), ("xml", coqidetop_args)):
+        start = time.perf_counter()
+        with CoqTop(backend=backend, transport="pipe", **kwargs) as coqtop:
+            results[backend] = [coqtop.query(sentence) for sentence in sentences]
+        duration = time.perf_counter() - start
+        print("{}: {:.0f} sentences/s".format(backend, len(sentences) / duration))
+    for sentence, repl, xml in zip(sentences, results["repl"], results["xml"]):
+        if repl.error != xml.error:
+            print("Disagreement on {!r}: {} vs {}".format(sentence, repl, xml))
+
+def main():
+    """Compare both backends, against fakecoqtop.py unless $COQBIN and
+    $COQIDETOP are set."""
+    import sys
+    fake = {"coqtop_bin": sys.executable, "args": [os.path.join(os.path.dirname(__file__), "fakecoqtop.py")]}
+    coqtop_args = {} if os.getenv("COQBIN") else fake
+    coqidetop_args = {} if os.getenv("COQIDETOP") else fake
+    sentences = ["Check nat.", "Definition x := 1.", "Hint Resolve x.", "Check x.", "Check y.", "Back 1.",
+                 "Reset Initial.", "Check x."] * 100
+    compare_backends(sentences, coqtop_args, coqidetop_args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Incremental re-execution of coqtop sessions.
+============================================
+
+When a document is rebuilt after a small edit, most of its sentences are
+unchanged.  An `IncrementalSession` keeps its coqtop process alive between runs,
+remembers which sentences it ran, and uses ``Back`` to rewind to the end of the
+longest unchanged prefix before running the rest: outputs of the prefix are
+reused.
+
+To know how far to rewind, each session tracks coqtop's stack of states: each
+successful sentence pushes a state, failing ones don't, and ``Undo``, ``Back``
+and ``Reset Initial`` pop states.
+"""
+
+import os
+import atexit
+import threading
+from collections import OrderedDict
+
+from .cache import is_reset, RESET_SENTENCE
+from .coqtop import is_error, backtrack_count
+
+def update_states(states, index, sentence, output):
+    """Update states (a list of indices of sentences that created a live state)
+    to reflect the effect of running sentence (at position index), which
+    produced output."""
+    count = backtrack_count(sentence)
+    if is_error(output):
+        pass
+    elif is_reset(sentence):
+        del states[:]
+    elif count is not None:
+        del states[max(0, len(states) - count):]
+    else:
+        states.append(index)
+
+class IncrementalSession:
+    """A long-lived coqtop session that only re-runs changed sentences."""
+
+    def __init__(self, repl):
+        """Wrap repl, a CoqTop-like object that hasn't been started yet."""
+        self.repl = repl.__enter__()
+        self.history = [] # (sentence, output) pairs, in the order they ran
+        self.states = []  # Indices (into history) of sentences that created live states
+
+    def close(self):
+        self.repl.__exit__(None, None, None)
+
+    def _rewind(self, sentences):
+        """Rewind to the end of the longest prefix of sentences that already ran.
+
+        :return: The length of the reused prefix."""
+        prefix = 0
+        for (old, _), new in zip(self.history, sentences):
+            if old != new:
+                break
+            prefix += 1
+
+        states = []
+        for index, (sentence, output) in enumerate(self.history[:prefix]):
+            update_states(states, index, sentence, output)
+
+        if states == self.states[:len(states)]:
+            extra = len(self.states) - len(states)
+            if extra:
+                self.repl.sendone("Back {}.".format(extra))
+        else: # A state of the prefix was discarded later on; start over
+            self.repl.sendone(RESET_SENTENCE)
+            prefix, states = 0, []
+
+        del self.history[prefix:]
+        self.states = states
+        return prefix
+
+    def run(self, sentences):
+        """Run sentences, as if in a fresh coqtop session.
+
+        :return: The list of coqtop's responses to each sentence."""
+        prefix = self._rewind(sentences)
+        for sentence in sentences[prefix:]:
+            output = self.repl.sendone(sentence)
+            update_states(self.states, len(self.history), sentence, output)
+            self.history.append((sentence, output))
+        return [output for _, output in self.history]
+
+class SessionStore:
+    """A bounded collection of IncrementalSessions, evicting the least recently used.
+
+    Sessions are per-process: a store inherited through a fork starts empty.
+    The store is thread-safe, but each session should only be used by one
+    thread at a time.
+    """
+
+    def __init__(self, max_sessions=0):
+        self.max_sessions = max_sessions
+        self.pid, self.sessions = os.getpid(), OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, make_repl):
+        """Return the session for key, creating it using make_repl if needed."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.sessions = os.getpid(), OrderedDict()
+            session = self.sessions.pop(key, None)
+        session = session or IncrementalSession(make_repl()) # Slow; don't hold the lock
+        with self.lock:
+            self.sessions[key] = session
+            evicted = []
+            while len(self.sessions) > self.max_sessions:
+                evicted.append(self.sessions.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return session
+
+    def discard(self, key):
+        """Close and forget the session for key (e.g. after an error)."""
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session:
+            session.close()
+
+    def close(self):
+        if self.pid == os.getpid():
+            for session in self.sessions.values():
+                session.close()
+        self.sessions = OrderedDict()
+
+# Sessions outlive individual builds, so they live at the module level (but not
+# the process: forked workers start with no sessions, and all are closed at exit)
+SESSIONS = SessionStore()
+atexit.register(SESSIONS.close)
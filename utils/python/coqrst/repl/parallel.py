@@ -0,0 +1,71 @@
+"""
+Run independent parts of a coqtop session concurrently.
+=======================================================
+
+``Reset Initial`` returns coqtop to a clean state, so the sentences between two
+resets don't depend on anything that came before them.  `split_at_resets` cuts
+a session into such segments, and `run_segments` runs them on separate coqtop
+processes at the same time; with a single job, `split_for_jobs` keeps them
+together instead.  Talking to coqtop is mostly waiting, so threads
+are enough to keep several processes busy.  `run_longest_first` does the same
+for segments of many documents, scheduling the longest ones first.
+"""
+
+import os
+
+from .cache import is_reset
+
+def split_at_resets(sentences):
+    """Split sentences into segments, starting a new one at each reset.
+
+    Each segment but the first starts with a reset; no segment is empty."""
+    segments = []
+    for sentence in sentences:
+        if not segments or is_reset(sentence):
+            segments.append([])
+        segments[-1].append(sentence)
+    return segments
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+def split_for_jobs(sentences, jobs=None):
+    """Split sentences at resets if segments can run concurrently (with more
+    than one job); otherwise keep them in a single segment, so that they run
+    on a single coqtop process: a reset is much cheaper than a new process."""
+    if (jobs or default_jobs()) > 1:
+        return split_at_resets(sentences)
+    return [sentences] if sentences else []
+
+def run_segments(segments, run_segment, jobs=None):
+    """Run segments concurrently, using at most jobs threads.
+
+    :param run_segment: A function taking a segment's index and sentences, and
+                        returning the list of coqtop's responses to them.
+    :return: The list of responses to all sentences of all segments, in order.
+    """
+    results = map_segments(run_segment, list(range(len(segments))), segments, jobs)
+    return [output for outputs in results for output in outputs]
+
+def run_longest_first(segments, run_segment, jobs=None):
+    """Like `run_segments`, but start the longest segments first.
+
+    When there are more segments than threads, this keeps a long segment from
+    starting last and running alone.
+
+    :return: The list of the results of run_segment on each segment, in order.
+    """
+    order = sorted(range(len(segments)), key=lambda idx: len(segments[idx]), reverse=True)
+    results = map_segments(run_segment, order, [segments[idx] for idx in order], jobs)
+    by_index = dict(zip(order, results))
+    return [by_index[idx] for idx in range(len(segments))]
+
+def map_segments(run_segment, indices, segments, jobs):
+    """Call run_segment on each index and segment, using at most jobs threads,
+    which start segments in order."""
+    jobs = min(jobs or default_jobs(), len(segments))
+    if jobs <= 1:
+        return [run_segment(idx, seg) for idx, seg in zip(indices, segments)]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(run_segment, indices, segments))
@@ -0,0 +1,126 @@
+"""
+A pool of warm coqtop processes.
+================================
+
+Starting coqtop and loading a document's prerequisites takes a while.  A
+`CoqTopPool` keeps a few coqtop processes ready, each already primed with a
+prelude (typically ``Require Import`` sentences).  Documents check out a
+`PooledCoqTop`, which starts in a known clean state: a fresh process that has
+run just the prelude.  Processes are never returned to the pool: instead, each
+checkout starts priming a replacement in the background, by queuing the prelude
+on the new process' input without waiting for responses.  Errors in the prelude
+are reported to a callback, since they would otherwise go unnoticed.
+"""
+
+import os
+import threading
+
+from .coqtop import CoqTop, is_error
+from .cache import is_reset
+
+# Requiring libraries can take much longer than running a typical sentence
+PRELUDE_TIMEOUT = 60
+
+class CoqTopPool:
+    """A pool of started coqtop processes, primed with a prelude.
+
+    Processes are spawned lazily, on the first checkout in each process: a pool
+    created before Sphinx forks its workers isn't shared with them, and workers
+    close their copies of the parent's connections.  Checkouts are thread-safe.
+    """
+
+    def __init__(self, size, prelude=(), on_error=None, **coqtop_args):
+        """Configure a pool (but don't start any coqtop yet).
+
+        :param size:        How many primed processes to keep ready
+        :param prelude:     Sentences to run in each process before checkout
+        :param on_error:    Called as on_error(sentence, output) the first time
+                            each sentence of prelude fails
+        :param coqtop_args: Arguments passed to CoqTop for each process
+        """
+        self.size, self.prelude, self.coqtop_args = size, list(prelude), coqtop_args
+        self.on_error, self.failed = on_error, set()
+        self.pid, self.idle = os.getpid(), []
+        self.lock = threading.Lock()
+        template = CoqTop(**coqtop_args)
+        self.coqtop_bin, self.args = template.coqtop_bin, template.args
+        self.transport, self.backend = template.transport, template.backend
+        self.max_output = template.max_output
+
+    def _spawn(self):
+        """Start a coqtop process and queue the prelude, without waiting."""
+        coqtop = CoqTop(**self.coqtop_args)
+        coqtop.start()
+        for sentence in self.prelude:
+            coqtop.write(sentence)
+        return coqtop
+
+    def _check_owner(self):
+        """Forget processes inherited through a fork; they belong to the parent."""
+        if self.pid != os.getpid():
+            for coqtop in self.idle:
+                coqtop.abandon()
+            self.pid, self.idle = os.getpid(), []
+
+    def check_prelude(self, sentence, output):
+        """Report output (the response to sentence, from the prelude) if it's an error."""
+        if is_error(output) and self.on_error and sentence not in self.failed:
+            self.failed.add(sentence)
+            self.on_error(sentence, output)
+
+    def checkout(self):
+        """Return a started CoqTop instance that has run the prelude.
+
+        The caller owns the result, and should return it using `checkin`.
+        """
+        with self.lock:
+            self._check_owner()
+            coqtop = self.idle.pop(0) if self.idle else self._spawn()
+            while len(self.idle) < self.size:
+                self.idle.append(self._spawn())
+        coqtop.next_prompt(timeout=PRELUDE_TIMEOUT)
+        for sentence in self.prelude:
+            self.check_prelude(sentence, coqtop.next_prompt(timeout=PRELUDE_TIMEOUT))
+        return coqtop
+
+    def checkin(self, coqtop):
+        """Dispose of coqtop, which was obtained from `checkout`."""
+        coqtop.__exit__(None, None, None)
+
+    def close(self):
+        """Stop all idle processes."""
+        with self.lock:
+            self._check_owner()
+            for coqtop in self.idle:
+                coqtop.__exit__(None, None, None)
+            self.idle = []
+
+class PooledCoqTop:
+    """A CoqTop-like object backed by a process from a `CoqTopPool`.
+
+    Use this as a context manager, like CoqTop.  ``Reset Initial`` returns to
+    the state right after the prelude, instead of Coq's initial state.
+    """
+
+    def __init__(self, pool):
+        self.pool, self.coqtop = pool, None
+        self.coqtop_bin, self.args, self.prelude = pool.coqtop_bin, pool.args, pool.prelude
+        self.transport, self.backend = pool.transport, pool.backend
+        self.max_output = pool.max_output
+
+    def __enter__(self):
+        self.coqtop = self.pool.checkout()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.pool.checkin(self.coqtop)
+        self.coqtop = None
+
+    def sendone(self, sentence):
+        """Send a single sentence to coqtop; see `CoqTop.sendone`."""
+        output = self.coqtop.sendone(sentence)
+        if is_reset(sentence):
+            for prelude_sentence in self.prelude:
+                prelude_output = self.coqtop.sendone(prelude_sentence, timeout=PRELUDE_TIMEOUT)
+                self.pool.check_prelude(prelude_sentence, prelude_output)
+        return output
@@ -0,0 +1,263 @@
+"""
+Split Coq code into sentences.
+==============================
+
+coqtop expects exactly one sentence per request, so sentences must be cut
+where Coq's lexer would cut them: at a ``.`` followed by whitespace (or the
+end of the input), but not in ``..`` or ``...``, nor in strings or (nested)
+comments, nor between the components of a qualified name.  Bullets (``-``,
+``++``, ``***``, …) and braces (``{`` and ``}``) at the start of a sentence
+are sentences of their own.
+
+`SentenceSplitter` does this incrementally, in a single pass: feed it chunks
+of text, and it yields the spans of complete sentences as soon as they are
+known.  Comments and whitespace before a sentence belong to it; comments
+after the last sentence are attached to that sentence.
+
+Run this module with files or directories of reStructuredText to check the
+splitter on the contents of their ``coqtop`` blocks, and to time it.
+"""
+
+import re
+
+CODE_RE = re.compile(r'[."(]')
+COMMENT_RE = re.compile(r'[("*]')
+BLANK_RE = re.compile(r"\s*")
+BULLETS = "-+*"
+BRACES = "{}"
+
+class SentenceSplitter:
+    """An incremental splitter; see the module's documentation.
+
+    Spans are (start, end) pairs of offsets into the concatenation of all
+    chunks passed to `feed`.
+    """
+
+    def __init__(self):
+        self.text, self.offset = "", 0 # Unconsumed text, and its offset in the input
+        self.pos = 0 # Offset (in the input) up to which text has been scanned
+        self.start = None # Start of the current sentence, if any
+        self.has_code = False # Whether the current sentence has more than comments
+        self.depth, self.in_string = 0, False
+        self.last = None # The last sentence, held back until the next one has code
+        self.final = False
+
+    def feed(self, chunk):
+        """Add chunk to the input, and return the list of the spans of the
+        sentences that this completes."""
+        consumed = (self.start if self.start is not None else self.pos) - self.offset
+        self.text, self.offset = self.text[consumed:] + chunk, self.offset + consumed
+        return list(self._scan())
+
+    def close(self):
+        """Signal the end of the input, and return the list of the spans of the
+        remaining sentences."""
+        self.final = True
+        return list(self._scan())
+
+    def _emit(self, end):
+        """Finish the current sentence at end; return the previous one, if it
+        can be released."""
+        released, self.last = self.last, (self.start, end)
+        self.start, self.has_code = None, False
+        return released
+
+    def _scan(self):
+        text, offset = self.text, self.offset
+        end = offset + len(text)
+        pos = self.pos
+        while pos < end:
+            idx = pos - offset
+            if self.in_string:
+                quote = text.find('"', idx)
+                if quote < 0:
+                    pos = end
+                elif quote + 1 == len(text) and not self.final:
+                    pos = offset + quote # Might be an escaped quote ("")
+                    break
+                elif quote + 1 < len(text) and text[quote + 1] == '"':
+                    pos = offset + quote + 2
+                else:
+                    self.in_string, pos = False, offset + quote + 1
+            elif self.depth:
+                match = COMMENT_RE.search(text, idx)
+                if not match:
+                    pos = end
+                    continue
+                i = match.start()
+                char = text[i]
+                if char == '"':
+                    self.in_string, pos = True, offset + i + 1
+                elif i + 1 == len(text) and not self.final:
+                    pos = offset + i
+                    break
+                else:
+                    pair = text[i:i + 2]
+                    self.depth += (pair == "(*") - (pair == "*)")
+                    pos = offset + i + (2 if pair in ("(*", "*)") else 1)
+            elif not self.has_code:
+                i = BLANK_RE.match(text, idx).end()
+                if i == len(text):
+                    pos = end
+                    continue
+                if self.start is None:
+                    self.start = offset + i
+                char = text[i]
+                if text.startswith("(*", i):
+                    self.depth, pos = 1, offset + i + 2
+                elif char == "(" and i + 1 == len(text) and not self.final:
+                    pos = offset + i
+                    break
+                elif char in BRACES:
+                    pos = offset + i + 1
+                    released = self._emit(pos)
+                    if released:
+                        yield released
+                elif char in BULLETS:
+                    j = i
+                    while j < len(text) and text[j] == char:
+                        j += 1
+                    if j == len(text) and not self.final:
+                        pos = offset + i
+                        break
+                    pos = offset + j
+                    released = self._emit(pos)
+                    if released:
+                        yield released
+                else:
+                    self.has_code, pos = True, offset + i
+                    if self.last:
+                        yield self.last
+                        self.last = None
+            else:
+                match = CODE_RE.search(text, idx)
+                if not match:
+                    pos = end
+                    continue
+                i = match.start()
+                char = text[i]
+                if char == '"':
+                    self.in_string, pos = True, offset + i + 1
+                elif char == "(":
+                    if i + 1 == len(text) and not self.final:
+                        pos = offset + i
+                        break
+                    if text.startswith("(*", i):
+                        self.depth, pos = 1, offset + i + 2
+                    else:
+                        pos = offset + i + 1
+                else: # A run of dots
+                    j = i
+                    while j < len(text) and text[j] == ".":
+                        j += 1
+                    if j == len(text) and not self.final:
+                        pos = offset + i
+                        break
+                    pos = offset + j
+                    if j - i == 1 and (j == len(text) or text[j].isspace()):
+                        released = self._emit(pos)
+                        if released:
+                            yield released
+        self.pos = pos
+        if self.final and pos >= end:
+            yield from self._finish()
+
+    def _finish(self):
+        """Release the last sentences at the end of the input."""
+        end = self.offset + len(self.text.rstrip())
+        if self.start is not None and not self.has_code and self.last:
+            self.start, self.last = None, (self.last[0], end) # Trailing comments
+        if self.last:
+            yield self.last
+            self.last = None
+        if self.start is not None:
+            yield (self.start, end)
+            self.start = None
+
+def sentence_spans(source):
+    """Iterate over the (start, end) spans of the sentences in source."""
+    splitter = SentenceSplitter()
+    yield from splitter.feed(source)
+    yield from splitter.close()
+
+def split_sentences(source):
+    """Split source into a list of sentences."""
+    return [source[start:end] for start, end in sentence_spans(source)]
+
+def coqtop_blocks(path):
+    """Extract the contents of the coqtop blocks of reStructuredText file path."""
+    import textwrap
+    with open(path, encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    blocks, idx = [], 0
+    while idx < len(lines):
+        match = re.match(r"(\s*)\.\. coqtop::", lines[idx])
+        idx += 1
+        if match:
+            body = []
+            while idx < len(lines) and (not lines[idx].strip() or
+                                        re.match(match.group(1) + r"\s", lines[idx])):
+                body.append(lines[idx])
+                idx += 1
+            blocks.append(textwrap.dedent("\n".join(body)).strip())
+    return blocks
+
+def check(source, chunkings=20):
+    """Check properties of the sentences of source; return a list of failures."""
+    import random
+    failures = []
+    spans = list(sentence_spans(source))
+    gaps = [source[e:s] for (_, e), (s, _) in zip([(0, 0)] + spans, spans + [(len(source), 0)])]
+    if any(gap.strip() for gap in gaps):
+        failures.append("non-blank text between sentences: {!r}".format(gaps))
+    if any(s >= e for s, e in spans) or any(e1 > s2 for (_, e1), (s2, _) in zip(spans, spans[1:])):
+        failures.append("overlapping or empty spans: {}".format(spans))
+    for start, end in spans:
+        if list(sentence_spans(source[start:end])) != [(0, end - start)]:
+            failures.append("sentence isn't stable: {!r}".format(source[start:end]))
+    for _ in range(chunkings):
+        cuts = sorted(random.sample(range(len(source) + 1), min(5, len(source) + 1)))
+        splitter, streamed = SentenceSplitter(), []
+        for lo, hi in zip([0] + cuts, cuts + [len(source)]):
+            streamed.extend(splitter.feed(source[lo:hi]))
+        streamed.extend(splitter.close())
+        if streamed != spans:
+            failures.append("chunking at {} changes spans: {} vs {}".format(cuts, streamed, spans))
+            break
+    return failures
+
+def main():
+    """Check the splitter on coqtop blocks, and compare it with a regexp."""
+    import os
+    import sys
+    import timeit
+    paths = []
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths.extend(os.path.join(arg, f) for f in sorted(os.listdir(arg)) if f.endswith(".rst"))
+        else:
+            paths.append(arg)
+    blocks = [block for path in paths for block in coqtop_blocks(path)]
+
+    failures, differences = 0, 0
+    for block in blocks:
+        for failure in check(block):
+            failures += 1
+            print("Failure on {!r}: {}".format(block, failure))
+        old = re.split(r"(?<=(?<!\.)\.)\s+", block)
+        if old != split_sentences(block):
+            differences += 1
+            print("Differs from the regexp on {!r}:\n  {}\n  {}".format(block, old, split_sentences(block)))
+    print("{} blocks: {} failures, {} differences with the regexp".format(
+        len(blocks), failures, differences))
+
+    corpus = "\n".join(blocks)
+    size = len(corpus.encode("utf-8"))
+    for name, fn in (("regexp", lambda: re.split(r"(?<=(?<!\.)\.)\s+", corpus)),
+                     ("SentenceSplitter", lambda: list(sentence_spans(corpus)))):
+        duration = min(timeit.repeat(fn, number=20, repeat=3)) / 20
+        print("{}: {:.1f} MB/s".format(name, size / duration / 1e6))
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure the startup cost of the Coq domain
+==========================================
+
+Run ``python3 -m coqrst.startup [budget_ms]`` to time ``import
+coqrst.coqdomain`` and ``setup(app)``, excluding the time spent loading
+Sphinx itself.  Exits with an error if that takes longer than budget_ms, or if
+heavy dependencies (which should be loaded on first use) were loaded eagerly.
+"""
+
+import sys
+import time
+
+# Dependencies that only the directives and transforms that need them load
+LAZY_MODULES = ("bs4", "asyncio", "antlr4")
+
+# Modules that Sphinx loads anyway, and that shouldn't count towards our budget
+SPHINX_MODULES = ("docutils.parsers.rst", "docutils.transforms", "sphinx.addnodes",
+                  "sphinx.roles", "sphinx.util.nodes", "sphinx.directives",
+                  "sphinx.domains", "sphinx.ext.mathbase")
+
+class StubApp:
+    """A stand-in for a Sphinx application that ignores all calls."""
+
+    def __getattr__(self, _name):
+        return lambda *args, **kwargs: None
+
+def measure():
+    """Return the time (in seconds) taken to load and set up coqrst.coqdomain."""
+    import importlib
+    for module in SPHINX_MODULES:
+        importlib.import_module(module)
+    start = time.perf_counter()
+    from . import coqdomain
+    coqdomain.setup(StubApp())
+    return time.perf_counter() - start
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    duration = measure() * 1000
+    eager = [m for m in LAZY_MODULES if m in sys.modules]
+    print("import coqrst.coqdomain + setup(app): {:.1f}ms (budget: {:.0f}ms)".format(duration, budget))
+    if eager:
+        print("Eagerly loaded: {}".format(", ".join(eager)))
+    if eager or duration > budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
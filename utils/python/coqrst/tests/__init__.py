@@ -0,0 +1,7 @@
+"""
+Tests for coqrst.
+=================
+
+Run ``python3 -m pytest coqrst/tests`` from ``utils/python`` (or ``make
+test``).  Tests that need coqtop run against ``coqrst/repl/fakecoqtop.py``.
+"""
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+
+import pytest
+
+FAKE_COQTOP = os.path.join(os.path.dirname(__file__), os.pardir, "repl", "fakecoqtop.py")
+
+@pytest.fixture
+def fake_coqtop(tmp_path, monkeypatch):
+    """Return a function that configures fakecoqtop.py with rules (a list of
+    dicts, or None for its default rules), and returns keyword arguments for
+    `CoqTop` that run it."""
+    def configure(rules=None):
+        if rules is not None:
+            path = tmp_path / "rules.json"
+            path.write_text(json.dumps(rules), encoding="utf-8")
+            monkeypatch.setenv("FAKE_COQTOP_RULES", str(path))
+        else:
+            monkeypatch.delenv("FAKE_COQTOP_RULES", raising=False)
+        return {"coqtop_bin": sys.executable, "args": [os.path.abspath(FAKE_COQTOP)]}
+    return configure
+
+class Build:
+    """The result of a `sphinx_build`."""
+
+    def __init__(self, process, outdir, log):
+        self.returncode, self.warnings = process.returncode, process.stderr
+        self.outdir, self.log = outdir, log
+
+    def html(self, docname):
+        return (self.outdir / (docname + ".html")).read_text(encoding="utf-8")
+
+    def coqtop_pairs(self, docname):
+        """Return the (sentence, output) pairs of the coqtop blocks of docname."""
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(self.html(docname), "html.parser")
+        return [(dt.get_text(), dt.find_next_sibling("dd").get_text())
+                for block in soup.select("div.coqtop") for dt in block.find_all("dt")]
+
+    def spawns(self):
+        return self.log.count("spawn")
+
+@pytest.fixture
+def sphinx_build(tmp_path, fake_coqtop):
+    """Return a function that builds a Sphinx project with the Coq domain, and
+    returns a `Build`.  The function takes a dict of documents (docname →
+    reStructuredText), rules for fakecoqtop.py (which plays coqtop), Sphinx's
+    number of jobs, and conf.py settings as keyword arguments.  Builds share
+    their source and output directories, so later ones are incremental."""
+    import subprocess
+    srcdir, outdir, log = tmp_path / "src", tmp_path / "html", tmp_path / "coqtop.log"
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    def build(documents, rules=None, jobs=1, **settings):
+        srcdir.mkdir(exist_ok=True)
+        conf = dict({"extensions": ["coqrst.coqdomain"], "master_doc": "index",
+                     "coq_lexer": "python"}, **settings)
+        (srcdir / "conf.py").write_text("".join("{} = {!r}\n".format(k, v) for k, v in conf.items()),
+                                        encoding="utf-8")
+        for docname, text in documents.items():
+            (srcdir / (docname + ".rst")).write_text(text, encoding="utf-8")
+        fake_coqtop(rules)
+        env = dict(os.environ, COQBIN=os.path.abspath(FAKE_COQTOP), FAKE_COQTOP_LOG=str(log),
+                   PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.getenv("PYTHONPATH")])))
+        if log.exists():
+            log.unlink()
+        process = subprocess.run([sys.executable, "-m", "sphinx", "-q", "-j", str(jobs), "-b", "html",
+                                  str(srcdir), str(outdir)],
+                                 env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, timeout=120)
+        lines = log.read_text(encoding="utf-8").splitlines() if log.exists() else []
+        return Build(process, outdir, lines)
+    return build
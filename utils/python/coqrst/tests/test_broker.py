@@ -0,0 +1,60 @@
+import os
+import subprocess
+
+import pytest
+
+from coqrst.repl.coqtop import is_error
+from coqrst.repl.broker import Broker, BrokerError, start_broker
+
+@pytest.fixture
+def settings(fake_coqtop, tmp_path, monkeypatch):
+    log = tmp_path / "log"
+    monkeypatch.setenv("FAKE_COQTOP_LOG", str(log))
+    settings = {"max_sessions": 2, "coqtop_args": dict(transport="pipe", **fake_coqtop())}
+    settings["log"] = lambda: log.read_text().splitlines()
+    return settings
+
+def test_sessions_are_reused(settings):
+    log = settings.pop("log")
+    broker = Broker(**settings)
+    try:
+        first = ["Definition x := 1.", "Check y.", "Hint Resolve x.", "Check nat."]
+        outputs = broker.run(("doc", 0), first)
+        assert outputs[0] == "x is defined" and is_error(outputs[1]) and not is_error(outputs[2])
+        second = first[:2] + ["Definition z := 2."]
+        assert broker.run(("doc", 0), second)[2] == "z is defined"
+        # The warning created a state, which must be undone too
+        assert log()[-2:] == ["Back 2.", "Definition z := 2."]
+    finally:
+        stats = broker.close()
+    assert stats["sessions"] == 1 and stats["reused"] == 1
+
+def test_start_broker(settings):
+    settings.pop("log")
+    client = start_broker(settings)
+    path, process = client.path, client.process
+    try:
+        assert len(path) < 100
+        assert client.run(("doc", 0), ["Definition x := 1."]) == ["x is defined"]
+        with pytest.raises(BrokerError):
+            client._request({"unknown": True}) # pylint: disable=protected-access
+    finally:
+        stats = client.shutdown()
+    assert stats["segments"] == 1
+    assert process.returncode == 0 and not os.path.exists(os.path.dirname(path))
+
+def test_broker_exits_with_its_parent(settings):
+    settings.pop("log")
+    client = start_broker(settings)
+    client.run(("doc", 0), ["Definition x := 1."])
+    client.process.stdin.close() # As if the parent had died
+    assert client.process.wait(timeout=10) == 0
+    assert not os.path.exists(os.path.dirname(client.path))
+
+def test_failed_start_stops_the_broker(monkeypatch):
+    started = []
+    popen = subprocess.Popen
+    monkeypatch.setattr(subprocess, "Popen", lambda *args, **kwargs: started.append(popen(*args, **kwargs)) or started[-1])
+    with pytest.raises(BrokerError):
+        start_broker({"no_such_setting": True})
+    assert started[0].poll() is not None
@@ -0,0 +1,106 @@
+import pytest
+
+DOCUMENTS = {
+    "index": """Index
+=====
+
+.. toctree::
+
+   other
+
+.. coqtop:: all
+
+   Check nat.
+   Definition x := 1.
+
+.. coqtop:: reset all
+
+   Check x.
+""",
+    "other": """Other
+=====
+
+.. coqtop:: in
+
+   Definition y := 2.
+
+.. coqtop:: all
+
+   Check nat.
+"""}
+
+@pytest.mark.parametrize("jobs, settings", [(1, {}), (1, {"coqtop_jobs": 2}), (2, {"coqtop_jobs": 2})])
+def test_coqtop_blocks(sphinx_build, jobs, settings):
+    build = sphinx_build(DOCUMENTS, jobs=jobs, **settings)
+    assert build.returncode == 0 and build.warnings == ""
+    pairs = build.coqtop_pairs("index")
+    assert pairs[:2] == [("Check nat.", "nat\n     : Set"), ("Definition x := 1.", "x is defined")]
+    assert pairs[2][0] == "Check x." and "The reference x was not found" in pairs[2][1]
+    assert build.coqtop_pairs("other") == [("Definition y := 2.", "y is defined"),
+                                           ("Check nat.", "nat\n     : Set")]
+    assert 'class="ansi-fg-light-green first">nat</span>' in build.html("other")
+
+SEGMENTS = {"index": ".. toctree::\n\n   other\n\n" + "".join(
+    ".. coqtop:: {}all\n\n   Check nat.\n\n".format("reset " if idx else "") for idx in range(2)),
+            "other": "Other\n=====\n\n" + "".join(
+    ".. coqtop:: {}all\n\n   Definition x := {}.\n\n".format("reset " if idx else "", idx) for idx in range(2))}
+
+@pytest.mark.parametrize("settings, spawns", [({}, 2), ({"coqtop_jobs": 2}, 4), ({"coqtop_deferred": True}, 2)])
+def test_one_coqtop_per_document_with_one_job(sphinx_build, settings, spawns):
+    build = sphinx_build(SEGMENTS, coqtop_cache_size=0, **settings)
+    assert build.returncode == 0 and build.warnings == ""
+    assert build.spawns() == spawns
+    assert [output for _, output in build.coqtop_pairs("other")] == ["x is defined"] * 2
+
+@pytest.mark.parametrize("broker", [False, True])
+def test_incremental_sessions_need_the_broker(sphinx_build, broker):
+    build = sphinx_build(DOCUMENTS, coqtop_incremental_sessions=4, coqtop_broker=broker)
+    assert build.returncode == 0
+    assert ("coqtop_incremental_sessions only reuses sessions within one process" in build.warnings) != broker
+
+GRAMMAR = {"index": ".. toctree::\n\n   grammar\n   tactics\n",
+           "grammar": """Grammar
+=======
+
+.. productionlist:: coq
+   term : `ident` | `term` `term`
+
+A :production:`qualid` is a qualified identifier.
+""",
+           "tactics": """Tactics
+=======
+
+.. coq:tacn:: foo @term in @qualid using @unknown
+"""}
+
+def hole_links(html):
+    """Return a dict mapping the holes of html to their links (or None)."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    return {hole.get_text(): hole.parent.get("href") if hole.parent.name == "a" else None
+            for hole in soup.select("span.hole")}
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_notation_holes_link_to_productions(sphinx_build, jobs):
+    build = sphinx_build(GRAMMAR, jobs=jobs)
+    assert build.returncode == 0 and build.warnings == ""
+    assert hole_links(build.html("tactics")) == {"term": "grammar.html#grammar-token-term",
+                                                 "qualid": "grammar.html#grammar-token-qualid",
+                                                 "unknown": None}
+
+@pytest.mark.filterwarnings("ignore::DeprecationWarning") # From Sphinx 1.7's templates
+def test_grammar_tokens_are_reset_between_builds(tmp_path):
+    from sphinx.application import Sphinx
+    srcdir, outdir = tmp_path / "src", tmp_path / "html"
+    srcdir.mkdir()
+    (srcdir / "conf.py").write_text("extensions = ['coqrst.coqdomain']\nmaster_doc = 'index'\n")
+    for docname, text in GRAMMAR.items():
+        (srcdir / (docname + ".rst")).write_text(text, encoding="utf-8")
+    app = Sphinx(str(srcdir), str(srcdir), str(outdir), str(tmp_path / "doctrees"), "html",
+                 status=None, warning=None, freshenv=True)
+    app.build()
+    assert hole_links((outdir / "tactics.html").read_text())["unknown"] is None
+    (srcdir / "grammar.rst").write_text(GRAMMAR["grammar"] + "\nAn :production:`unknown`.\n")
+    (srcdir / "tactics.rst").write_text(GRAMMAR["tactics"] + "\nChanged.\n")
+    app.build()
+    assert hole_links((outdir / "tactics.html").read_text())["unknown"] == "grammar.html#grammar-token-unknown"
@@ -0,0 +1,82 @@
+import os
+import hashlib
+
+import pytest
+
+from coqrst.repl.coqtop import CoqTop
+from coqrst.repl.cache import ResponseCache, CachedCoqTop, fingerprint
+
+RULES = [{"pattern": r"^Definition (\S+)", "output": "{1} is defined"},
+         {"pattern": r"^Check (\S+)\.$", "output": "{1} : Set"}]
+SENTENCES = ["Definition a := 1.", "Check a.", "Reset Initial.", "Check nat."]
+
+@pytest.fixture
+def cached(fake_coqtop, tmp_path, monkeypatch):
+    """Return a function that runs sentences through a CachedCoqTop and
+    returns their outputs, and a function that returns the fake's log."""
+    log = tmp_path / "log"
+    monkeypatch.setenv("FAKE_COQTOP_LOG", str(log))
+    cache = ResponseCache(str(tmp_path / "cache"), 10 ** 6)
+    kwargs = fake_coqtop(RULES)
+    def run(sentences):
+        with CachedCoqTop(CoqTop(transport="pipe", **kwargs), cache) as coqtop:
+            return [coqtop.sendone(sentence) for sentence in sentences]
+    def read_log():
+        lines = log.read_text().splitlines() if log.exists() else []
+        log.unlink(missing_ok=True)
+        return lines
+    return cache, run, read_log
+
+def test_hit_after_rebuild(cached):
+    cache, run, log = cached
+    outputs = run(SENTENCES)
+    assert outputs == ["a is defined", "a : Set", "", "nat : Set"]
+    assert log() == ["spawn"] + SENTENCES
+    assert run(SENTENCES) == outputs
+    assert log() == [] # coqtop never started
+    assert (cache.hits, cache.misses) == (4, 4)
+
+def test_first_miss_replays_pending_sentences(cached):
+    _, run, log = cached
+    run(SENTENCES)
+    log()
+    changed = ["Definition a := 1.", "Check a.", "Definition b := 2.", "Check b."]
+    assert run(changed) == ["a is defined", "a : Set", "b is defined", "b : Set"]
+    assert log() == ["spawn"] + changed
+
+def test_replay_after_reset(cached):
+    _, run, log = cached
+    run(SENTENCES)
+    log()
+    assert run(SENTENCES[:3] + ["Check bool."])[-1] == "bool : Set"
+    assert log() == ["spawn", "Check bool."] # A fresh coqtop needs neither the reset nor what precedes it
+
+def test_key_depends_on_settings(fake_coqtop):
+    kwargs = fake_coqtop(RULES)
+    prints = {fingerprint(kwargs["coqtop_bin"], kwargs["args"]),
+              fingerprint(kwargs["coqtop_bin"], kwargs["args"], prelude=["Require Import Arith."]),
+              fingerprint(kwargs["coqtop_bin"], kwargs["args"], transport="pipe"),
+              fingerprint(kwargs["coqtop_bin"], kwargs["args"], backend="xml"),
+              fingerprint(kwargs["coqtop_bin"], kwargs["args"], max_output=100)}
+    assert len(prints) == 5
+    cache = ResponseCache(None, 0)
+    keys = {ResponseCache.key(CachedCoqTop(CoqTop(**settings, **kwargs), cache).history, "Check nat.")
+            for settings in ({}, {"transport": "pipe"}, {"backend": "xml"})}
+    assert len(keys) == 3
+
+def test_running_key_matches_hash_of_history():
+    history, sentences = ResponseCache.history("fp"), ["Check a.", "Check b."]
+    for sentence in sentences:
+        ResponseCache.add_sentence(history, sentence)
+    expected = hashlib.sha256("".join(part + "\0" for part in ["fp"] + sentences + ["Check c."]).encode("utf-8"))
+    assert ResponseCache.key(history, "Check c.") == expected.hexdigest()
+    assert ResponseCache.key(history, "Check c.") == expected.hexdigest() # history is unchanged
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path), 250)
+    for age, key in enumerate(["cc", "bb", "aa"]): # aa is the oldest
+        cache.put(key * 32, "x" * 100)
+        os.utime(cache._path(key * 32), (1000 - age, 1000 - age)) # pylint: disable=protected-access
+    assert cache.get("aa" * 32) == "x" * 100 # Refreshes aa
+    cache.prune()
+    assert [cache.get(key * 32) is not None for key in ["aa", "bb", "cc"]] == [True, False, True]
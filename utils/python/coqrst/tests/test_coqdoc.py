@@ -0,0 +1,50 @@
+import re
+import html
+import pickle
+import importlib
+
+import pytest
+
+coqdoc_main = importlib.import_module("coqrst.coqdoc.main")
+
+def fake_coqdoc(coq_code, coqdoc_bin="coqdoc", timeout=2): # pylint: disable=unused-argument
+    """Render each snippet of coq_code as a single keyword, like coqdoc would."""
+    parts = re.split(r"\(\*\* coqrst-snippet-([0-9]+) \*\)\n", coq_code)
+    if len(parts) == 1:
+        return '<div class="code"><span class="id" type="keyword">{}</span></div>'.format(
+            html.escape(coq_code.strip()))
+    output = []
+    for idx in range(1, len(parts), 2):
+        output.append('<div class="doc">coqrst-snippet-{}</div>'.format(parts[idx]))
+        output.append('<div class="code"><span class="id" type="keyword">{}</span>\n</div>'
+                      .format(html.escape(parts[idx + 1].strip())))
+    return "".join(output)
+
+@pytest.fixture(autouse=True)
+def no_coqdoc(monkeypatch):
+    monkeypatch.setattr(coqdoc_main, "coqdoc", fake_coqdoc)
+    monkeypatch.setattr(coqdoc_main, "CACHE", None)
+
+def test_lex_many():
+    tokens = coqdoc_main.lex_many(["Check nat.", "Goal True."])
+    assert tokens == [[(["coqdoc-keyword"], "Check nat.")], [(["coqdoc-keyword"], "Goal True.")]]
+
+def test_lex_many_returns_plain_strings():
+    # bs4 strings point to their soup; pickling one used to recurse endlessly
+    tokens = coqdoc_main.lex_many_with_coqdoc(["Check nat."])
+    assert all(type(text) is str for _, text in tokens[0]) # pylint: disable=unidiomatic-typecheck
+    assert pickle.loads(pickle.dumps(tokens)) == tokens
+
+def test_lex_many_fallback(monkeypatch):
+    # A snippet that swallows the next sentinel forces one coqdoc run per snippet
+    monkeypatch.setattr(coqdoc_main, "SNIPPET_SENTINEL", "(* {} *)\n")
+    tokens = coqdoc_main.lex_many_with_coqdoc(["Check nat.", "Goal True."])
+    assert [[text for _, text in snippet] for snippet in tokens] == [["Check nat."], ["Goal True."]]
+    assert all(type(text) is str for snippet in tokens for _, text in snippet) # pylint: disable=unidiomatic-typecheck
+
+def test_lex_elements_comments():
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup('<span class="comment">(* a *)</span><span class="id" type="var">x</span>',
+                         "html.parser")
+    assert list(coqdoc_main.lex_elements(soup.children)) == [
+        (["coqdoc-comment"], "(* a *)"), (["coqdoc-var"], "x")]
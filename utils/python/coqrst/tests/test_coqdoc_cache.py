@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+
+from coqrst.coqdoc import cache as coqdoc_cache
+from coqrst.coqdoc.cache import HighlightCache
+
+TOKENS = [[(["coqdoc-keyword"], "Check"), ([], " nat.")]]
+
+@pytest.fixture
+def warnings():
+    return []
+
+def make_cache(path, warnings):
+    return HighlightCache(str(path), 10, fingerprint="test", on_error=warnings.append)
+
+def test_roundtrip(tmp_path, warnings):
+    cache = make_cache(tmp_path / "cache.sqlite", warnings)
+    assert cache.get_many(["Check nat."]) == [None]
+    cache.put_many(["Check nat."], TOKENS)
+    assert cache.get_many(["Check nat.", "Goal True."]) == [TOKENS[0], None]
+    assert (cache.hits, cache.misses, warnings) == (1, 2, [])
+
+def test_lookups_dont_wait_for_writers(tmp_path, warnings, monkeypatch):
+    path = tmp_path / "cache.sqlite"
+    make_cache(path, warnings).put_many(["Check nat."], TOKENS)
+    cache = make_cache(path, warnings) # A new build
+    assert cache.get_many(["Check nat."]) == TOKENS # Updates last_used, once
+    monkeypatch.setattr(coqdoc_cache, "LOCK_TIMEOUT", 0.1)
+    writer = sqlite3.connect(str(path))
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        assert cache.get_many(["Check nat."] * 3) == TOKENS * 3
+    finally:
+        writer.rollback()
+        writer.close()
+    assert warnings == [] and not cache.disabled
+
+@pytest.mark.parametrize("breakage", ["parent is a file", "not a database"])
+def test_broken_database_disables_cache(tmp_path, warnings, breakage):
+    if breakage == "parent is a file":
+        (tmp_path / "file").write_text("")
+        path = tmp_path / "file" / "cache.sqlite"
+    else:
+        path = tmp_path / "cache.sqlite"
+        path.write_bytes(b"garbage" * 1000)
+    cache = make_cache(path, warnings)
+    assert cache.get_many(["Check nat.", "Goal True."]) == [None, None]
+    cache.put_many(["Check nat."], TOKENS)
+    cache.prune()
+    assert cache.disabled and len(warnings) == 1
+    assert warnings[0].startswith("Not using the coqdoc cache at {}".format(path))
+
+def test_lock_timeout_disables_cache(tmp_path, warnings, monkeypatch):
+    path = tmp_path / "cache.sqlite"
+    cache = make_cache(path, warnings)
+    cache.put_many(["Check nat."], TOKENS)
+    monkeypatch.setattr(coqdoc_cache, "LOCK_TIMEOUT", 0.1)
+    writer = sqlite3.connect(str(path))
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        cache.put_many(["Goal True."], TOKENS)
+    finally:
+        writer.rollback()
+        writer.close()
+    assert cache.disabled and "locked" in warnings[0]
+    assert cache.get_many(["Check nat."]) == [None]
+
+def test_prune(tmp_path, warnings):
+    cache = make_cache(tmp_path / "cache.sqlite", warnings)
+    snippets = ["Check n{}.".format(idx) for idx in range(15)]
+    cache.put_many(snippets, TOKENS * 15)
+    cache.prune()
+    assert cache.count() == 10
@@ -0,0 +1,76 @@
+import pytest
+
+from coqrst.repl.coqtop import CoqTop, is_error, truncate, TRUNCATION_MARKER
+
+RULES = [{"pattern": r"^Definition (\S+)", "output": "{1} is defined"},
+         {"pattern": r"^Hint Resolve", "warning": True, "output": "Deprecated."},
+         {"pattern": r"^Check slow_(\S+)\.$", "error": True, "delay": 0.2,
+          "output": "The reference slow_{1} was not found."},
+         {"pattern": r"^Check flushing_(\S+)\.$", "error": True, "delay": 0.2, "discard": True,
+          "output": "The reference flushing_{1} was not found."},
+         {"pattern": r"^Print Colors\.$", "output": "abcdef", "ansi": "33"},
+         {"pattern": r"^Print Lines\.$", "output": "{n}\n", "repeat": 1000},
+         {"pattern": r"^Check (\S+)\.$", "error": True,
+          "output": "The reference {1} was not found in the current environment."}]
+
+@pytest.fixture(params=["pty", "pipe"])
+def coqtop(request, fake_coqtop, tmp_path, monkeypatch):
+    log = tmp_path / "log"
+    monkeypatch.setenv("FAKE_COQTOP_LOG", str(log))
+    with CoqTop(transport=request.param, **fake_coqtop(RULES)) as coqtop:
+        coqtop.log = lambda: log.read_text().splitlines()
+        yield coqtop
+
+def test_sendone(coqtop):
+    assert coqtop.sendone("Definition x := 1.") == "x is defined"
+    newline = "\r\n" if coqtop.transport == "pty" else "\n"
+    assert coqtop.sendone("Print Lines.", timeout=10) == newline.join(map(str, range(1000)))
+    assert is_error(coqtop.sendone("Check y."))
+    assert coqtop.sendone("Definition z := 1.") == "z is defined"
+
+def test_pipelined_warnings_dont_stop(coqtop):
+    sentences = ["Definition a := 1.", "Hint Resolve a.", "Definition b := 2."]
+    outputs = coqtop.send_pipelined(sentences, window=8)
+    assert len(outputs) == 3 and "Warning: Deprecated." in outputs[1]
+    assert not any(line.startswith("Check coqrst_sync") for line in coqtop.log())
+
+def test_pipelined_error_rolls_back(coqtop):
+    sentences = ["Definition a := 1.", "Check slow_b.", "Definition c := 3.", "Definition d := 4."]
+    outputs = coqtop.send_pipelined(sentences, window=8)
+    assert len(outputs) == 2 and is_error(outputs[1])
+    assert coqtop.log()[-2:] == ["Check coqrst_sync_1.", "Back 2."]
+
+def test_pipelined_error_with_discarded_input(coqtop):
+    # The second error drops the marker sent after the first one
+    sentences = ["Definition a := 1.", "Check slow_b.", "Check flushing_c.", "Definition d := 4."]
+    outputs = coqtop.send_pipelined(sentences, window=8, timeout=2)
+    assert len(outputs) == 2 and is_error(outputs[1])
+    assert coqtop.log()[-1] == "Check coqrst_sync_2."
+    assert coqtop.sendone("Definition e := 5.") == "e is defined"
+
+@pytest.mark.parametrize("max_output, kept", [
+    (3, "abc"), (4, "abc"), (7, "abc"), (8, "abc\x1b[33m"), (9, "abc\x1b[33md"), (20, None)])
+def test_truncate_keeps_escapes_whole(max_output, kept):
+    output = "abc\x1b[33mdef\x1b[0m"
+    truncated = truncate(output, max_output)
+    if kept is None:
+        assert truncated == output
+    else:
+        assert truncated == kept + TRUNCATION_MARKER.format(len(output) - len(kept))
+
+def test_truncated_output_can_be_colorized():
+    from coqrst.coqdomain import AnsiColorsParser
+    nodes = AnsiColorsParser().colorize_str(truncate("abc\x1b[33mdef\x1b[0m", 7))
+    assert "".join(node.astext() for node in nodes).startswith("abc\n[… output truncated")
+
+@pytest.mark.parametrize("transport", ["pty", "pipe"])
+def test_max_output(fake_coqtop, transport):
+    with CoqTop(transport=transport, color=True, max_output=8, **fake_coqtop(RULES)) as coqtop:
+        output = coqtop.sendone("Print Colors.")
+        assert output == "\x1b[33mabc" + TRUNCATION_MARKER.format(len("def\x1b[0m"))
+    with CoqTop(transport=transport, color=True, max_output=13, **fake_coqtop(RULES)) as coqtop:
+        output = coqtop.sendone("Print Colors.") # Cut in the middle of \x1b[0m
+        assert output == "\x1b[33mabcdef" + TRUNCATION_MARKER.format(len("\x1b[0m"))
+        output = coqtop.sendone("Print Lines.", timeout=10)
+        assert output.startswith("0") and output.endswith("more characters]")
+        assert coqtop.sendone("Definition x := 1.") == "x is defined"
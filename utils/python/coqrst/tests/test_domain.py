@@ -0,0 +1,82 @@
+import copy
+
+from coqrst.coqdomain import CoqDomain, CoqTacticIndex, ObjectRecord
+
+class Env:
+    """A stand-in for a Sphinx environment, with domain data and warnings."""
+
+    def __init__(self, domaindata=None):
+        self.domaindata = domaindata or {}
+        self.warnings = []
+
+    def warn(self, docname, msg):
+        self.warnings.append((docname, msg))
+
+def add(domain, subdomain, name, docname):
+    CoqDomain.add_object(domain.data, subdomain, name, ObjectRecord.make(docname, subdomain, name))
+
+def test_migrate_v1():
+    objects = {subdomain: {} for subdomain in CoqDomain.initial_data['objects']}
+    objects['tacn']['intro'] = ("tactics", "tacn", "coq:tacn.intro-1")
+    domain = CoqDomain(Env({'coq': {'version': 1, 'objects': objects}}))
+    record = domain.data['objects']['tacn']['intro']
+    assert record == ObjectRecord("tactics", "tacn", "intro-1")
+    assert record.targetid == "coq:tacn.intro-1"
+    assert domain.data['by_doc'] == {"tactics": {"tacn": {"intro"}}}
+    assert domain.data['version'] == CoqDomain.data_version
+
+def test_clear_doc():
+    domain = CoqDomain(Env())
+    add(domain, 'tacn', 'intro', "a")
+    add(domain, 'cmd', 'Print', "a")
+    add(domain, 'cmd', 'Check', "b")
+    domain.clear_doc("a")
+    assert domain.data['by_doc'] == {"b": {"cmd": {"Check"}}}
+    assert domain.data['objects']['tacn'] == {} and list(domain.data['objects']['cmd']) == ["Check"]
+
+def test_clear_overridden_doc():
+    domain = CoqDomain(Env())
+    add(domain, 'tacn', 'intro', "a")
+    add(domain, 'tacn', 'intro', "b") # Overrides a's definition
+    domain.clear_doc("a")
+    assert domain.data['objects']['tacn']['intro'].docname == "b"
+    domain.clear_doc("b")
+    assert domain.data['objects']['tacn'] == {} and domain.data['by_doc'] == {}
+
+def test_merge_domaindata():
+    domain = CoqDomain(Env())
+    add(domain, 'cmd', 'Check', "main")
+    worker = CoqDomain(Env(copy.deepcopy(domain.env.domaindata))) # A forked reader
+    worker.clear_doc("main")
+    add(worker, 'tacn', 'intro', "x")
+    add(worker, 'cmd', 'Check', "y") # Also defined in main
+    add(worker, 'tacn', 'apply', "y")
+    add(worker, 'tacn', 'apply', "z") # Overrides y's definition, but z isn't merged
+    domain.merge_domaindata(["x", "y"], worker.data)
+    assert {name: record.docname for name, record in domain.data['objects']['tacn'].items()} == {"intro": "x"}
+    assert domain.data['objects']['cmd']['Check'].docname == "y"
+    assert domain.data['by_doc'] == {"main": {"cmd": {"Check"}}, "x": {"tacn": {"intro"}}, "y": {"cmd": {"Check"}}}
+    assert [docname for docname, _ in domain.env.warnings] == ["y"]
+
+def names(content):
+    return [(letter, [entry[0] for entry in entries]) for letter, entries in content]
+
+def test_tactic_index_merges_subdomains():
+    domain = CoqDomain(Env())
+    for subdomain, name, docname in [("tac", "intro", "a"), ("tacn", "Induction", "b"),
+                                     ("tacn", "apply", "a"), ("tac", "induction", "a")]:
+        add(domain, subdomain, name, docname)
+    content, collapse = CoqTacticIndex(domain).generate()
+    assert not collapse
+    assert names(content) == [("a", ["apply"]), ("i", ["induction", "Induction", "intro"])]
+    assert content[0][1][0][1:4] == [0, "a", "coq:tacn.apply"]
+
+def test_index_restricted_to_documents():
+    domain = CoqDomain(Env())
+    for subdomain, name, docname in [("tac", "intro", "a"), ("tacn", "Induction", "b"), ("tac", "apply", "b")]:
+        add(domain, subdomain, name, docname)
+    content, _ = CoqTacticIndex(domain).generate(["b"])
+    assert names(content) == [("a", ["apply"]), ("i", ["Induction"])]
+    domain.clear_doc("b")
+    content, _ = CoqTacticIndex(domain).generate()
+    assert names(content) == [("i", ["intro"])]
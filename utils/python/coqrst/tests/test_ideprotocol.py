@@ -0,0 +1,50 @@
+import pytest
+
+from coqrst.repl.coqtop import CoqTop, Message
+from coqrst.repl.ideprotocol import render
+
+SENTENCES = ["Check nat.", "Definition x := 1.", "Hint Resolve x.", "Check y.", "Back 1.",
+             "Definition z := 2.", "Reset Initial.", "Fail Check w."]
+
+@pytest.fixture
+def backends(fake_coqtop):
+    args = fake_coqtop()
+    with CoqTop(backend="repl", transport="pipe", **args) as repl, \
+         CoqTop(backend="xml", **args) as xml:
+        yield repl, xml
+
+def test_backends_agree(backends):
+    repl, xml = backends
+    for sentence in SENTENCES:
+        expected, response = repl.query(sentence), xml.query(sentence)
+        assert response.error == expected.error, sentence
+        if not expected.output.startswith("Toplevel input"):
+            assert response.output == expected.output, sentence
+
+def test_messages(backends):
+    _, xml = backends
+    assert xml.query("Check nat.").messages == (Message("notice", "nat\n     : Set"),)
+    response = xml.query("Hint Resolve nat.")
+    assert not response.error and response.messages[0].level == "warning"
+    assert response.output.startswith("Warning: Adding and removing hints")
+    response = xml.query("Check y.")
+    assert response.error and response.output.startswith("Error: The reference y")
+
+def test_state_ids(backends):
+    _, xml = backends
+    initial = xml.query("Reset Initial.").state_id
+    checked = xml.query("Check nat.").state_id
+    defined = xml.query("Definition x := 1.").state_id
+    assert len({initial, checked, defined}) == 3
+    assert xml.query("Check y.").state_id == defined
+    assert xml.query("Back 1.").state_id == checked
+    assert xml.query("Reset Initial.").state_id == initial
+
+def test_pipelined(backends):
+    _, xml = backends
+    outputs = xml.send_pipelined(["Definition a := 1.", "Check b.", "Definition c := 2."])
+    assert outputs[0] == "a is defined" and outputs[1].startswith("Error:") and len(outputs) == 2
+
+def test_render():
+    assert render([Message("warning", "w"), Message("notice", "n"), Message("error", "e")]) == \
+        "Warning: w\nn\nError: e"
@@ -0,0 +1,54 @@
+import pytest
+
+from coqrst.repl.coqtop import CoqTop, is_error
+from coqrst.repl.incremental import update_states, IncrementalSession
+
+ERROR = "Toplevel input, characters 6-7:\n> Check y.\n>       ^\nError: The reference y was not found."
+WARNING = "Toplevel input, characters 0-14:\n> Hint Resolve x.\nWarning: Adding hints… [implicit-core-hint-db]"
+
+def test_is_error():
+    assert is_error(ERROR)
+    assert is_error("\x1b[91mError:\x1b[0m Oops.")
+    assert not is_error(WARNING)
+    assert not is_error("The command has indeed failed with message:\nError-prone")
+
+@pytest.mark.parametrize("sentence, output, expected", [
+    ("Definition z := 0.", "z is defined", [0, 1, 2, 3]),
+    ("Hint Resolve x.", WARNING, [0, 1, 2, 3]),
+    ("Check y.", ERROR, [0, 1, 2]),
+    ("Back 2.", "", [0]),
+    ("Undo.", "", [0, 1]),
+    ("Back 5.", "", []),
+    ("Reset Initial.", "", []),
+])
+def test_update_states(sentence, output, expected):
+    states = [0, 1, 2]
+    update_states(states, 3, sentence, output)
+    assert states == expected
+
+@pytest.fixture
+def session(fake_coqtop, tmp_path, monkeypatch):
+    log = tmp_path / "log"
+    monkeypatch.setenv("FAKE_COQTOP_LOG", str(log))
+    session = IncrementalSession(CoqTop(transport="pipe", **fake_coqtop()))
+    session.log = lambda: log.read_text().splitlines()
+    yield session
+    session.close()
+
+def test_reuses_unchanged_prefix(session):
+    first = ["Definition x := 1.", "Check y.", "Check nat."]
+    outputs = session.run(first)
+    assert outputs[0] == "x is defined" and is_error(outputs[1])
+    assert session.run(first[:2] + ["Definition w := 2."])[2] == "w is defined"
+    assert session.log()[-2:] == ["Back 1.", "Definition w := 2."]
+
+def test_warnings_create_states(session):
+    session.run(["Definition x := 1.", "Hint Resolve x.", "Check nat.", "Check nat."])
+    assert session.states == [0, 1, 2, 3]
+    session.run(["Definition x := 1.", "Hint Resolve x.", "Definition w := 2."])
+    assert session.log()[-2:] == ["Back 2.", "Definition w := 2."]
+
+def test_resets_when_a_state_was_discarded(session):
+    session.run(["Definition x := 1.", "Back 1.", "Definition w := 2."])
+    session.run(["Definition x := 1.", "Definition w := 2."])
+    assert session.log()[-3:] == ["Reset Initial.", "Definition x := 1.", "Definition w := 2."]
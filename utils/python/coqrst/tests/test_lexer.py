@@ -0,0 +1,66 @@
+import pytest
+
+from coqrst.coqdoc import lexer
+
+def classes(source):
+    return [(cls[0] if cls else None, text) for cls, text in lexer.lex(source)]
+
+def test_keywords_tactics_and_variables():
+    assert classes("Proof. intros n.") == [
+        ("coqdoc-keyword", "Proof"), (None, ". "), ("coqdoc-tactic", "intros"),
+        (None, " "), ("coqdoc-var", "n"), (None, ".")]
+
+def test_qualified_names():
+    assert classes("Nat.add") == [("coqdoc-var", "Nat.add")]
+
+def test_nested_comments_and_strings():
+    assert classes('(* a (* "*)" *) b *) "x""y"') == [
+        ("coqdoc-comment", '(* a (* "*)" *) b *)'), (None, " "), ("coqdoc-string", '"x""y"')]
+
+def test_unterminated_comment():
+    assert classes("(* a") == [("coqdoc-comment", "(* a")]
+
+@pytest.mark.parametrize("symbol", ["/\\", "<->", "++", "<=", "*"])
+def test_notations(symbol):
+    assert ("coqdoc-notation", symbol) in classes("A {} B".format(symbol))
+
+@pytest.mark.parametrize("source", ["x := y", "fun x => x", "a : A", "match x with | _ => x end"])
+def test_punctuation_is_not_a_notation(source):
+    assert "coqdoc-notation" not in [cls for cls, _ in classes(source)]
+
+def test_bullets():
+    assert classes("- split.")[0] == (None, "- ")
+    assert classes("  ** auto.")[0] == (None, "  ** ")
+
+def test_roundtrip():
+    source = 'Definition f := fun x => (* c *) x ++ "s". - idtac.'
+    assert "".join(text for _, text in lexer.lex(source)) == source
+
+def test_normalize_ignores_classes_unknown_to_coqdoc():
+    tokens = lexer.lex('A /\\ B "s"')
+    assert lexer.normalize(tokens, lexer.UNTYPED_BY_COQDOC) == [
+        (["coqdoc-var"], "A"), ([], "/\\"), (["coqdoc-var"], "B"), ([], '"s"')]
+
+@pytest.mark.parametrize("differences, status", [(0, 0), (1, 0), (2, 1)])
+def test_main_fails_above_threshold(tmp_path, monkeypatch, capsys, differences, status):
+    import importlib
+    coqdoc_main = importlib.import_module("coqrst.coqdoc.main")
+    rst = tmp_path / "doc.rst"
+    rst.write_text(".. coqtop:: all\n\n   " + " ".join("Check x{}.".format(i) for i in range(20)) + "\n")
+    def fake_lex_many(snippets):
+        return [[(["coqdoc-keyword"], "Check"), ([], " "),
+                 (["coqdoc-var"] if idx >= differences else [], snippet[6:-1]), ([], ".")]
+                for idx, snippet in enumerate(snippets)]
+    monkeypatch.setattr(coqdoc_main, "lex_many", fake_lex_many)
+    monkeypatch.setattr("sys.argv", ["lexer", str(rst)])
+    with pytest.raises(SystemExit) as exit_info:
+        lexer.main()
+    assert exit_info.value.code == status
+    assert "{}/20 snippets differ".format(differences) in capsys.readouterr().out
+
+def test_sphinx_snippets_split_like_the_build(tmp_path):
+    rst = tmp_path / "doc.rst"
+    rst.write_text(".. coqtop:: all\n\n   Check (* a. b *) nat.\n   Goal True. Proof.\n\n"
+                   "   - exact I.\n\nText.\n", encoding="utf-8")
+    assert list(lexer.sphinx_snippets([str(rst)])) == [
+        "Check (* a. b *) nat.", "Goal True.", "Proof.", "-", "exact I."]
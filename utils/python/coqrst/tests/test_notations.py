@@ -0,0 +1,43 @@
+import pytest
+
+from coqrst.notations import rdparser
+from coqrst.notations.parsing import substitute, parse_with_antlr
+
+NOTATIONS = [
+    "apply @term",
+    "intros",
+    "rewrite {+, @oriented_rewriter } {? in @ident }",
+    "{* @id}",
+    "exists {+, @bindings_list}",
+    "simpl {? @delta_flag } {? {| @ref | @pattern } {? at {+ @num } } }",
+    "a {b} c",
+    "a { b } c",
+    "Set Printing {+ @ident }",
+    "Hint Resolve {+ @qualid_or_string } : @ident",
+    "@a@b",
+    "{+; @tactic }",
+    "foo  bar",
+]
+
+MALFORMED = ["", "{+ foo", "foo }", "@", "{+}", "{? }", "foo {"]
+
+@pytest.mark.parametrize("notation", NOTATIONS)
+def test_same_tree_as_antlr(notation):
+    notation = substitute(notation)
+    assert rdparser.sexp(rdparser.parse(notation)) == rdparser.sexp(parse_with_antlr(notation))
+
+@pytest.mark.parametrize("notation", MALFORMED)
+def test_same_errors_as_antlr(notation):
+    with pytest.raises(rdparser.NotationSyntaxError) as antlr_error:
+        parse_with_antlr(notation)
+    with pytest.raises(rdparser.NotationSyntaxError) as error:
+        rdparser.parse(notation)
+    assert error.value.column == antlr_error.value.column
+    assert error.value.notation == notation
+
+def test_terminals():
+    tree = rdparser.parse("apply @term")
+    assert tree.getText() == "apply @term"
+    hole = tree.getChild(0).getChild(2).getChild(0)
+    assert isinstance(hole, rdparser.HoleContext)
+    assert hole.ID().getText() == "@term"
@@ -0,0 +1,34 @@
+import threading
+
+from coqrst.repl.parallel import split_at_resets, split_for_jobs, run_segments, run_longest_first
+
+def test_split_at_resets():
+    sentences = ["Check nat.", "Reset Initial.", "Check x.", "Reset Initial.", "Reset Initial."]
+    assert split_at_resets(sentences) == [["Check nat."], ["Reset Initial.", "Check x."],
+                                          ["Reset Initial."], ["Reset Initial."]]
+    assert split_at_resets([]) == []
+
+def test_run_segments_keeps_order():
+    segments = [["a", "b"], ["c"], ["d", "e", "f"]]
+    outputs = run_segments(segments, lambda idx, seg: [(idx, s) for s in seg], jobs=3)
+    assert outputs == [(0, "a"), (0, "b"), (1, "c"), (2, "d"), (2, "e"), (2, "f")]
+
+def test_one_job_runs_in_the_calling_thread():
+    threads = set()
+    run_segments([["a"], ["b"]], lambda idx, seg: threads.add(threading.current_thread()) or seg, jobs=1)
+    assert threads == {threading.current_thread()}
+
+def test_run_longest_first():
+    started = []
+    def run(idx, seg):
+        started.append(idx)
+        return seg
+    segments = [["a"], ["b", "c", "d"], ["e", "f"]]
+    assert run_longest_first(segments, run, jobs=1) == segments
+    assert started == [1, 2, 0]
+
+def test_split_for_jobs():
+    sentences = ["Check nat.", "Reset Initial.", "Check x."]
+    assert split_for_jobs(sentences, 1) == [sentences]
+    assert split_for_jobs(sentences, 2) == split_at_resets(sentences)
+    assert split_for_jobs([], 1) == []
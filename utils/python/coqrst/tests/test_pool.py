@@ -0,0 +1,49 @@
+import os
+
+from coqrst.repl.pool import CoqTopPool, PooledCoqTop
+
+RULES = [{"pattern": r"^Require Import Broken\.$", "error": True, "output": "Cannot find Broken."},
+         {"pattern": r"^Check (\S+)\.$", "output": "{1} : Set"}]
+
+def test_prelude_runs_before_checkout(fake_coqtop):
+    errors = []
+    pool = CoqTopPool(0, ["Require Import Arith.", "Require Import Broken."],
+                      on_error=lambda *args: errors.append(args), transport="pipe", **fake_coqtop(RULES))
+    try:
+        with PooledCoqTop(pool) as coqtop:
+            assert coqtop.sendone("Check nat.") == "nat : Set"
+            coqtop.sendone("Reset Initial.")
+        with PooledCoqTop(pool) as coqtop:
+            pass
+        assert pool.idle == []
+    finally:
+        pool.close()
+    assert [sentence for sentence, _ in errors] == ["Require Import Broken."]
+    assert "Cannot find Broken." in errors[0][1]
+
+def test_keeps_processes_ready(fake_coqtop):
+    pool = CoqTopPool(2, transport="pipe", **fake_coqtop(RULES))
+    try:
+        with PooledCoqTop(pool) as coqtop:
+            assert len(pool.idle) == 2
+            assert coqtop.sendone("Check bool.") == "bool : Set"
+    finally:
+        pool.close()
+    assert pool.idle == []
+
+def test_forked_workers_dont_reuse_the_parents_processes(fake_coqtop):
+    pool = CoqTopPool(1, transport="pipe", **fake_coqtop(RULES))
+    try:
+        pool.checkin(pool.checkout())
+        inherited = pool.idle[0]
+        pid = os.fork()
+        if pid == 0: # pragma: no cover (runs in the child)
+            pool.close()
+            os._exit(0 if pool.idle == [] and inherited.driver.read_fd is None else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        coqtop = pool.checkout() # The child didn't stop the parent's process
+        assert coqtop is inherited
+        assert coqtop.sendone("Check nat.") == "nat : Set"
+        pool.checkin(coqtop)
+    finally:
+        pool.close()
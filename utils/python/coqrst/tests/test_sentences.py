@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from coqrst.repl.sentences import SentenceSplitter, split_sentences, sentence_spans, check
+
+CASES = [
+    ("Check nat. Check 1..2. Definition x := Nat.add.",
+     ["Check nat.", "Check 1..2.", "Definition x := Nat.add."]),
+    ('Check "a. b""c. d".', ['Check "a. b""c. d".']),
+    ("Check (* nested (* . *) \"*)\" *) x.", ["Check (* nested (* . *) \"*)\" *) x."]),
+    ("(* a. *) Check x.", ["(* a. *) Check x."]),
+    ("Check x. (* trailing *)", ["Check x. (* trailing *)"]),
+    ("Check x.y. Check x...", ["Check x.y.", "Check x..."]),
+    ("- { auto. } ++ idtac.\n*** exact I.", ["-", "{", "auto.", "}", "++", "idtac.", "***", "exact I."]),
+    ("Check x.\n\n  Check\n  y.", ["Check x.", "Check\n  y."]),
+    ("Check x", ["Check x"]),
+    ("", []),
+    ("  (* just a comment *)  ", ["(* just a comment *)"]),
+]
+
+@pytest.mark.parametrize("source, expected", CASES)
+def test_split_sentences(source, expected):
+    assert split_sentences(source) == expected
+
+@pytest.mark.parametrize("source", [source for source, _ in CASES])
+def test_properties(source):
+    random.seed(0)
+    assert check(source) == []
+
+@pytest.mark.parametrize("source", [source for source, _ in CASES])
+def test_one_character_at_a_time(source):
+    splitter, spans = SentenceSplitter(), []
+    for char in source:
+        spans.extend(splitter.feed(char))
+    spans.extend(splitter.close())
+    assert spans == list(sentence_spans(source))
+
+def test_sentences_are_released_early():
+    splitter = SentenceSplitter()
+    assert splitter.feed("Check x. (* c *)") == [] # Could be a trailing comment
+    assert splitter.feed(" Check") == [(0, 8)]
+    assert splitter.feed(" y. Check z.") == [(9, 25)] # Leading comments belong to the next one
+    assert splitter.close() == [(26, 34)]
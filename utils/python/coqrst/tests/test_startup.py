@@ -0,0 +1,16 @@
+import sys
+import subprocess
+
+EAGER_MODULES = """
+import sys
+from coqrst import startup
+startup.measure()
+print(*[m for m in startup.LAZY_MODULES if m in sys.modules])
+"""
+
+def test_heavy_dependencies_are_loaded_lazily():
+    # Use a fresh interpreter: other tests load these modules.  Timings are
+    # left to ‘make check-startup’, as they are unreliable in test runs.
+    eager = subprocess.run([sys.executable, "-c", EAGER_MODULES], check=True,
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    assert eager == []
@@ -0,0 +1,158 @@
+"""
+Measure where the Coq domain spends its time.
+=============================================
+
+When ``coq_timing_report`` is set, the domain times its expensive phases
+(`PHASES`) in each document: starting coqtop, running sentences (or waiting
+for the coqtop broker to run them), highlighting Coq code, parsing notations,
+parsing ANSI colors, and the coqtop transform as a whole.  At the end of the
+build it writes a JSON report with per-document and per-phase counts, total
+and maximum durations, and the slowest sentences, and logs a short summary.
+
+Measurements go to the module-level `RECORDER`.  When it's None (the default),
+`measure` returns a shared no-op context manager, and coqtop instances aren't
+wrapped at all.
+"""
+
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+
+PHASES = ("coqtop-start", "coqtop", "broker", "coqdoc", "notations", "ansi", "transform")
+
+# How many slow sentences to keep, per document and in the report
+SLOWEST = 20
+
+class _NoTiming:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+NO_TIMING = _NoTiming()
+
+RECORDER = None
+
+def measure(phase):
+    """Return a context manager that times its body as part of phase."""
+    return RECORDER.measure(phase) if RECORDER else NO_TIMING
+
+def merge_stats(stats, other):
+    """Add the [count, total, max] triple other into stats."""
+    stats[0] += other[0]
+    stats[1] += other[1]
+    stats[2] = max(stats[2], other[2])
+
+class TimingRecorder:
+    """Per-document timings, for the document being read in this process.
+
+    Sphinx reads one document at a time in each process (in parallel builds,
+    each worker has its own recorder); coqtop segments may run in threads, so
+    recording is thread-safe.
+    """
+
+    def __init__(self):
+        self.docname = None
+        self.phases = {} # Phase → [count, total, max]
+        self.sentences = [] # Heap of (duration, sentence): the slowest ones
+        self.lock = threading.Lock()
+
+    def start_document(self, docname):
+        self.docname, self.phases, self.sentences = docname, {}, []
+
+    def add(self, phase, duration):
+        with self.lock:
+            merge_stats(self.phases.setdefault(phase, [0, 0.0, 0.0]), [1, duration, duration])
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def add_sentence(self, sentence, duration):
+        self.add("coqtop", duration)
+        with self.lock:
+            entry = (duration, sentence)
+            if len(self.sentences) < SLOWEST:
+                heapq.heappush(self.sentences, entry)
+            else:
+                heapq.heappushpop(self.sentences, entry)
+
+    def finish_document(self, source):
+        """Return the timings of the current document as a JSON-compatible
+        dict, locating its slowest sentences in source (the document's text)."""
+        lines = source.splitlines()
+        sentences = []
+        for duration, sentence in sorted(self.sentences, reverse=True):
+            first = sentence.strip().split("\n")[0]
+            line = next((idx + 1 for idx, text in enumerate(lines) if first in text), None)
+            sentences.append({"sentence": sentence, "line": line, "duration": duration})
+        timings = {"phases": dict(self.phases), "slowest": sentences}
+        self.start_document(None)
+        return timings
+
+class TimedRepl:
+    """A wrapper around a CoqTop-like object that times each sentence."""
+
+    def __init__(self, repl, recorder):
+        self.repl, self.recorder = repl, recorder
+
+    def __getattr__(self, name):
+        return getattr(self.repl, name)
+
+    def __enter__(self):
+        with self.recorder.measure("coqtop-start"):
+            self.repl.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.repl.__exit__(type, value, traceback)
+
+    def sendone(self, sentence, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.repl.sendone(sentence, *args, **kwargs)
+        finally:
+            self.recorder.add_sentence(sentence, time.perf_counter() - start)
+
+def make_report(documents):
+    """Aggregate documents (a dict mapping docnames to the results of
+    `TimingRecorder.finish_document`) into a JSON-compatible report."""
+    phases, slowest = {}, []
+    for docname, timings in documents.items():
+        for phase, stats in timings["phases"].items():
+            merge_stats(phases.setdefault(phase, [0, 0.0, 0.0]), stats)
+        slowest.extend(dict(entry, docname=docname) for entry in timings["slowest"])
+    slowest = sorted(slowest, key=lambda entry: entry["duration"], reverse=True)[:SLOWEST]
+
+    def stats_dict(stats):
+        return {"count": stats[0], "total": stats[1], "max": stats[2]}
+    return {"phases": {phase: stats_dict(stats) for phase, stats in phases.items()},
+            "documents": {docname: {phase: stats_dict(stats)
+                                    for phase, stats in timings["phases"].items()}
+                          for docname, timings in sorted(documents.items())},
+            "slowest_sentences": slowest}
+
+def summarize(report, count=3):
+    """Return a few lines describing report, for the console."""
+    lines = []
+    for phase in PHASES:
+        stats = report["phases"].get(phase)
+        if stats:
+            lines.append("{}: {:.2f}s in {} calls (max {:.3f}s)".format(
+                phase, stats["total"], stats["count"], stats["max"]))
+    # Other phases run within the transform, except notation parsing
+    totals = [(sum(phases[phase]["total"] for phase in ("transform", "notations") if phase in phases),
+               docname) for docname, phases in report["documents"].items()]
+    for total, docname in sorted(totals, reverse=True)[:count]:
+        lines.append("slow document: {} ({:.2f}s)".format(docname, total))
+    for entry in report["slowest_sentences"][:count]:
+        lines.append("slow sentence: {}:{} ({:.3f}s): {}".format(
+            entry["docname"], entry["line"] or "?", entry["duration"],
+            entry["sentence"].strip().split("\n")[0]))
+    return lines